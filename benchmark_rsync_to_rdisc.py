@@ -0,0 +1,327 @@
+#! /usr/bin/env python3
+"""
+Benchmark of a transfer cycle: discovery, rsync, vcf uploads and email, with local stand-ins for the HPC.
+
+Synthetic runs are created in a temporary folder: an exome run with vcf files, a RAW_data run with many small files
+and a run with one large file. Remote commands run locally with bash after a fixed ssh round trip latency, rsync
+copies local folders and vcf_upload.py is replaced by a script that sleeps.
+Results are written as json per release and compared with a previous result to catch regressions.
+"""
+import argparse
+from collections import Counter
+from io import BytesIO
+import json
+import os
+from pathlib import Path
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import rsync_to_rdisc
+import settings
+
+# Used by the rsync stand-in if rsync is not installed: copy the source folder and print --stats output.
+FAKE_RSYNC = """#! {python}
+import os
+import shutil
+import sys
+
+source, target = [arg.split(":", 1)[-1] if ":" in arg else arg for arg in sys.argv[-2:]]
+target = os.path.join(target, os.path.basename(source.rstrip("/")))
+files, size = 0, 0
+for folder, dirs, file_names in os.walk(source):
+    os.makedirs(os.path.join(target, os.path.relpath(folder, source)), exist_ok=True)
+    for file_name in file_names:
+        shutil.copyfile(os.path.join(folder, file_name), os.path.join(target, os.path.relpath(folder, source), file_name))
+        files += 1
+        size += os.path.getsize(os.path.join(folder, file_name))
+print("Number of regular files transferred: {{}}".format(files))
+print("Total file size: {{}} bytes".format(size))
+print("Total transferred file size: {{}} bytes".format(size))
+print("Literal data: {{}} bytes".format(size))
+print("Matched data: 0 bytes")
+"""
+
+# rsync stand-in using rsync of this host, the user@host: prefix of the source is removed.
+LOCAL_RSYNC = """#! {python}
+import os
+import sys
+
+args = [arg for arg in sys.argv[1:] if not arg.startswith("--rsh=")]
+args[-2] = args[-2].split(":", 1)[-1]
+os.execv({rsync!r}, ["rsync"] + args)
+"""
+
+FAKE_VCF_UPLOAD = """import sys
+import time
+
+time.sleep({latency})
+"""
+
+
+class LatencyClient:
+    """Stand-in for the ssh client, runs remote commands with bash on this host after a fixed round trip latency."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.round_trips = 0
+        self.lock = threading.Lock()
+
+    def exec_command(self, command):
+        with self.lock:
+            self.round_trips += 1
+        time.sleep(self.latency)
+        result = subprocess.run(["bash", "-c", command], stdout=subprocess.PIPE)
+        return None, BytesIO(result.stdout), BytesIO(b"")
+
+    def get_transport(self):
+        return self
+
+    def is_active(self):
+        return True
+
+    def close(self):
+        pass
+
+
+class StageTimer:
+    """Total time and number of calls per stage, stages are module functions of rsync_to_rdisc."""
+
+    stages = {
+        "discovery": "get_folders_remote_server",
+        "remote_sizes": "get_remote_folder_sizes",
+        "transfer": "transfer_run",
+        "rsync": "run_rsync",
+        "vcf_upload": "run_vcf_upload",
+        "email": "send_email",
+    }
+
+    def __init__(self):
+        self.seconds = Counter()
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.functions = {}
+
+    def _wrap(self, stage, function):
+        def timed(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.seconds[stage] += time.monotonic() - started
+                    self.calls[stage] += 1
+
+        return timed
+
+    def __enter__(self):
+        for stage, function_name in self.stages.items():
+            self.functions[function_name] = getattr(rsync_to_rdisc, function_name)
+            setattr(rsync_to_rdisc, function_name, self._wrap(stage, self.functions[function_name]))
+        return self
+
+    def __exit__(self, *exc_info):
+        for function_name, function in self.functions.items():
+            setattr(rsync_to_rdisc, function_name, function)
+
+    def reset(self):
+        with self.lock:
+            self.seconds.clear()
+            self.calls.clear()
+
+
+def create_runs(input_dir, samples, small_files, large_file_mb):
+    exome_run = input_dir / "Exomes/240101_A01131_0001_BENCHMARK_1"
+    for folder in ["single_sample_vcf", "exomedepth/HC", "QC/CNV"]:
+        (exome_run / folder).mkdir(parents=True)
+    summary = []
+    for sample in range(samples):
+        (exome_run / f"single_sample_vcf/U{sample:06d}.vcf").write_text("##fileformat=VCFv4.2\n" * 100)
+        (exome_run / f"exomedepth/HC/U{sample:06d}_HC.vcf").write_text("##fileformat=VCFv4.2\n" * 100)
+        summary.append(f"U{sample:06d};CM=HC;REFSET=RS-SSv7-2023-4;GENDER=female;CR=0.9900;PD=60.00;TC=95")
+    (exome_run / "QC/CNV/240101_A01131_0001_BENCHMARK_1_exomedepth_summary.txt").write_text("\n".join(summary))
+    (exome_run / "workflow.done").touch()
+
+    raw_run = input_dir / "RAW_data/240101_A01131_0001_BENCHMARK"
+    for index in range(small_files):
+        small_file = raw_run / f"Data/Intensities/BaseCalls/L{index % 4 + 1:03d}/C{index // 4}.1/s_{index % 4 + 1}.cbcl"
+        small_file.parent.mkdir(parents=True, exist_ok=True)
+        small_file.write_bytes(os.urandom(1024))
+
+    large_run = input_dir / "Genomes/240101_A01131_0002_BENCHMARK_1"
+    large_run.mkdir(parents=True)
+    with open(large_run / "sample.bam", "wb") as large_file:
+        for megabyte in range(large_file_mb):
+            large_file.write(os.urandom(1024 * 1024))
+    (large_run / "workflow.done").touch()
+
+
+def set_up_settings(work_dir, input_dir, mount_dir, upload_latency):
+    bin_dir = work_dir / "bin"
+    bin_dir.mkdir()
+    rsync = shutil.which("rsync")
+    if rsync:
+        (bin_dir / "rsync").write_text(LOCAL_RSYNC.format(python=sys.executable, rsync=rsync))
+    else:
+        (bin_dir / "rsync").write_text(FAKE_RSYNC.format(python=sys.executable))
+    (bin_dir / "rsync").chmod(0o755)
+    # vcf uploads use `source`, which is not a builtin of all /bin/sh implementations (e.g. dash).
+    (bin_dir / "source").write_text("#! /bin/sh\n")
+    (bin_dir / "source").chmod(0o755)
+    os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+
+    alissa_vcf_upload = work_dir / "alissa_vcf_upload"
+    (alissa_vcf_upload / "venv/bin").mkdir(parents=True)
+    (alissa_vcf_upload / "venv/bin/activate").touch()
+    (alissa_vcf_upload / "vcf_upload.py").write_text(FAKE_VCF_UPLOAD.format(latency=upload_latency))
+
+    settings.wkdir = str(work_dir / "wkdir")
+    Path(settings.wkdir).mkdir()
+    settings.log_path = f"{settings.wkdir}/Rsync_Dx.log"
+    settings.errorlog_path = f"{settings.wkdir}/Rsync_Dx.errorlog"
+    settings.event_log_path = f"{settings.wkdir}/Rsync_Dx.events.jsonl"
+    settings.alissa_vcf_upload = str(alissa_vcf_upload)
+    settings.ssh_control_path = None
+    settings.metrics_textfile_path = None
+    settings.rsync_progress = bool(rsync)
+    settings.transfer_settings = {
+        "benchmark": {
+            "mount_path": str(mount_dir),
+            "transfers": [
+                {
+                    "name": "Exomes",
+                    "input": f"{input_dir}/Exomes/",
+                    "output": "Exomes/",
+                    "files_required": ["workflow.done"],
+                    "continue_without_email": False,
+                    "upload_gatk_vcf": True,
+                    "upload_exomedepth_vcf": True,
+                    "priority": 10,
+                },
+                {
+                    "name": "RAW_data",
+                    "input": f"{input_dir}/RAW_data/",
+                    "output": "RAW_data/",
+                    "files_required": [""],
+                    "continue_without_email": False,
+                    "upload_gatk_vcf": False,
+                    "upload_exomedepth_vcf": False,
+                },
+                {
+                    "name": "Genomes",
+                    "input": f"{input_dir}/Genomes/",
+                    "output": "Genomes/",
+                    "files_required": ["workflow.done"],
+                    "continue_without_email": False,
+                    "upload_gatk_vcf": False,
+                    "upload_exomedepth_vcf": False,
+                },
+            ],
+        }
+    }
+    for transfer in settings.transfer_settings["benchmark"]["transfers"]:
+        (mount_dir / transfer["output"]).mkdir(parents=True)
+
+
+def run_cycle(client, stage_timer):
+    client.round_trips = 0
+    stage_timer.reset()
+    started = time.monotonic()
+    remove_run_file, to_be_transferred = rsync_to_rdisc.transfer_cycle(client, ["localhost"], f"{settings.wkdir}/run_file")
+    return {
+        "cycle_seconds": round(time.monotonic() - started, 3),
+        "ssh_round_trips": client.round_trips,
+        "runs": sum(len(runs) for runs in to_be_transferred.values()),
+        "stages": {
+            stage: {"seconds": round(stage_timer.seconds[stage], 3), "calls": stage_timer.calls[stage]}
+            for stage in StageTimer.stages
+        },
+    }
+
+
+def run_benchmark(args):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = Path(temp_dir)
+        input_dir, mount_dir = work_dir / "hpc", work_dir / "mount"
+        create_runs(input_dir, args.samples, args.small_files, args.large_file_mb)
+        set_up_settings(work_dir, input_dir, mount_dir, args.upload_latency)
+        client = LatencyClient(args.ssh_latency)
+        # vcf files are found relative to the working directory, as run_folder is <output>/<run>.
+        cwd = os.getcwd()
+        os.chdir(mount_dir)
+        try:
+            with StageTimer() as stage_timer:
+                # First cycle transfers all runs, second cycle finds no new runs.
+                results = {"transfer": run_cycle(client, stage_timer), "idle": run_cycle(client, stage_timer)}
+        finally:
+            os.chdir(cwd)
+            rsync_to_rdisc.get_transferred_runs(settings.wkdir).close()
+            rsync_to_rdisc.transferred_runs_stores.pop(settings.wkdir, None)
+    return {"label": args.label, "parameters": vars(args), "results": results}
+
+
+def print_result(result, previous=None):
+    print(f"Benchmark {result['label']}")
+    for cycle, cycle_result in result["results"].items():
+        previous_cycle = previous["results"][cycle] if previous else None
+        compare = f" (previous {previous_cycle['cycle_seconds']}s)" if previous_cycle else ""
+        print(
+            f"{cycle}: {cycle_result['cycle_seconds']}s{compare}, {cycle_result['runs']} runs, "
+            f"{cycle_result['ssh_round_trips']} ssh round trips"
+        )
+        for stage, stage_result in cycle_result["stages"].items():
+            print(f"  {stage:<14}{stage_result['seconds']:>10.3f}s{stage_result['calls']:>6} calls")
+
+
+def get_regressions(result, previous, threshold):
+    # Cycles that are slower than the previous result by more than threshold, or need more ssh round trips.
+    regressions = []
+    for cycle, cycle_result in result["results"].items():
+        previous_cycle = previous["results"].get(cycle)
+        if not previous_cycle:
+            continue
+        if cycle_result["cycle_seconds"] > previous_cycle["cycle_seconds"] * (1 + threshold):
+            regressions.append(f"{cycle}: {previous_cycle['cycle_seconds']}s -> {cycle_result['cycle_seconds']}s")
+        if cycle_result["ssh_round_trips"] > previous_cycle["ssh_round_trips"]:
+            regressions.append(
+                f"{cycle}: {previous_cycle['ssh_round_trips']} -> {cycle_result['ssh_round_trips']} ssh round trips"
+            )
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark a transfer cycle with local stand-ins for the HPC.")
+    parser.add_argument("--label", default="current", help="Name of this result, e.g. the release.")
+    parser.add_argument("--samples", type=int, default=24, help="Number of samples of the exome run.")
+    parser.add_argument("--small-files", type=int, default=2000, help="Number of files of the RAW_data run.")
+    parser.add_argument("--large-file-mb", type=int, default=256, help="Size of the large file in MB.")
+    parser.add_argument("--ssh-latency", type=float, default=0.05, help="Seconds per remote command.")
+    parser.add_argument("--upload-latency", type=float, default=0.2, help="Seconds per vcf upload.")
+    parser.add_argument("--output", help="Write the result as json to this file.")
+    parser.add_argument("--compare", help="Previous json result, exit with 1 on a regression.")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed slow down compared to --compare.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    previous = json.loads(Path(args.compare).read_text()) if args.compare else None
+    # Emails are counted as a stage, not sent.
+    rsync_to_rdisc.send_email = lambda subject, template, body_params, attachments=None: None
+    result = run_benchmark(args)
+    print_result(result, previous)
+    if args.output:
+        Path(args.output).write_text(json.dumps(result, indent=2))
+    if previous:
+        regressions = get_regressions(result, previous, args.threshold)
+        for regression in regressions:
+            print(f"Regression {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,544 @@
 #! /usr/bin/env python3
+import argparse
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from csv import writer
-from datetime import datetime
+from datetime import datetime, timedelta
+import fcntl
 import glob
+import hashlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import BytesIO
+from itertools import count
+import json
+import os
+import re
+import shlex
+import shutil
+import signal
+import smtplib
+import sqlite3
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import traceback
 
-from socket import gethostname, timeout
-from paramiko import SSHClient, ssh_exception
+from socket import create_connection, gethostname, timeout
 from pathlib import Path
-from jinja2 import Environment, FileSystemLoader
-from redmail import EmailSender
 
 import settings
 
 # TODO: add docstrings to all functions.
 
-def send_email(subject, template, body_params, attachments=None):
-    email = EmailSender(host=settings.email_smtp_host, port=settings.email_smtp_port, use_starttls=False)
-
-    # Setup template environment
-    jinja_env = Environment(loader=FileSystemLoader("templates"))
-    email.templates_html = jinja_env
-
-    # Send the email
-    email.send(
-        subject=subject,
-        sender=settings.email_from,
-        receivers=settings.email_to,
-        attachments=attachments,
-        html_template=template,
-        body_params=body_params,
+# rsync exit codes caused by a lost connection: socket I/O, protocol data stream, timeouts and ssh errors.
+RSYNC_CONNECTION_ERRORS = {10, 12, 30, 35, 255}
+
+# rsync exit codes that are retried: a lost connection or vanished source files.
+RSYNC_TRANSIENT_ERRORS = RSYNC_CONNECTION_ERRORS | {24}
+
+# Content of a run file that blocks transfers, any content that is not a pid blocks transfers.
+RUN_FILE_BLOCKED = "Transfers are blocked, remove this file before datatransfer can be restarted."
+
+# Open run files per path, the lock on a run file is held as long as its file object is open.
+run_file_locks = {}
+
+# State stores of transferred runs per wkdir, see get_transferred_runs.
+transferred_runs_stores = {}
+
+
+class LogWriter:
+    """
+    Single writer of the log files shared by parallel transfers.
+
+    Each write is appended at once, lines of parallel transfers are never interleaved.
+    Files are opened per write, the log files can be rotated while the daemon is running.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def write(self, path, lines):
+        # The human readable log files are optional, nothing is written when the path is set to None.
+        if not path:
+            return
+        with self.lock:
+            with open(path, "a", newline="\n") as log_file:
+                log_file.writelines(lines)
+
+    def writerows(self, path, rows):
+        if not path:
+            return
+        with self.lock:
+            with open(path, "a", newline="\n") as log_file:
+                writer(log_file, delimiter="\t").writerows(rows)
+
+
+log_writer = LogWriter()
+
+
+class EventLog:
+    """
+    Buffered writer of structured events, one JSON object per line in settings.event_log_path.
+
+    Each event has the time and stage, and if known the run, transfer, result, duration and bytes.
+    Events are written when event_log_buffer events are waiting and after each transfer cycle.
+    The file is rotated to <event_log_path>.1 .. .<event_log_backups> when it exceeds event_log_max_bytes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buffer = []
+
+    def emit(self, stage, **fields):
+        if not settings.event_log_path:
+            return
+        event = {"time": datetime.now().isoformat(timespec="seconds"), "stage": stage}
+        event.update(fields)
+        with self.lock:
+            self.buffer.append(json.dumps(event, default=str) + "\n")
+            if len(self.buffer) >= settings.event_log_buffer:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.buffer or not settings.event_log_path:
+            return
+        event_log_path = Path(settings.event_log_path)
+        if (
+            settings.event_log_max_bytes
+            and event_log_path.exists()
+            and event_log_path.stat().st_size + sum(len(line) for line in self.buffer) > settings.event_log_max_bytes
+        ):
+            self._rotate(event_log_path)
+        with open(event_log_path, "a", newline="\n") as event_log_file:
+            event_log_file.writelines(self.buffer)
+        self.buffer = []
+
+    def _rotate(self, event_log_path):
+        # Shift backups, the oldest backup is overwritten.
+        for index in range(settings.event_log_backups - 1, 0, -1):
+            backup_path = Path(f"{event_log_path}.{index}")
+            if backup_path.exists():
+                backup_path.replace(f"{event_log_path}.{index + 1}")
+        if settings.event_log_backups:
+            event_log_path.replace(f"{event_log_path}.1")
+        else:
+            event_log_path.unlink()
+
+
+event_log = EventLog()
+
+# Time a run was first found by discovery per run key, used for the priority age boost.
+run_first_seen = {}
+
+# Last probe per mount path: (probe time, available, probe thread), see is_mount_available.
+mount_probes = {}
+
+# Live progress of running rsync transfers per run, parsed from --info=progress2.
+transfer_progress = {}
+
+# Size of the runs submitted to the transfer scheduler per run key: (mount path, bytes), see get_available_bytes.
+in_flight_sizes = {}
+in_flight_sizes_lock = threading.Lock()
+
+# Running rsync processes per mount and per transfer, bandwidth budgets are split between these processes.
+running_rsyncs = Counter()
+running_rsyncs_lock = threading.Lock()
+
+# rsync --info=progress2 line: transferred bytes, percentage, transfer rate and time left (elapsed time when finished).
+RSYNC_PROGRESS = re.compile(r"^\s*([\d.,]+[KMGTP]?)\s+(\d+)%\s+(\S+/s)\s+(\d+):(\d\d):(\d\d)")
+
+
+class Metrics:
+    """
+    Prometheus metrics collected by the transfer cycles, exported in the text exposition format.
+
+    Gauges are set, counters are increased and summaries keep the sum and count of observed values.
+    """
+
+    definitions = {
+        "rsync_to_rdisc_runs_pending": ("gauge", "Runs to be transferred in the last transfer cycle."),
+        "rsync_to_rdisc_rsync_transferred_bytes": ("counter", "Bytes transferred by rsync."),
+        "rsync_to_rdisc_rsync_duration_seconds": ("summary", "Duration of rsync transfers."),
+        "rsync_to_rdisc_rsync_failures": ("counter", "Failed rsync transfers."),
+        "rsync_to_rdisc_rsync_retries": ("counter", "Retried rsync transfers after a transient error."),
+        "rsync_to_rdisc_rsync_progress_bytes": ("gauge", "Bytes transferred by running rsync transfers."),
+        "rsync_to_rdisc_rsync_progress_eta_seconds": ("gauge", "Estimated time left of running rsync transfers."),
+        "rsync_to_rdisc_discovery_duration_seconds": ("summary", "Duration of the remote discovery command."),
+        "rsync_to_rdisc_vcf_upload_duration_seconds": ("summary", "Duration of vcf uploads."),
+        "rsync_to_rdisc_vcf_upload_failures": ("counter", "Failed vcf uploads."),
+        "rsync_to_rdisc_mount_available": ("gauge", "Mount point available in the last transfer cycle."),
+        "rsync_to_rdisc_last_successful_cycle_timestamp_seconds": ("gauge", "Time of the last transfer cycle without errors."),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, name, labels):
+        return name, tuple(sorted((labels or {}).items()))
+
+    def set(self, name, value, labels=None):
+        with self.lock:
+            self.values[self._key(name, labels)] = value
+
+    def inc(self, name, value=1, labels=None):
+        with self.lock:
+            key = self._key(name, labels)
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        with self.lock:
+            key = self._key(name, labels)
+            observed_sum, observed_count = self.values.get(key, (0, 0))
+            self.values[key] = (observed_sum + value, observed_count + 1)
+
+    def get(self, name, labels=None):
+        with self.lock:
+            return self.values.get(self._key(name, labels))
+
+    def remove(self, name, labels=None):
+        with self.lock:
+            self.values.pop(self._key(name, labels), None)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            values = dict(self.values)
+        for name, (metric_type, help_text) in self.definitions.items():
+            samples = sorted((labels, value) for (metric_name, labels), value in values.items() if metric_name == name)
+            if not samples:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                label_text = ",".join(f'{label}="{label_value}"' for label, label_value in labels)
+                label_text = f"{{{label_text}}}" if label_text else ""
+                if metric_type == "summary":
+                    lines.append(f"{name}_sum{label_text} {value[0]}")
+                    lines.append(f"{name}_count{label_text} {value[1]}")
+                elif metric_type == "counter":
+                    lines.append(f"{name}_total{label_text} {value}")
+                else:
+                    lines.append(f"{name}{label_text} {value}")
+        return "\n".join(lines) + "\n"
+
+
+# Metrics of this process, see write_metrics_textfile and start_metrics_server.
+metrics = Metrics()
+
+
+def write_metrics_textfile(metrics_textfile_path):
+    # Replace the file at once, the textfile collector must not read a partially written file.
+    temp_path = f"{metrics_textfile_path}.{os.getpid()}.tmp"
+    Path(temp_path).write_text(metrics.render())
+    os.replace(temp_path, metrics_textfile_path)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Do not log every scrape to stderr.
+        pass
+
+
+def start_metrics_server(address, port):
+    metrics_server = HTTPServer((address, port), MetricsRequestHandler)
+    threading.Thread(target=metrics_server.serve_forever, daemon=True).start()
+    return metrics_server
+
+
+class TransferScheduler:
+    """
+    Run transfer jobs on a bounded pool of worker threads.
+
+    Each job can be restricted by one or more (key, limit) pairs, e.g. per mount or per transfer name.
+    A job is only started when the pool has a free worker and none of its limits have been reached.
+    Waiting jobs are started by priority, highest first, and in order of submission for equal priorities.
+    Jobs can be submitted while other jobs are running, e.g. new runs found by the daemon.
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.pending = []
+        self.running = {}
+        self.running_count = Counter()
+        self.active_keys = set()
+        self.errors = []
+        self.sequence = count()
+        self.condition = threading.Condition(threading.RLock())
+
+    def submit(self, function, *args, limits=(), priority=0, key=None, **kwargs):
+        with self.condition:
+            if key is not None:
+                self.active_keys.add(key)
+            self.pending.append((-priority, next(self.sequence), function, args, kwargs, limits, key))
+            self.pending.sort(key=lambda job: job[:2])
+            self._dispatch()
+
+    def is_active(self, key):
+        # Job with this key is waiting or running.
+        with self.condition:
+            return key in self.active_keys
+
+    def _is_allowed(self, limits):
+        return all(not limit or self.running_count[key] < limit for key, limit in limits)
+
+    def _dispatch(self):
+        for job in list(self.pending):
+            if len(self.running) >= self.max_workers:
+                break
+            priority, sequence, function, args, kwargs, limits, key = job
+            if self._is_allowed(limits):
+                self.pending.remove(job)
+                for limit_key, limit in limits:
+                    self.running_count[limit_key] += 1
+                future = self.executor.submit(function, *args, **kwargs)
+                self.running[future] = (limits, key)
+                future.add_done_callback(self._done)
+
+    def _done(self, future):
+        with self.condition:
+            limits, key = self.running.pop(future)
+            for limit_key, limit in limits:
+                self.running_count[limit_key] -= 1
+            self.active_keys.discard(key)
+            if future.exception() is not None:
+                # Do not start waiting jobs after an error, such as SystemExit, the error is raised by raise_errors.
+                self.errors.append(future.exception())
+                self.cancel_pending()
+            self._dispatch()
+            self.condition.notify_all()
+
+    def cancel_pending(self):
+        with self.condition:
+            for job in self.pending:
+                self.active_keys.discard(job[-1])
+            self.pending.clear()
+
+    def raise_errors(self):
+        # Raise exceptions, such as SystemExit, from the worker threads.
+        with self.condition:
+            if self.errors:
+                raise self.errors.pop(0)
+
+    def join(self):
+        try:
+            with self.condition:
+                while self.pending or self.running:
+                    self.condition.wait()
+            self.raise_errors()
+        finally:
+            self.executor.shutdown(wait=True)
+
+
+def get_run_priority(run, transfer_settings):
+    # Runs waiting for a long time gain priority, a backup is not delayed indefinitely by clinical runs.
+    first_seen = run_first_seen.get(f"{run}_{transfer_settings['name']}", time.time())
+    # Full hours only, runs of the same transfer found in the same cycle keep their order.
+    waiting_hours = int((time.time() - first_seen) // 3600)
+    return transfer_settings.get("priority", 0) + settings.priority_age_boost * waiting_hours
+
+
+def get_transfer_limits(mount_path, mount_max_parallel, transfer_settings):
+    return [
+        (f"mount:{mount_path}", mount_max_parallel),
+        (f"transfer:{transfer_settings['name']}", transfer_settings.get("max_parallel", None)),
+    ]
+
+
+def get_bwlimit_budget(bwlimit, now):
+    # bwlimit is a fixed limit in KiB/s or a list of time windows: {"start": "HH:MM", "end": "HH:MM", "bwlimit": KiB/s}.
+    # None is unlimited, as is the time outside all windows.
+    if not isinstance(bwlimit, list):
+        return bwlimit
+    current_time = now.strftime("%H:%M")
+    for window in bwlimit:
+        if window["start"] <= window["end"]:
+            in_window = window["start"] <= current_time < window["end"]
+        else:
+            # Window past midnight, e.g. 22:00 - 06:00.
+            in_window = current_time >= window["start"] or current_time < window["end"]
+        if in_window:
+            return window["bwlimit"]
+    return None
+
+
+def get_bwlimits(mount_path, transfer_settings):
+    # Bandwidth budget and number of rsync slots of the mount and of the transfer.
+    mount_settings = next(
+        (
+            mount_settings
+            for mount_settings in settings.transfer_settings.values()
+            if str(mount_settings["mount_path"]) == str(mount_path)
+        ),
+        {},
     )
+    return [
+        (f"mount:{mount_path}", mount_settings.get("bwlimit"), mount_settings.get("max_parallel")),
+        (f"transfer:{transfer_settings['name']}", transfer_settings.get("bwlimit"), transfer_settings.get("max_parallel")),
+    ]
+
+
+def get_bwlimit(mount_path, transfer_settings, now=None):
+    """
+    Bandwidth limit in KiB/s for a new rsync process, None if unlimited.
+
+    The budgets of the mount and the transfer in the current time window are split evenly between the rsync slots
+    of the mount and of the transfer (max_parallel, or rsync_max_workers if not set), the lowest share is used.
+    The running rsync processes never exceed the budget, also when more processes are started later.
+    """
+    now = now or datetime.now()
+    shares = []
+    for limit_key, bwlimit, max_parallel in get_bwlimits(mount_path, transfer_settings):
+        budget = get_bwlimit_budget(bwlimit, now)
+        if budget is not None:
+            with running_rsyncs_lock:
+                rsync_slots = max(1, running_rsyncs[limit_key], max_parallel or settings.rsync_max_workers)
+            shares.append(max(1, int(budget / rsync_slots)))
+    return min(shares) if shares else None
+
+
+def get_bwlimit_window_seconds(mount_path, transfer_settings, now=None):
+    # Seconds until the next start or end of a bandwidth window of the mount or the transfer, None without windows.
+    now = now or datetime.now()
+    window_changes = []
+    for _, bwlimit, _ in get_bwlimits(mount_path, transfer_settings):
+        if not isinstance(bwlimit, list):
+            continue
+        for window in bwlimit:
+            for window_time in [window["start"], window["end"]]:
+                hour, minute = (int(value) for value in window_time.split(":"))
+                window_change = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+                if window_change <= now:
+                    window_change += timedelta(days=1)
+                window_changes.append((window_change - now).total_seconds())
+    return min(window_changes) if window_changes else None
+
+
+class Notifier:
+    """
+    Sends all emails with a single EmailSender, templates are compiled once by its template environment.
+
+    Within a session, e.g. a transfer cycle, emails are sent over a single SMTP connection opened for the first email.
+    With settings.email_digest completed transfers are collected and sent as one summary email,
+    at the end of a session when the last digest was sent email_digest_interval seconds ago, or by send_digest.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.email_sender = None
+        self.sessions = 0
+        self.digest = []
+        self.digest_sent = time.monotonic()
+
+    def get_email_sender(self):
+        # redmail and jinja2 are only imported to send email, e.g. not when a cycle stops early.
+        import redmail
+
+        if self.email_sender is None:
+            self.email_sender = redmail.EmailSender(
+                host=settings.email_smtp_host, port=settings.email_smtp_port, use_starttls=False
+            )
+            self.email_sender.templates_html = get_template_environment()
+        return self.email_sender
+
+    def send(self, subject, template, body_params, attachments=None):
+        with self.lock:
+            email_sender = self.get_email_sender()
+            for attempt in range(2):
+                if self.sessions and not email_sender.is_alive:
+                    email_sender.connect()
+                try:
+                    email_sender.send(
+                        subject=subject,
+                        sender=settings.email_from,
+                        receivers=settings.email_to,
+                        attachments=attachments,
+                        html_template=template,
+                        body_params=body_params,
+                    )
+                    return
+                except smtplib.SMTPServerDisconnected:
+                    # Session closed by the SMTP server, e.g. after an idle timeout, send again over a new connection.
+                    email_sender.connection = None
+                    if attempt or not self.sessions:
+                        raise
+
+    def add_to_digest(self, subject, body_params):
+        with self.lock:
+            self.digest.append(dict(body_params, subject=subject))
+
+    def send_digest(self):
+        with self.lock:
+            self.digest_sent = time.monotonic()
+            if not self.digest:
+                return
+            digest, self.digest = self.digest, []
+            send_email(
+                subject=f"COMPLETED: Transfer has completed for {len(digest)} runs",
+                template="transfer_digest.html",
+                body_params={"transfers": digest},
+            )
+
+    @contextmanager
+    def session(self):
+        with self.lock:
+            self.sessions += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                try:
+                    if time.monotonic() - self.digest_sent >= settings.email_digest_interval:
+                        self.send_digest()
+                finally:
+                    self.sessions -= 1
+                    if not self.sessions and self.email_sender is not None and self.email_sender.is_alive:
+                        try:
+                            self.email_sender.close()
+                        except smtplib.SMTPException:
+                            self.email_sender.connection = None
+
+
+notifier = Notifier()
+
+
+def get_template_environment():
+    # Compiled templates are cached on disk and reused by the next transfer process.
+    import jinja2
+
+    bytecode_cache = None
+    if settings.template_cache_dir:
+        Path(settings.template_cache_dir).mkdir(parents=True, exist_ok=True)
+        bytecode_cache = jinja2.FileSystemBytecodeCache(settings.template_cache_dir)
+    return jinja2.Environment(loader=jinja2.FileSystemLoader("templates"), bytecode_cache=bytecode_cache)
+
+
+def send_email(subject, template, body_params, attachments=None):
+    notifier.send(subject, template, body_params, attachments)
+
+
+def is_alert_due(alert):
+    # Alerts for the same problem, e.g. a failing transfer retried every cycle, are sent once per email_alert_interval.
+    return get_transferred_runs(settings.wkdir).set_alert(alert, interval=settings.email_alert_interval)
 
 
 def send_mail_lost_mount(mount_name, run_file):
@@ -50,20 +558,54 @@ def send_mail_lost_hpc(hpc_host, run_file):
     )
 
 
-def send_mail_transfer_state(filename, state, upload_result_gatk=None, upload_result_exomedepth=None):
+def send_mail_mount_full(mount_path, skipped_runs, free_bytes):
+    send_email(
+        subject=f"ERROR: Not enough space on {mount_path} for {len(skipped_runs)} runs",
+        template="mount_full.html",
+        body_params={
+            "mount_path": mount_path,
+            "skipped_runs": [(run, round(run_size / 1e9, 1)) for run, run_size in skipped_runs],
+            "free_gb": round(free_bytes / 1e9, 1),
+        },
+    )
+
+
+def send_mail_transfer_state(
+    filename,
+    state,
+    upload_result_gatk=None,
+    upload_result_exomedepth=None,
+    metrics=None,
+    errors=None,
+    verify_result=None,
+):
     body_params = {"filename": filename}
-    if state in ["ok", "vcf_upload_error", "vcf_upload_warning"]:
+    if state in ["ok", "vcf_upload_error", "vcf_upload_warning", "verify_error"]:
         if state == "ok":
             subject = f"COMPLETED: Transfer has successfully completed for {filename}"
         elif state == "vcf_upload_error":
             subject = f"ERROR: Transfer has completed with VCF upload error for {filename}"
         elif state == "vcf_upload_warning":
             subject = f"COMPLETED: Transfer has completed with VCF upload warning for {filename}"
+        elif state == "verify_error":
+            subject = f"ERROR: Transfer has completed with checksum errors for {filename}"
         template = "transfer_ok.html"
-        body_params.update({"upload_result_gatk": upload_result_gatk, "upload_result_exomedepth": upload_result_exomedepth})
+        body_params.update(
+            {
+                "upload_result_gatk": upload_result_gatk,
+                "upload_result_exomedepth": upload_result_exomedepth,
+                "metrics": metrics,
+                "verify_result": verify_result,
+            }
+        )
     elif state == "error":
         subject = f"ERROR: Transfer has not completed for {filename}"
         template = "transfer_error.html"
+        body_params["errors"] = errors
+    if settings.email_digest and state in ["ok", "vcf_upload_warning"]:
+        # Completed transfers are sent in a single summary email, errors are sent immediately.
+        notifier.add_to_digest(subject, body_params)
+        return
     send_email(subject, template, body_params)
 
 
@@ -75,61 +617,771 @@ def send_mail_incomplete(run, title_template, subject, run_file):
 
 
 def check_rsync(run, input, ngs_type_name, subprocess_out):
+    # stderr of the run is passed with subprocess_out, the full stderr is written to errorlog_path.
     if not subprocess_out.stderr or not subprocess_out.returncode:
-        log_msg = [[""], [">>> No errors detected <<<"]]
-        Path(settings.temp_error_path).unlink()  # remove tmperror file.
+        log_msg = [[run, ">>> No errors detected <<<"]]
         rsync_result = "ok"
     else:
-        log_msg = [[""], [f">>>{run}_{ngs_type_name} errors detected in data transfer, not added to completed files <<<"]]
-        send_mail_transfer_state(f"{input}{run}", "error")
+        log_msg = [[run, f">>>{run}_{ngs_type_name} errors detected in data transfer, not added to completed files <<<"]]
         rsync_result = "error"
 
-    with open(settings.log_path, "a", newline="\n") as log_file:
-        log_file_writer = writer(log_file, delimiter="\t")
-        log_file_writer.writerows(log_msg)
+    log_writer.writerows(settings.log_path, log_msg)
+
+    if rsync_result == "error":
+        # A failed run is transferred again in the next cycles, the error mail is not repeated every cycle.
+        if is_alert_due(f"transfer_error:{run}_{ngs_type_name}"):
+            send_mail_transfer_state(f"{input}{run}", "error", errors=subprocess_out.stderr)
+    else:
+        get_transferred_runs(settings.wkdir).clear_alert(f"transfer_error:{run}_{ngs_type_name}")
 
     return rsync_result
 
 
 def check_daemon_running(wkdir):
     run_file = Path(f"{wkdir}/transfer.running")
+    run_file_exists = run_file.exists()
+    lock_file = open(run_file, "a+")
     try:
-        run_file.touch(exist_ok=False)
-    except FileExistsError:
+        # The lock is released by the kernel when the process stops, also after a crash.
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        # Another transfer process is running.
+        lock_file.close()
         sys.exit()
     else:
-        return run_file
+        if not run_file.exists() or os.stat(run_file).st_ino != os.fstat(lock_file.fileno()).st_ino:
+            # The run_file was removed by the previous transfer process while acquiring the lock.
+            lock_file.close()
+            return check_daemon_running(wkdir)
+
+        lock_file.seek(0)
+        run_file_content = lock_file.read().strip()
+        if run_file_exists and not run_file_content.isdigit():
+            # Transfers are blocked until the run_file is removed manually.
+            lock_file.close()
+            sys.exit()
+        else:
+            # A pid is left behind by a stopped transfer process and does not block transfers.
+            write_run_file(lock_file, str(os.getpid()))
+            run_file_locks[run_file] = lock_file
+            return run_file
 
 
-def is_mount_available(mount_name, mount_path, run_file):
-    is_available = True
+def write_run_file(lock_file, content):
+    lock_file.seek(0)
+    lock_file.truncate()
+    lock_file.write(content)
+    lock_file.flush()
+
+
+def release_run_file(run_file, remove_run_file):
+    # No run file is used by --plan.
+    if run_file is None:
+        return
+    lock_file = run_file_locks.pop(Path(run_file), None)
+    # Remove run_file if transfer daemon shouldn't be blocked to prevent repeated mailing.
+    if remove_run_file:
+        if Path(run_file).exists():
+            Path(run_file).unlink()
+    elif lock_file:
+        write_run_file(lock_file, RUN_FILE_BLOCKED)
+    elif Path(run_file).exists():
+        Path(run_file).write_text(RUN_FILE_BLOCKED)
+    if lock_file:
+        lock_file.close()
+
+
+def probe_mount(mount_path, output_dirs=()):
+    # Write, read and remove a small file, exists() does not detect a stale or read only network mount.
+    # The file is written in the first existing output directory of the transfers, not in the root of the mount.
+    # Without an output directory the mount is only listed.
     try:
-        Path(mount_path).exists()
-    except (OSError, BlockingIOError):
+        probe_dir = next(
+            (Path(mount_path) / output_dir for output_dir in output_dirs if (Path(mount_path) / output_dir).is_dir()), None
+        )
+        if probe_dir is None:
+            os.listdir(mount_path)
+            return True
+        probe_file = probe_dir / f".rsync_to_rdisc_probe_{gethostname()}_{os.getpid()}"
+        probe_content = str(time.time())
+        probe_file.write_text(probe_content)
+        try:
+            return probe_file.read_text() == probe_content
+        finally:
+            probe_file.unlink()
+    except OSError:
+        return False
+
+
+def is_mount_available(mount_name, mount_path, run_file):
+    # The probe runs in a separate thread, a probe blocked by a stale mount does not block the transfer cycle.
+    probed, is_available, probe_thread = mount_probes.get(mount_path, (None, False, None))
+    if probe_thread is not None and probe_thread.is_alive():
+        # Previous probe is still blocked.
         is_available = False
+    elif probed is None or time.monotonic() - probed > settings.mount_probe_ttl:
+        probe_result = []
+        output_dirs = [
+            transfer["output"] for transfer in settings.transfer_settings.get(mount_name, {}).get("transfers", [])
+        ]
+        probe_thread = threading.Thread(
+            target=lambda: probe_result.append(probe_mount(mount_path, output_dirs)), daemon=True
+        )
+        probe_thread.start()
+        probe_thread.join(settings.mount_probe_timeout)
+        is_available = bool(probe_result) and probe_result[0]
+        mount_probes[mount_path] = (time.monotonic(), is_available, probe_thread)
+
+    # Send a single mail when the mount is lost, transfers to other mounts continue.
+    transferred_runs = get_transferred_runs(settings.wkdir)
+    if is_available:
+        transferred_runs.clear_alert(f"lost_mount:{mount_name}")
+    elif transferred_runs.set_alert(f"lost_mount:{mount_name}"):
+        send_mail_lost_mount(mount_name, run_file)
+
+    metrics.set("rsync_to_rdisc_mount_available", int(is_available), {"mount": mount_name})
+    return is_available
+
+
+class TransferredRuns:
+    """
+    State store of transferred runs, a SQLite database in wkdir.
+
+    Runs are stored by run_key <run>_<transfer name>, as in the legacy transferred_runs.txt.
+    The legacy file is imported once when the database is created and is not changed afterwards.
+    """
+
+    columns = ["run_key", "run", "name", "state", "started", "finished", "bytes", "duration", "metrics"]
+
+    def __init__(self, wkdir):
+        self.db_path = Path(f"{wkdir}/transferred_runs.db")
+        self.lock = threading.Lock()
+        # Connection is shared by the transfer threads, access is serialized with self.lock.
+        self.connection = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS transferred_runs (
+                    run_key TEXT PRIMARY KEY,
+                    run TEXT,
+                    name TEXT,
+                    state TEXT,
+                    started TEXT,
+                    finished TEXT,
+                    bytes INTEGER,
+                    duration REAL
+                )"""
+            )
+            # Added after the first release of the state store.
+            table_columns = [column[1] for column in self.connection.execute("PRAGMA table_info(transferred_runs)")]
+            if "metrics" not in table_columns:
+                self.connection.execute("ALTER TABLE transferred_runs ADD COLUMN metrics TEXT")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS transferred_runs_state ON transferred_runs (state)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)")
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS post_transfer_jobs (
+                    run_key TEXT PRIMARY KEY,
+                    run TEXT,
+                    transfer TEXT,
+                    status TEXT,
+                    steps TEXT,
+                    created TEXT
+                )"""
+            )
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS discovery_cache (
+                    folder_key TEXT PRIMARY KEY,
+                    mtime INTEGER,
+                    missing TEXT,
+                    checked REAL
+                )"""
+            )
+            # Added after the first release of the discovery cache.
+            cache_columns = [column[1] for column in self.connection.execute("PRAGMA table_info(discovery_cache)")]
+            if "bytes" not in cache_columns:
+                self.connection.execute("ALTER TABLE discovery_cache ADD COLUMN bytes INTEGER")
+        self.import_legacy_file(Path(f"{wkdir}/transferred_runs.txt"))
+
+    def import_legacy_file(self, legacy_file):
+        with self.lock, self.connection:
+            imported = self.connection.execute("SELECT value FROM metadata WHERE key = 'legacy_imported'").fetchone()
+            if imported or not legacy_file.is_file():
+                return
+            with open(legacy_file, "r") as runs:
+                for transferred_run_state in runs.read().splitlines():
+                    if not transferred_run_state:
+                        continue
+                    run_key, *state = transferred_run_state.split("\t")
+                    run, name = split_run_key(run_key)
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO transferred_runs (run_key, run, name, state) VALUES (?, ?, ?, ?)",
+                        (run_key, run, name, state[0] if state else None),
+                    )
+            self.connection.execute(
+                "INSERT INTO metadata (key, value) VALUES ('legacy_imported', ?)", (datetime.now().isoformat(),)
+            )
+
+    def __contains__(self, run_key):
+        with self.lock:
+            return bool(self.connection.execute("SELECT 1 FROM transferred_runs WHERE run_key = ?", (run_key,)).fetchone())
+
+    def get(self, run_key):
+        with self.lock:
+            row = self.connection.execute(
+                f"SELECT {', '.join(self.columns)} FROM transferred_runs WHERE run_key = ?", (run_key,)
+            ).fetchone()
+        return self._to_dict(row) if row else None
+
+    def _to_dict(self, row):
+        transferred_run = dict(zip(self.columns, row))
+        transferred_run["metrics"] = json.loads(transferred_run["metrics"]) if transferred_run["metrics"] else None
+        return transferred_run
+
+    def set_state(
+        self, run, name, state, started=None, finished=None, transferred_bytes=None, duration=None, metrics=None
+    ):
+        with self.lock, self.connection:
+            self.connection.execute(
+                f"INSERT OR REPLACE INTO transferred_runs ({', '.join(self.columns)}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    f"{run}_{name}",
+                    run,
+                    name,
+                    state,
+                    started,
+                    finished,
+                    transferred_bytes,
+                    duration,
+                    json.dumps(metrics) if metrics else None,
+                ),
+            )
+
+    def list(self, state=None):
+        query = f"SELECT {', '.join(self.columns)} FROM transferred_runs"
+        params = ()
+        if state:
+            query += " WHERE state = ?"
+            params = (state,)
+        with self.lock:
+            rows = self.connection.execute(f"{query} ORDER BY finished, run_key", params).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def get_throughput(self, name, runs=20):
+        # Bytes per second of the last transferred runs of a transfer, None without history.
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT bytes, duration FROM transferred_runs WHERE name = ? AND bytes > 0 AND duration > 0 "
+                "ORDER BY finished DESC LIMIT ?",
+                (name, runs),
+            ).fetchall()
+        if not rows:
+            return None
+        return sum(transferred_bytes for transferred_bytes, duration in rows) / sum(duration for _, duration in rows)
+
+    def update_state(self, run_key, state, finished=None):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE transferred_runs SET state = ?, finished = COALESCE(?, finished) WHERE run_key = ?",
+                (state, finished, run_key),
+            )
+
+    def reset(self, run_key):
+        # Remove run from the store, the run will be transferred again in the next cycle.
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM post_transfer_jobs WHERE run_key = ?", (run_key,))
+            return self.connection.execute("DELETE FROM transferred_runs WHERE run_key = ?", (run_key,)).rowcount > 0
+
+    def set_alert(self, alert, interval=None):
+        # Returns False if the alert was already set, e.g. to send a single mail for the same problem.
+        # With an interval in seconds, an alert set more than interval seconds ago is set again.
+        with self.lock, self.connection:
+            if interval is not None:
+                row = self.connection.execute("SELECT value FROM metadata WHERE key = ?", (f"alert:{alert}",)).fetchone()
+                if row and (datetime.now() - datetime.strptime(row[0], "%Y-%m-%dT%H:%M:%S")).total_seconds() >= interval:
+                    self.connection.execute("DELETE FROM metadata WHERE key = ?", (f"alert:{alert}",))
+            return (
+                self.connection.execute(
+                    "INSERT OR IGNORE INTO metadata (key, value) VALUES (?, ?)",
+                    (f"alert:{alert}", datetime.now().isoformat(timespec="seconds")),
+                ).rowcount
+                > 0
+            )
+
+    def clear_alert(self, alert):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM metadata WHERE key = ?", (f"alert:{alert}",))
+
+    def get_discovery_cache(self):
+        # Remote folders not yet transferred by <remote folder>_<transfer name>:
+        # (mtime, missing required files, time of the last check).
+        with self.lock:
+            rows = self.connection.execute("SELECT folder_key, mtime, missing, checked FROM discovery_cache").fetchall()
+        return {folder_key: (mtime, json.loads(missing), checked) for folder_key, mtime, missing, checked in rows}
+
+    def update_discovery_cache(self, checked_folders, remote_folders, discovery_since):
+        # Store the checked folders, remove folders that are no longer found or transferred.
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO discovery_cache (folder_key, mtime, missing, checked) VALUES (?, ?, ?, ?)",
+                [
+                    (folder_key, mtime, json.dumps(missing), checked)
+                    for folder_key, (mtime, missing, checked) in checked_folders.items()
+                ],
+            )
+            cached_keys = {folder_key for folder_key, in self.connection.execute("SELECT folder_key FROM discovery_cache")}
+            self.connection.executemany(
+                "DELETE FROM discovery_cache WHERE folder_key = ?",
+                [(folder_key,) for folder_key in cached_keys - set(remote_folders)],
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO metadata (key, value) VALUES ('discovery_since', ?)", (str(discovery_since),)
+            )
+
+    def get_folder_sizes(self):
+        # Size of remote folders by discovery cache key, a folder is measured again when its cache entry is replaced,
+        # e.g. when the folder changed or is checked again after discovery_cache_ttl.
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT folder_key, bytes FROM discovery_cache WHERE bytes IS NOT NULL"
+            ).fetchall()
+        return dict(rows)
+
+    def set_folder_sizes(self, folder_sizes):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE discovery_cache SET bytes = ? WHERE folder_key = ?",
+                [(folder_size, folder_key) for folder_key, folder_size in folder_sizes.items()],
+            )
+
+    def get_discovery_since(self):
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM metadata WHERE key = 'discovery_since'").fetchone()
+        return int(row[0]) if row else 0
+
+    def add_job(self, run, transfer_settings, steps=None):
+        # steps: optional values known when the job is added, e.g. the mount path of the run.
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO post_transfer_jobs VALUES (?, ?, ?, 'pending', ?, ?)",
+                (
+                    f"{run}_{transfer_settings['name']}",
+                    run,
+                    json.dumps(transfer_settings),
+                    json.dumps(steps or {}),
+                    datetime.now().isoformat(),
+                ),
+            )
+
+    def claim_job(self):
+        # Oldest pending job is marked as running and returned, None if no job is pending.
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                "SELECT run_key, run, transfer, steps FROM post_transfer_jobs "
+                "WHERE status = 'pending' ORDER BY created LIMIT 1"
+            ).fetchone()
+            if not row:
+                return None
+            self.connection.execute("UPDATE post_transfer_jobs SET status = 'running' WHERE run_key = ?", (row[0],))
+        return {"run_key": row[0], "run": row[1], "transfer_settings": json.loads(row[2]), "steps": json.loads(row[3])}
+
+    def update_job(self, run_key, status, steps):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE post_transfer_jobs SET status = ?, steps = ? WHERE run_key = ?", (status, json.dumps(steps), run_key)
+            )
+
+    def finish_job(self, run_key):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM post_transfer_jobs WHERE run_key = ?", (run_key,))
+
+    def retry_job(self, run_key):
+        # Failed job is started again by the post transfer workers, finished steps are not repeated.
+        with self.lock, self.connection:
+            return (
+                self.connection.execute(
+                    "UPDATE post_transfer_jobs SET status = 'pending' WHERE run_key = ? AND status = 'failed'", (run_key,)
+                ).rowcount
+                > 0
+            )
+
+    def resume_jobs(self):
+        # Jobs interrupted by a stopped transfer process are started again, finished steps are not repeated.
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE post_transfer_jobs SET status = 'pending' WHERE status = 'running'")
+
+    def list_jobs(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT run_key, status, steps FROM post_transfer_jobs ORDER BY created").fetchall()
+        return [{"run_key": row[0], "status": row[1], "steps": json.loads(row[2])} for row in rows]
+
+    def close(self):
+        self.connection.close()
+
+
+class PostTransferWorkers:
+    """
+    Worker threads draining the post transfer job queue, VCF uploads and the transfer state email of a run.
+
+    Jobs are stored in the state store, jobs interrupted by a stopped transfer process are resumed on start.
+    """
+
+    def __init__(self, transferred_runs, workers):
+        self.transferred_runs = transferred_runs
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.transferred_runs.resume_jobs()
+        self.threads = [threading.Thread(target=self._work, daemon=True) for worker in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, run, transfer_settings, steps=None):
+        self.transferred_runs.add_job(run, transfer_settings, steps)
+        with self.condition:
+            self.condition.notify()
+
+    def _work(self):
+        while True:
+            job = self.transferred_runs.claim_job()
+            if job:
+                run_post_transfer_job(self.transferred_runs, job)
+                continue
+            with self.condition:
+                if self.stopping:
+                    return
+                self.condition.wait(timeout=10)
+
+    def close(self):
+        # Wait until all pending jobs are finished.
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+
+def get_run_folder(run, transfer_settings, steps):
+    run_folder = "{output}/{run}".format(output=transfer_settings["output"], run=run)
+    # Jobs queued before the mount path was stored use the run folder relative to the working directory.
+    if "mount_path" not in steps:
+        return run_folder
+    return f"{steps['mount_path']}/{run_folder}"
+
+
+def run_post_transfer_job(transferred_runs, job):
+    run = job["run"]
+    transfer_settings = job["transfer_settings"]
+    steps = job["steps"]
+    run_folder = get_run_folder(run, transfer_settings, steps)
+    try:
+        # Each finished step is stored, to resume an interrupted job without repeating uploads or email.
+        if transfer_settings.get("verify") and "verify" not in steps:
+            step_started = time.monotonic()
+            steps["verify"] = verify_run(run, transfer_settings, run_folder)
+            transferred_runs.update_job(job["run_key"], "running", steps)
+            event_log.emit(
+                "verify",
+                run=run,
+                transfer=transfer_settings["name"],
+                result=steps["verify"][0],
+                duration_seconds=round(time.monotonic() - step_started, 3),
+            )
+        verify_state, verify_result = steps.get("verify", ("ok", None))
+
+        for step, upload_vcf in [("upload_gatk_vcf", upload_gatk_vcf), ("upload_exomedepth_vcf", upload_exomedepth_vcf)]:
+            # VCF files are not uploaded from a run that does not match its checksums.
+            if transfer_settings[step] and step not in steps and verify_state == "ok":
+                step_started = time.monotonic()
+                steps[step] = upload_vcf(run=run, run_folder=run_folder)
+                transferred_runs.update_job(job["run_key"], "running", steps)
+                event_log.emit(
+                    step,
+                    run=run,
+                    transfer=transfer_settings["name"],
+                    result=steps[step][0],
+                    duration_seconds=round(time.monotonic() - step_started, 3),
+                )
+
+        upload_state_gatk, upload_result_gatk = steps.get("upload_gatk_vcf", ("ok", None))
+        upload_state_exomedepth, upload_result_exomedepth = steps.get("upload_exomedepth_vcf", ("ok", None))
+        email_state = "ok"
+        if upload_state_gatk != "ok":
+            # Warning or error
+            email_state = f"vcf_upload_{upload_state_gatk}"
+        # To avoid email_state 'vcf_upload_error' to become a 'vcf_upload_warning'
+        if upload_state_exomedepth != "ok" and email_state != "vcf_upload_error":
+            email_state = f"vcf_upload_{upload_state_exomedepth}"
+        if verify_state != "ok":
+            email_state = "verify_error"
+
+        if "email" not in steps:
+            transferred_run = transferred_runs.get(job["run_key"])
+            send_mail_transfer_state(
+                filename="{}{}".format(transfer_settings["input"], run),
+                state=email_state,
+                upload_result_gatk=upload_result_gatk,
+                upload_result_exomedepth=upload_result_exomedepth,
+                metrics=transferred_run["metrics"] if transferred_run else None,
+                verify_result=verify_result,
+            )
+            steps["email"] = email_state
+            transferred_runs.update_job(job["run_key"], "running", steps)
+    except Exception:
+        # Keep the job, it is listed with 'state jobs' and started again with 'state retry', the run is not transferred again.
+        print(f"Post transfer job {job['run_key']} failed:\n{traceback.format_exc()}", file=sys.stderr)
+        transferred_runs.update_job(job["run_key"], "failed", steps)
+        event_log.emit("post_transfer", run=run, transfer=transfer_settings["name"], result="failed")
     else:
-        if not Path(mount_path).exists():
-            is_available = False
+        event_log.emit("post_transfer", run=run, transfer=transfer_settings["name"], result=email_state)
+        transferred_runs.update_state(job["run_key"], email_state, finished=datetime.now().isoformat(timespec="seconds"))
+        transferred_runs.finish_job(job["run_key"])
 
-    return is_available
+
+def split_run_key(run_key):
+    # Transfer names can contain underscores, use the longest configured name that matches.
+    names = [
+        transfer["name"]
+        for mount_name in settings.transfer_settings
+        for transfer in settings.transfer_settings[mount_name]["transfers"]
+    ]
+    for name in sorted(names, key=len, reverse=True):
+        if run_key.endswith(f"_{name}"):
+            return run_key[: -len(name) - 1], name
+    return run_key, None
 
 
 def get_transferred_runs(wkdir):
-    transferred_runs = Path(f"{wkdir}/transferred_runs.txt")
-    if transferred_runs.is_file():
-        with open(transferred_runs, "r") as runs:
-            transferred_set = set()
-            for transferred_run_state in set(runs.read().splitlines()):
-                # Remove state
-                transferred_set.add(transferred_run_state.split("\t")[0])
-        return transferred_set
-    else:
-        Path.touch(transferred_runs)
-        return {}
+    # Open the state store once per wkdir, it is shared by all cycles in daemon mode.
+    wkdir = str(wkdir)
+    if wkdir not in transferred_runs_stores:
+        transferred_runs_stores[wkdir] = TransferredRuns(wkdir)
+    return transferred_runs_stores[wkdir]
+
+
+def get_ssh_options(host_keys=None, control_master="auto"):
+    # Shared OpenSSH ControlMaster connection, reused by discovery and all rsync processes to the same server.
+    # ssh uses the first value of an option, the master connection is started with control_master "yes".
+    ssh_options = [
+        "-o",
+        "BatchMode=yes",
+        "-o",
+        f"ControlMaster={control_master}",
+        "-o",
+        f"ControlPath={settings.ssh_control_path}",
+        "-o",
+        f"ControlPersist={settings.ssh_control_persist}",
+        "-o",
+        f"ConnectTimeout={settings.ssh_connect_timeout}",
+    ]
+    if host_keys:
+        ssh_options.extend(["-o", f"UserKnownHostsFile={host_keys}"])
+    return ssh_options
+
+
+class ControlMasterClient:
+    """
+    Minimal paramiko SSHClient replacement running commands over a multiplexed OpenSSH ControlMaster connection.
+
+    The master connection is shared with the rsync processes and kept for settings.ssh_control_persist seconds,
+    so the next cycle reuses it as well.
+    """
+
+    def __init__(self):
+        self.host_keys = None
+        self.destination = None
+
+    def load_host_keys(self, host_keys):
+        self.host_keys = host_keys
+
+    def load_system_host_keys(self):
+        # System known_hosts files are used by ssh by default.
+        pass
+
+    def _ssh(self, *args, timeout=None, control_master="auto", stderr=subprocess.PIPE):
+        return subprocess.run(
+            ["ssh", *get_ssh_options(self.host_keys, control_master), *args],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=stderr,
+            timeout=timeout,
+        )
+
+    def connect(self, hostname, username):
+        self.destination = f"{username}@{hostname}"
+        if not self.is_active():
+            self._start_master()
+
+    def _start_master(self):
+        # The master keeps running in the background (-f) with the stderr of ssh, a pipe would not be closed until it stops.
+        # stderr is written to a temporary file instead, errors are read from it when the master could not be started.
+        with tempfile.TemporaryFile() as master_stderr:
+            try:
+                master = self._ssh(
+                    "-f",
+                    "-N",
+                    self.destination,
+                    timeout=settings.ssh_connect_timeout * 2,
+                    control_master="yes",
+                    stderr=master_stderr,
+                )
+            except subprocess.TimeoutExpired:
+                raise timeout(f"Timeout connecting to {self.destination}")
+            master_stderr.seek(0)
+            stderr = master_stderr.read().decode("utf8", errors="replace")
+        if master.returncode:
+            if "Permission denied" in stderr or "Host key verification failed" in stderr:
+                import paramiko
+
+                raise paramiko.ssh_exception.AuthenticationException(stderr)
+            raise OSError(stderr)
+
+    def is_active(self):
+        # Health check of the master connection.
+        return bool(self.destination) and not self._ssh("-O", "check", self.destination).returncode
+
+    def get_transport(self):
+        return self
+
+    def exec_command(self, command, timeout=None):
+        # timeout in seconds as paramiko, ssh_command_timeout by default.
+        command_timeout = timeout or settings.ssh_command_timeout
+        try:
+            result = self._ssh(self.destination, command, timeout=command_timeout)
+            if result.returncode == 255 and not self.is_active():
+                # Transfer node dropped the connection, reconnect once.
+                self._start_master()
+                result = self._ssh(self.destination, command, timeout=command_timeout)
+        except (subprocess.TimeoutExpired, OSError):
+            raise TimeoutError(f"Command on {self.destination} failed: {command}")
+        if result.returncode == 255:
+            raise ConnectionResetError(result.stderr.decode("utf8"))
+        return None, BytesIO(result.stdout), BytesIO(result.stderr)
+
+    def close(self):
+        # Master connection is kept for ControlPersist seconds, to be reused by the next cycle.
+        pass
+
+
+def get_ssh_client():
+    if settings.ssh_control_path:
+        return ControlMasterClient()
+    # paramiko is only imported when it is used, e.g. not when a cycle stops early because a transfer is still running.
+    import paramiko
+
+    return paramiko.SSHClient()
+
+
+def get_ssh_address(server):
+    # Host name and port ssh connects to, e.g. a Host alias or another Port in ~/.ssh/config, as printed by ssh -G.
+    try:
+        ssh_config = subprocess.run(
+            ["ssh", "-G", server],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            encoding="UTF-8",
+            timeout=settings.ssh_connect_timeout,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return server, 22
+    ssh_options = dict(line.split(" ", 1) for line in ssh_config.stdout.splitlines() if " " in line)
+    port = ssh_options.get("port", "22")
+    return ssh_options.get("hostname", server), int(port) if port.isdigit() else 22
+
+
+def get_server_latency(server):
+    # TCP connect time to the ssh port in seconds, None if the server is not reachable.
+    address = get_ssh_address(server)
+    start = time.monotonic()
+    try:
+        create_connection(address, timeout=settings.ssh_connect_timeout).close()
+    except OSError:
+        return None
+    return time.monotonic() - start
+
 
+def get_server_load(server, user, host_keys):
+    # 1 minute load average per cpu, None if the server can not be probed.
+    import paramiko
 
-def connect_to_remote_server(host_keys, servers, user, run_file):
-    client = SSHClient()
+    client = ControlMasterClient()
+    client.load_host_keys(host_keys)
+    try:
+        client.connect(server, username=user)
+        stdin, stdout, stderr = client.exec_command("echo $(cut -d ' ' -f 1 /proc/loadavg) $(nproc)")
+        load, cpus = stdout.read().decode("utf8").split()
+        return float(load) / int(cpus)
+    except (OSError, ValueError, paramiko.ssh_exception.SSHException):
+        return None
+
+
+def get_server_score(server, user, host_keys):
+    latency = get_server_latency(server)
+    if latency is None:
+        return None
+    score = latency
+    # Load can only be probed over the multiplexed connection, the master is reused by rsync afterwards.
+    if settings.server_load_probe and settings.ssh_control_path:
+        load = get_server_load(server, user, host_keys)
+        if load is None:
+            return None
+        score += load * settings.server_load_weight
+    return score
+
+
+def rank_remote_servers(servers, user, host_keys):
+    # Reachable servers ordered by connect latency and load, probed in parallel.
+    with ThreadPoolExecutor(max_workers=len(servers)) as executor:
+        scores = dict(zip(servers, executor.map(lambda server: get_server_score(server, user, host_keys), servers)))
+    return sorted([server for server in servers if scores[server] is not None], key=lambda server: scores[server])
+
+
+class ServerPool:
+    """
+    Spread rsync processes over the transfer nodes, the node with the fewest running rsync processes is used first.
+
+    Nodes are ordered by preference, a node that lost its connection is not used again by this pool.
+    """
+
+    def __init__(self, servers):
+        self.servers = list(servers)
+        self.running = Counter()
+        self.failed = set()
+        self.lock = threading.Lock()
+
+    def acquire(self, exclude=(), include_failed=False):
+        # Without include_failed None is returned when all nodes failed, e.g. a single node that lost its connection.
+        # Starting a transfer uses include_failed, rsync is never started without a node.
+        with self.lock:
+            candidates = [server for server in self.servers if server not in self.failed and server not in exclude]
+            if not candidates and include_failed:
+                # Try failed nodes again, e.g. when a transfer is retried after backing off.
+                candidates = [server for server in self.servers if server not in exclude]
+            if not candidates:
+                return None
+            # min returns the first, preferred, server if the number of running rsync processes is equal.
+            server = min(candidates, key=lambda server: self.running[server])
+            self.running[server] += 1
+            return server
+
+    def release(self, server, failed=False):
+        with self.lock:
+            self.running[server] -= 1
+            if failed:
+                self.failed.add(server)
+
+
+def connect_to_best_server(run_file, block_on_lost=True):
+    # Connect to the best ranked server, returns client and all healthy servers with the connected server first.
+    ranked_servers = rank_remote_servers(settings.server, settings.user, settings.host_keys)
+    client, hpc_server = connect_to_remote_server(
+        settings.host_keys, ranked_servers or settings.server, settings.user, run_file, block_on_lost
+    )
+    return client, [hpc_server] + [server for server in ranked_servers if server != hpc_server]
+
+
+def connect_to_remote_server(host_keys, servers, user, run_file, block_on_lost=True):
+    import paramiko
+
+    client = get_ssh_client()
     client.load_host_keys(host_keys)
     client.load_system_host_keys()
     for hpc_server in servers:
@@ -138,31 +1390,236 @@ def connect_to_remote_server(host_keys, servers, user, run_file):
             break
         except OSError:
             if hpc_server == servers[-1]:
-                send_mail_lost_hpc(" and ".join(servers), run_file)
+                if run_file is not None and is_alert_due("lost_hpc"):
+                    send_mail_lost_hpc(" and ".join(servers), run_file)
+                if block_on_lost:
+                    # Block upcoming cron transfers to prevent repeated mailing, the daemon keeps its lock and retries.
+                    release_run_file(run_file, remove_run_file=False)
                 sys.exit("Connection to HPC transfer nodes are lost.")
-        except (timeout, ssh_exception.SSHException, ssh_exception.AuthenticationException):
+        except (timeout, paramiko.ssh_exception.SSHException, paramiko.ssh_exception.AuthenticationException):
             if hpc_server == servers[-1]:
-                Path(run_file).unlink()
+                release_run_file(run_file, remove_run_file=True)
                 sys.exit("HPC connection timeout/SSHException/AuthenticationException")
+    if run_file is not None:
+        # Only a transfer cycle reports the connection as restored, --plan connects without a run file.
+        get_transferred_runs(settings.wkdir).clear_alert("lost_hpc")
     return client, hpc_server
 
 
-def get_folders_remote_server(client, transfers, run_file, transferred_set):
-    to_be_transferred = {}
-    for transfer in transfers:
-        try:
-            stdin, stdout, stderr = client.exec_command("ls {}".format(transfer["input"]))
-        except (ConnectionResetError, TimeoutError):
-            Path(run_file).unlink()
-            sys.exit("HPC connection ConnectionResetError/TimeoutError")
+def get_check_files_cmd(input_dir, required_files):
+    # Print the required files present in folder "$folder" of input_dir, tab separated.
+    if not required_files:
+        return ""
+    return (
+        f'for check_file in {required_files}; do '
+        f'[ -f {input_dir}/"$folder"/"$check_file" ] && printf "\\t%s" "$check_file"; done; '
+    )
+
 
-        input_folders = stdout.read().decode("utf8").split()
-        for input_folder in input_folders:
-            combined = f"{input_folder}_{transfer['name']}"
-            if combined not in transferred_set:
-                to_be_transferred[input_folder] = transfer
+def get_discovery_cmd(transfers, since=0):
+    # Single remote command printing the remote time and one line per folder, tab separated:
+    # <transfer index> <folder> <mtime> [+ <present required files>].
+    # Required files are only checked (+) for folders changed since `since`, a new required file changes the folder mtime.
+    discovery_cmd = ['printf "time\\t%s\\n" "$(date +%s)"']
+    for index, transfer in enumerate(transfers):
+        input_dir = shlex.quote(transfer["input"])
+        required_files = " ".join(shlex.quote(check_file) for check_file in transfer["files_required"] if check_file)
+        discovery_cmd.append(
+            f"find -L {input_dir} -mindepth 1 -maxdepth 1 -printf '%T@ %f\\n' 2>/dev/null | while read -r mtime folder; do "
+            f'mtime=${{mtime%.*}}; printf "%s\\t%s\\t%s" {index} "$folder" "$mtime"; '
+            f'if [ "$mtime" -ge {int(since)} ]; then printf "\\t+"; {get_check_files_cmd(input_dir, required_files)}fi; '
+            f'printf "\\n"; done'
+        )
+    return "; ".join(discovery_cmd)
 
-    return to_be_transferred
+
+def get_check_folders_cmd(transfers, folders):
+    # Check required files of folders not found in the discovery cache, output as get_discovery_cmd.
+    check_cmd = []
+    for index, folder, mtime in folders:
+        input_dir = shlex.quote(transfers[index]["input"])
+        required_files = " ".join(
+            shlex.quote(check_file) for check_file in transfers[index]["files_required"] if check_file
+        )
+        check_cmd.append(
+            f"folder={shlex.quote(folder)}; "
+            f'printf "%s\\t%s\\t%s\\t+" {index} "$folder" {int(mtime)}; {get_check_files_cmd(input_dir, required_files)}'
+            f'printf "\\n"'
+        )
+    return "; ".join(check_cmd)
+
+
+def get_checked_folder(transfer, mtime, present):
+    # Discovery cache entry: (mtime, missing required files, time of the check).
+    missing = [check_file for check_file in transfer["files_required"] if check_file and check_file not in present]
+    return int(mtime), missing, time.time()
+
+
+def run_discovery_cmd(client, discovery_cmd, run_file):
+    try:
+        stdin, stdout, stderr = client.exec_command(discovery_cmd)
+        return stdout.read().decode("utf8")
+    except (ConnectionResetError, TimeoutError):
+        release_run_file(run_file, remove_run_file=True)
+        sys.exit("HPC connection ConnectionResetError/TimeoutError")
+
+
+def parse_discovery_out(discovery_out, transfers, transferred_set, discovery_cache):
+    """
+    Folders found by the discovery command that are not yet transferred.
+
+    Returns the remote time, the found folders (mount, folder, transfer, cache key), the checked or unchanged folders
+    (mtime, missing files, checked) per cache key and the folders to be checked (transfer index, folder, mtime).
+    """
+    remote_time = None
+    found_folders = []
+    remote_folders = {}
+    uncached_folders = []
+    for line in discovery_out.splitlines():
+        if line.startswith("time\t"):
+            remote_time = int(line.split("\t")[1])
+            continue
+        if not line:
+            continue
+        index, input_folder, mtime, *checked = line.split("\t")
+        mount_name, transfer = transfers[int(index)]
+        if f"{input_folder}_{transfer['name']}" in transferred_set:
+            continue
+        cache_key = f"{transfer['input']}/{input_folder}_{transfer['name']}"
+        found_folders.append((mount_name, input_folder, transfer, cache_key))
+        cached = discovery_cache.get(cache_key)
+        if checked:
+            remote_folders[cache_key] = get_checked_folder(transfer, mtime, checked[1:])
+        elif cached and cached[0] == int(mtime) and time.time() - cached[2] < settings.discovery_cache_ttl:
+            # Folder did not change since the last check.
+            remote_folders[cache_key] = cached
+        else:
+            uncached_folders.append((int(index), input_folder, int(mtime)))
+    return remote_time, found_folders, remote_folders, uncached_folders
+
+
+def check_uncached_folders(client, transfers, uncached_folders, run_file):
+    # Check folders missing from the cache, e.g. moved into the input folder, in a single remote call.
+    if not uncached_folders:
+        return {}
+    check_out = run_discovery_cmd(
+        client, get_check_folders_cmd([transfer for mount_name, transfer in transfers], uncached_folders), run_file
+    )
+    remote_folders = {}
+    for line in check_out.splitlines():
+        index, input_folder, mtime, *checked = line.split("\t")
+        transfer = transfers[int(index)][1]
+        remote_folders[f"{transfer['input']}/{input_folder}_{transfer['name']}"] = get_checked_folder(
+            transfer, mtime, checked[1:]
+        )
+    return remote_folders
+
+
+def get_folders_remote_server(client, mounts, run_file, transferred_set, update_cache=True):
+    # Folders to be transferred per mount point, discovered for all mount points in a single remote call.
+    # The discovery cache is not updated with update_cache False, e.g. by --plan.
+    to_be_transferred = {mount_name: {} for mount_name in mounts}
+    # Missing required files per remote folder, as checked in the same remote call or found in the discovery cache.
+    missing_files = {}
+    transfers = [(mount_name, transfer) for mount_name in mounts for transfer in mounts[mount_name]["transfers"]]
+    discovery_store = get_transferred_runs(settings.wkdir)
+    discovery_cache = discovery_store.get_discovery_cache()
+    discovery_started = time.monotonic()
+    discovery_out = run_discovery_cmd(
+        client,
+        get_discovery_cmd([transfer for mount_name, transfer in transfers], discovery_store.get_discovery_since()),
+        run_file,
+    )
+    metrics.observe("rsync_to_rdisc_discovery_duration_seconds", time.monotonic() - discovery_started)
+
+    remote_time, found_folders, remote_folders, uncached_folders = parse_discovery_out(
+        discovery_out, transfers, transferred_set, discovery_cache
+    )
+    remote_folders.update(check_uncached_folders(client, transfers, uncached_folders, run_file))
+
+    for mount_name, input_folder, transfer, cache_key in found_folders:
+        if cache_key in remote_folders:
+            to_be_transferred[mount_name][input_folder] = transfer
+            missing_files[f"{transfer['input']}/{input_folder}"] = remote_folders[cache_key][1]
+
+    if remote_time is not None and update_cache:
+        # Keep a margin for folders changed while the previous discovery was running.
+        discovery_store.update_discovery_cache(
+            {
+                cache_key: remote_folders[cache_key]
+                for cache_key in remote_folders
+                if remote_folders[cache_key] != discovery_cache.get(cache_key)
+            },
+            remote_folders,
+            remote_time - settings.discovery_mtime_margin,
+        )
+
+    event_log.emit(
+        "discovery",
+        duration_seconds=round(time.monotonic() - discovery_started, 3),
+        runs=sum(len(to_be_transferred[mount_name]) for mount_name in to_be_transferred),
+    )
+    return to_be_transferred, missing_files
+
+
+def get_remote_folder_sizes(client, remote_folders, run_file):
+    # Size in bytes per remote folder, following symlinks as rsync -L does, measured with a single remote du.
+    # Sizes are unknown when du fails or times out, the runs are transferred without a free space check.
+    if not remote_folders:
+        return {}
+    du_cmd = f"du -sbL -- {' '.join(shlex.quote(remote_folder) for remote_folder in remote_folders)} 2>/dev/null"
+    try:
+        stdin, stdout, stderr = client.exec_command(du_cmd)
+        du_out = stdout.read().decode("utf8")
+    except OSError as error:
+        print(f"Size of remote folders unknown: {error}", file=sys.stderr)
+        return {}
+
+    folder_sizes = {}
+    for line in du_out.splitlines():
+        folder_size, separator, remote_folder = line.partition("\t")
+        if separator and folder_size.isdigit():
+            folder_sizes[remote_folder] = int(folder_size)
+    return folder_sizes
+
+
+def is_filtered(transfer_settings):
+    return bool(transfer_settings.get("include") or transfer_settings.get("exclude"))
+
+
+def get_run_size(folder_sizes, run, transfer_settings):
+    # du measures the whole folder, the size of a transfer with include or exclude patterns is unknown.
+    if is_filtered(transfer_settings):
+        return None
+    return folder_sizes.get(f"{transfer_settings['input']}/{run}")
+
+
+def get_folder_sizes(client, to_be_transferred, missing_files, run_file, update_cache=True):
+    # Size of the folders with all required files, from the discovery cache or measured in a single remote call.
+    cache_keys = {
+        f"{transfer['input']}/{run}": f"{transfer['input']}/{run}_{transfer['name']}"
+        for mount_name in to_be_transferred
+        for run, transfer in to_be_transferred[mount_name].items()
+        if not missing_files.get(f"{transfer['input']}/{run}") and not is_filtered(transfer)
+    }
+    discovery_store = get_transferred_runs(settings.wkdir)
+    cached_sizes = discovery_store.get_folder_sizes()
+    folder_sizes = {
+        input_folder: cached_sizes[cache_key] for input_folder, cache_key in cache_keys.items() if cache_key in cached_sizes
+    }
+    measured_sizes = get_remote_folder_sizes(
+        client, [input_folder for input_folder in cache_keys if input_folder not in folder_sizes], run_file
+    )
+    if update_cache:
+        discovery_store.set_folder_sizes({cache_keys[input_folder]: size for input_folder, size in measured_sizes.items()})
+    folder_sizes.update(measured_sizes)
+    return folder_sizes
+
+
+def get_free_bytes(mount_path):
+    # Free space on the mount, keeping mount_reserved_fraction of the mount free.
+    disk_usage = shutil.disk_usage(mount_path)
+    return disk_usage.free - disk_usage.total * settings.mount_reserved_fraction
 
 
 def check_if_file_missing(required_files, input_folder, client):
@@ -198,106 +1655,454 @@ def action_if_file_missing(transfer_settings, rsync_succes, missing, run, run_fi
         return False
 
 
-def rsync_server_remote(hpc_server, client, to_be_transferred, mount_path, run_file):
-    # TODO: refactor this massive function into more bitesize functions.
-    date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    rsync_succes = True
+def get_server_pool(hpc_server):
+    # hpc_server is a single server, a list of healthy servers ordered by preference or a ServerPool shared by mounts.
+    if isinstance(hpc_server, ServerPool):
+        return hpc_server
+    return ServerPool([hpc_server] if isinstance(hpc_server, str) else hpc_server)
 
-    for run in to_be_transferred:
-        with open(settings.log_path, "a", newline="\n") as log_file:
-            log_file_writer = writer(log_file, delimiter="\t")
-            log_file_writer.writerows([["#########"], [f"Date: {date}"], [f"Run_folder: {run}"]])
 
+def get_missing_files(client, run, transfer_settings, missing_files):
+    input_folder = f"{transfer_settings['input']}/{run}"
+    if missing_files is not None and input_folder in missing_files:
+        # Required files are already checked during remote discovery.
+        return missing_files[input_folder]
+    return check_if_file_missing(transfer_settings["files_required"], input_folder, client)
+
+
+def get_available_bytes(mount_path, scheduler):
+    # Free space on the mount minus the size of runs waiting or running since a previous cycle, e.g. in daemon mode.
+    # Sizes are an upper limit, the part of a running transfer already written to the mount is counted twice.
+    with in_flight_sizes_lock:
+        for run_key in [run_key for run_key in in_flight_sizes if not scheduler.is_active(run_key)]:
+            del in_flight_sizes[run_key]
+        in_flight_bytes = sum(
+            run_size for run_mount_path, run_size in in_flight_sizes.values() if run_mount_path == str(mount_path)
+        )
+    return get_free_bytes(mount_path) - in_flight_bytes
+
+
+def fits_on_mount(run, transfer_settings, mount_path, run_size, free_bytes):
+    # Runs of unknown size are transferred, sizes are an upper limit as files already present are not transferred again.
+    if free_bytes is None or run_size is None or run_size <= free_bytes:
+        return True
+    # Don't start a transfer that fills up the mount, the run is transferred in a next cycle.
+    log_writer.writerows(settings.log_path, [[run, f">>> Not enough space on {mount_path}, not transferred <<<"]])
+    event_log.emit(
+        "size_check",
+        run=run,
+        transfer=transfer_settings["name"],
+        mount=mount_path,
+        result="not_enough_space",
+        bytes=run_size,
+        free_bytes=free_bytes,
+    )
+    return False
+
+
+def submit_transfer(
+    scheduler, server_pool, run, transfer_settings, mount_path, date, post_transfer_workers, mount_max_parallel, run_size
+):
+    scheduler.submit(
+        transfer_run,
+        server_pool,
+        run,
+        transfer_settings,
+        mount_path,
+        date,
+        post_transfer_workers,
+        limits=get_transfer_limits(mount_path, mount_max_parallel, transfer_settings),
+        priority=get_run_priority(run, transfer_settings),
+        key=f"{run}_{transfer_settings['name']}",
+    )
+    if run_size:
+        # Counted as used space of the mount until the transfer is finished, see get_available_bytes.
+        with in_flight_sizes_lock:
+            in_flight_sizes[f"{run}_{transfer_settings['name']}"] = (str(mount_path), run_size)
+
+
+def report_skipped_runs(mount_path, skipped_runs, free_bytes):
+    if not skipped_runs:
+        get_transferred_runs(settings.wkdir).clear_alert(f"mount_full:{mount_path}")
+    elif is_alert_due(f"mount_full:{mount_path}"):
+        send_mail_mount_full(mount_path, skipped_runs, free_bytes)
+
+
+def rsync_server_remote(
+    hpc_server,
+    client,
+    to_be_transferred,
+    mount_path,
+    run_file,
+    missing_files=None,
+    mount_max_parallel=None,
+    post_transfer_workers=None,
+    folder_sizes=None,
+    scheduler=None,
+):
+    date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    rsync_succes = True
+    # In daemon mode a single scheduler is shared by all cycles, transfers are not waited for.
+    join_scheduler = scheduler is None
+    if join_scheduler:
+        scheduler = TransferScheduler(settings.rsync_max_workers)
+    server_pool = get_server_pool(hpc_server)
+    close_post_transfer_workers = post_transfer_workers is None and join_scheduler
+    if post_transfer_workers is None:
+        post_transfer_workers = PostTransferWorkers(get_transferred_runs(settings.wkdir), settings.post_transfer_workers)
+
+    folder_sizes = folder_sizes or {}
+    runs = get_transfer_order(to_be_transferred, folder_sizes)
+    free_bytes = get_available_bytes(mount_path, scheduler) if folder_sizes else None
+    skipped_runs = []
+
+    for run in runs:
         transfer_settings = to_be_transferred[run]
+        if scheduler.is_active(f"{run}_{transfer_settings['name']}"):
+            # Still waiting or running since a previous cycle.
+            continue
         # Settings per folder data type, such as remote input dir and local output dir, etc.
-        missing = check_if_file_missing(transfer_settings["files_required"], f"{transfer_settings['input']}/{run}", client)
-
+        missing = get_missing_files(client, run, transfer_settings, missing_files)
         if missing:
+            write_log_header(date, run)
+            event_log.emit(
+                "required_files", run=run, transfer=transfer_settings["name"], result="missing", missing=missing
+            )
             print(transfer_settings, rsync_succes, missing, run, run_file)
             rsync_succes = action_if_file_missing(transfer_settings, rsync_succes, missing, run, run_file)
             # Don't transfer the run if a required file is missing.
             continue
 
-        # Get include and exclude patterns as list to easily access key-value pair in unit test.
-        if transfer_settings.get("include", None):
-            include_patterns = [f"--include={pattern}" for pattern in transfer_settings["include"]]
-        else:
-            include_patterns = []
-        if transfer_settings.get("exclude", None):
-            exclude_patterns = [f"--exclude={pattern}" for pattern in transfer_settings["exclude"]]
-        else:
-            exclude_patterns = []
-
-        source_destination = f"{settings.user}@{hpc_server}:{transfer_settings['input']}/{run}"
-        target_path = f"{mount_path}/{transfer_settings['output']}"
-
-        rsync_cmd = [
-            "rsync",
-            "-rahuL",
-            "--stats",
-            "--prune-empty-dirs",
-            *include_patterns,
-            *exclude_patterns,
-            source_destination,
-            target_path,
-        ]
-        subprocess_result = subprocess.run(rsync_cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE, encoding="UTF-8")
+        run_size = get_run_size(folder_sizes, run, transfer_settings)
+        if not fits_on_mount(run, transfer_settings, mount_path, run_size, free_bytes):
+            skipped_runs.append((run, run_size))
+            continue
+        if free_bytes is not None:
+            free_bytes -= run_size or 0
+
+        submit_transfer(
+            scheduler,
+            server_pool,
+            run,
+            transfer_settings,
+            mount_path,
+            date,
+            post_transfer_workers,
+            mount_max_parallel,
+            run_size,
+        )
 
-        with open(settings.log_path, "a", newline="\n") as log_file:
-            log_file.writelines(subprocess_result.stdout)
+    report_skipped_runs(mount_path, skipped_runs, free_bytes)
 
-        # Write stderr to two files
-        with open(settings.errorlog_path, "a", newline="\n") as stderr_log:
-            stderr_log.writelines(subprocess_result.stderr)
+    if join_scheduler:
+        # Wait for all transfers of this mount to finish.
+        try:
+            scheduler.join()
+        finally:
+            if close_post_transfer_workers:
+                post_transfer_workers.close()
+    return rsync_succes
 
-        with open(settings.temp_error_path, "a", newline="\n") as tmp_stderr_file:
-            tmp_stderr_file.writelines(subprocess_result.stderr)
 
+def get_transfer_order(to_be_transferred, folder_sizes):
+    # Transfer small runs first, all runs are transferred in this cycle but quick runs are not delayed by large runs.
+    return sorted(to_be_transferred, key=lambda run: get_run_size(folder_sizes, run, to_be_transferred[run]) or 0)
 
-        # Check on return code of subprocess.run in check_rsync
-        rsync_result = check_rsync(
-            run=run,
-            input=transfer_settings.get("input"),
-            ngs_type_name=transfer_settings.get("name"),
-            subprocess_out=subprocess_result,
-        )
 
-        if rsync_result == "ok":
-            upload_result_gatk = None
-            upload_result_exomedepth = None
-            email_state = rsync_result
+def write_log_header(date, run):
+    log_writer.writerows(settings.log_path, [["#########"], [f"Date: {date}"], [f"Run_folder: {run}"]])
 
-            if transfer_settings["upload_gatk_vcf"]:
-                upload_state, upload_result_gatk = upload_gatk_vcf(
-                    run=run, run_folder="{output}/{run}".format(output=transfer_settings["output"], run=run)
-                )
-                if upload_state != "ok":
-                    # Warning or error
-                    email_state = f"vcf_upload_{upload_state}"
 
-            if transfer_settings["upload_exomedepth_vcf"]:
-                upload_state, upload_result_exomedepth = upload_exomedepth_vcf(
-                    run=run, run_folder="{output}/{run}".format(output=transfer_settings["output"], run=run)
-                )
-                # To avoid email_state 'vcf_upload_error' to become a 'vcf_upload_warning'
-                if upload_state != "ok" and email_state != "vcf_upload_error":
-                    email_state = f"vcf_upload_{upload_state}"
+def get_rsync_cmd(hpc_server, run, transfer_settings, mount_path):
+    # Get include and exclude patterns as list to easily access key-value pair in unit test.
+    if transfer_settings.get("include", None):
+        include_patterns = [f"--include={pattern}" for pattern in transfer_settings["include"]]
+    else:
+        include_patterns = []
+    if transfer_settings.get("exclude", None):
+        exclude_patterns = [f"--exclude={pattern}" for pattern in transfer_settings["exclude"]]
+    else:
+        exclude_patterns = []
 
-            send_mail_transfer_state(
-                filename="{}{}".format(transfer_settings["input"], run),
-                state=email_state,
-                upload_result_gatk=upload_result_gatk,
-                upload_result_exomedepth=upload_result_exomedepth,
-            )
-            # Do not include run in transferred_runs.txt if temp error file is not empty.
-            with open(f"{settings.wkdir}/transferred_runs.txt", "a", newline="\n") as transferred_file:
-                file_writer = writer(transferred_file, delimiter="\t")
-                file_writer.writerow([f"{run}_{transfer_settings['name']}", email_state])
+    # Use the shared ssh connection of discovery
+    if settings.ssh_control_path:
+        rsh = [f"--rsh={' '.join(shlex.quote(option) for option in ['ssh', *get_ssh_options(settings.host_keys)])}"]
+    else:
+        rsh = []
+
+    source_destination = f"{settings.user}@{hpc_server}:{transfer_settings['input']}/{run}"
+    target_path = f"{mount_path}/{transfer_settings['output']}"
+
+    # Overall progress of the transfer instead of a line per file, requires rsync >= 3.1.
+    progress = ["--info=progress2"] if settings.rsync_progress else []
+
+    # Resume a failed transfer from partially transferred files.
+    resume = [f"--timeout={settings.rsync_io_timeout}"]
+    if settings.rsync_partial_dir:
+        resume.append(f"--partial-dir={settings.rsync_partial_dir}")
+    if transfer_settings.get("append_verify", False):
+        resume.append("--append-verify")
+
+    # Bandwidth and I/O shaping, e.g. large backups during office hours.
+    bwlimit = get_bwlimit(mount_path, transfer_settings)
+    shaping = [f"--bwlimit={bwlimit}"] if bwlimit is not None else []
+    nice = transfer_settings.get("nice", settings.rsync_nice)
+    ionice = transfer_settings.get("ionice", settings.rsync_ionice)
+    priority = []
+    if nice is not None:
+        priority.extend(["nice", "-n", str(nice)])
+    if ionice == "idle":
+        priority.extend(["ionice", "-c", "3"])
+    elif ionice is not None:
+        priority.extend(["ionice", "-c", "2", "-n", str(ionice)])
+
+    return [
+        *priority,
+        "rsync",
+        "-rahuL",
+        "--stats",
+        "--prune-empty-dirs",
+        *progress,
+        *resume,
+        *shaping,
+        *rsh,
+        *include_patterns,
+        *exclude_patterns,
+        source_destination,
+        target_path,
+    ]
+
+
+def get_rsync_env():
+    # rsync is run in the C locale, numbers are printed as 1,234 or 1.23G whatever the locale of the transfer process.
+    return dict(os.environ, LC_ALL="C")
+
+
+def parse_rsync_size(size):
+    # Sizes are printed with thousands separators or, with -h, in units of 1000 with a suffix, e.g. 1,234 or 1.23G.
+    match = re.match(r"([\d.,]+)\s*([KMGTP]?)", size.strip())
+    if not match:
+        return None
+    units = {"": 1, "K": 1e3, "M": 1e6, "G": 1e9, "T": 1e12, "P": 1e15}
+    try:
+        return int(float(match.group(1).replace(",", "")) * units[match.group(2)])
+    except ValueError:
+        # Numbers grouped by another locale, e.g. 1.234.567.
+        return None
+
+
+def parse_rsync_stats(rsync_stdout, duration):
+    # Structured metrics of the rsync --stats output, missing values are None.
+    stats = {}
+    for line in rsync_stdout.splitlines():
+        if ":" in line:
+            key, value = line.split(":", 1)
+            stats[key.strip()] = value
+    # Older rsync versions print "Number of files transferred".
+    files_transferred = stats.get("Number of regular files transferred", stats.get("Number of files transferred"))
+    rsync_metrics = {
+        "files_transferred": parse_rsync_size(files_transferred) if files_transferred else None,
+        "total_size": parse_rsync_size(stats["Total file size"]) if "Total file size" in stats else None,
+        "transferred_bytes": (
+            parse_rsync_size(stats["Total transferred file size"]) if "Total transferred file size" in stats else None
+        ),
+        "literal_bytes": parse_rsync_size(stats["Literal data"]) if "Literal data" in stats else None,
+        "matched_bytes": parse_rsync_size(stats["Matched data"]) if "Matched data" in stats else None,
+        "duration": duration,
+        "mb_per_second": None,
+    }
+    if rsync_metrics["transferred_bytes"] is not None and duration:
+        rsync_metrics["mb_per_second"] = round(rsync_metrics["transferred_bytes"] / 1e6 / duration, 2)
+    return rsync_metrics
+
+
+def is_connection_error(subprocess_result):
+    return subprocess_result.returncode in RSYNC_CONNECTION_ERRORS
+
+
+def is_transient_error(subprocess_result):
+    return subprocess_result.returncode in RSYNC_TRANSIENT_ERRORS
+
+
+def get_retry_delay(transfer_settings, attempt):
+    retry_backoff = transfer_settings.get("retry_backoff", settings.rsync_retry_backoff)
+    return min(retry_backoff * 2 ** (attempt - 1), settings.rsync_retry_max_backoff)
+
+
+def parse_rsync_progress(line):
+    match = RSYNC_PROGRESS.match(line)
+    if not match:
+        return None
+    hours, minutes, seconds = (int(value) for value in match.group(4, 5, 6))
+    return {
+        "bytes": parse_rsync_size(match.group(1)),
+        "percent": int(match.group(2)),
+        "rate": match.group(3),
+        "eta_seconds": hours * 3600 + minutes * 60 + seconds,
+    }
+
+
+def stream_rsync_output(stream, run, output_path, output_tail):
+    # Write rsync output to the log file line by line, progress lines are kept in transfer_progress instead.
+    # Lines are prefixed with the run, output of parallel transfers is written to the same log file.
+    for line in stream:
+        run_progress = parse_rsync_progress(line)
+        if run_progress:
+            transfer_progress[run] = run_progress
+            metrics.set("rsync_to_rdisc_rsync_progress_bytes", run_progress["bytes"], {"run": run})
+            metrics.set("rsync_to_rdisc_rsync_progress_eta_seconds", run_progress["eta_seconds"], {"run": run})
+            continue
+        output_tail.append(line)
+        log_writer.write(output_path, [f"{run}\t{line}"])
+
+
+def run_rsync(rsync_cmd, run, stop_after=None):
+    # Only the last lines of stdout and stderr of this run are kept in memory, e.g. the --stats summary and the last errors.
+    # rsync is stopped after stop_after seconds, e.g. at the start of a bandwidth window.
+    stdout_tail = deque(maxlen=settings.rsync_output_lines)
+    stderr_tail = deque(maxlen=settings.rsync_output_lines)
+    # Text mode splits lines on \r as well, as used by the progress output.
+    process = subprocess.Popen(
+        rsync_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding="UTF-8", errors="replace", env=get_rsync_env()
+    )
+    stderr_thread = threading.Thread(
+        target=stream_rsync_output,
+        args=(process.stderr, run, settings.errorlog_path, stderr_tail),
+    )
+    stderr_thread.start()
+    stop_timer = threading.Timer(stop_after, process.terminate) if stop_after else None
+    if stop_timer:
+        stop_timer.daemon = True
+        stop_timer.start()
+    try:
+        stream_rsync_output(process.stdout, run, settings.log_path, stdout_tail)
+    finally:
+        stderr_thread.join()
+        process.wait()
+        if stop_timer:
+            stop_timer.cancel()
+        transfer_progress.pop(run, None)
+        metrics.remove("rsync_to_rdisc_rsync_progress_bytes", {"run": run})
+        metrics.remove("rsync_to_rdisc_rsync_progress_eta_seconds", {"run": run})
+    return subprocess.CompletedProcess(rsync_cmd, process.returncode, "".join(stdout_tail), "".join(stderr_tail))
+
+
+def run_shaped_rsync(hpc_server, run, transfer_settings, mount_path, date):
+    # rsync is restarted at the start and end of bandwidth windows with the bandwidth limit of the new window,
+    # the restarted rsync continues from the partially transferred files.
+    rsync_keys = [f"mount:{mount_path}", f"transfer:{transfer_settings['name']}"]
+    while True:
+        # Count this rsync process before its bandwidth limit is calculated.
+        with running_rsyncs_lock:
+            running_rsyncs.update(rsync_keys)
+        try:
+            rsync_cmd = get_rsync_cmd(hpc_server, run, transfer_settings, mount_path)
+            write_log_header(date, run)
+            stop_after = get_bwlimit_window_seconds(mount_path, transfer_settings)
+            rsync_started = time.monotonic()
+            subprocess_result = run_rsync(rsync_cmd, run, stop_after)
+        finally:
+            with running_rsyncs_lock:
+                running_rsyncs.subtract(rsync_keys)
+        if not stop_after or subprocess_result.returncode == 0 or time.monotonic() - rsync_started < stop_after:
+            return subprocess_result
+        log_writer.writerows(settings.log_path, [[run, ">>> bandwidth window changed, restart rsync <<<"]])
+
+
+def rsync_with_failover(server_pool, run, transfer_settings, mount_path, date):
+    tried_servers = []
+    hpc_server = server_pool.acquire(include_failed=True)
+    while True:
+        rsync_started = time.monotonic()
+        subprocess_result = run_shaped_rsync(hpc_server, run, transfer_settings, mount_path, date)
+        server_pool.release(hpc_server, failed=is_connection_error(subprocess_result))
+        event_log.emit(
+            "rsync",
+            run=run,
+            transfer=transfer_settings["name"],
+            server=hpc_server,
+            result=subprocess_result.returncode,
+            duration_seconds=round(time.monotonic() - rsync_started, 3),
+        )
+        tried_servers.append(hpc_server)
+
+        # Move the run to another transfer node if the connection to this node is lost.
+        next_server = server_pool.acquire(exclude=tried_servers) if is_connection_error(subprocess_result) else None
+        if not next_server:
+            return subprocess_result
+        print(f"Connection to {hpc_server} lost for {run}, continue on {next_server}", file=sys.stderr)
+        hpc_server = next_server
+
+
+def transfer_run(server_pool, run, transfer_settings, mount_path, date, post_transfer_workers):
+    started = datetime.now()
+    retry_attempts = transfer_settings.get("retry_attempts", settings.rsync_retry_attempts)
+    subprocess_result = rsync_with_failover(server_pool, run, transfer_settings, mount_path, date)
+    # Retry transient errors, the next attempt continues from the partially transferred files.
+    for attempt in range(1, retry_attempts + 1):
+        if not is_transient_error(subprocess_result):
+            break
+        retry_delay = get_retry_delay(transfer_settings, attempt)
+        retry_msg = f"retry {attempt}/{retry_attempts} in {retry_delay}s"
+        log_writer.writerows(
+            settings.log_path, [[run, f">>> rsync exit code {subprocess_result.returncode}, {retry_msg} <<<"]]
+        )
+        metrics.inc("rsync_to_rdisc_rsync_retries", labels={"transfer": transfer_settings["name"]})
+        event_log.emit(
+            "retry",
+            run=run,
+            transfer=transfer_settings["name"],
+            result=subprocess_result.returncode,
+            attempt=attempt,
+            delay_seconds=retry_delay,
+        )
+        time.sleep(retry_delay)
+        subprocess_result = rsync_with_failover(server_pool, run, transfer_settings, mount_path, date)
+    duration = (datetime.now() - started).total_seconds()
+
+    # Check on return code of subprocess.run in check_rsync
+    rsync_result = check_rsync(
+        run=run,
+        input=transfer_settings.get("input"),
+        ngs_type_name=transfer_settings.get("name"),
+        subprocess_out=subprocess_result,
+    )
 
-    return rsync_succes
+    labels = {"transfer": transfer_settings["name"]}
+    metrics.observe("rsync_to_rdisc_rsync_duration_seconds", duration, labels)
+    run_metrics = parse_rsync_stats(subprocess_result.stdout, duration) if rsync_result == "ok" else {}
+    event_log.emit(
+        "transfer",
+        run=run,
+        transfer=transfer_settings["name"],
+        mount=mount_path,
+        result=rsync_result,
+        duration_seconds=round(duration, 3),
+        bytes=run_metrics.get("transferred_bytes"),
+        files=run_metrics.get("files_transferred"),
+        mb_per_second=run_metrics.get("mb_per_second"),
+    )
+    if rsync_result == "ok":
+        metrics.inc("rsync_to_rdisc_rsync_transferred_bytes", run_metrics["transferred_bytes"] or 0, labels)
+        # Do not include run in transferred runs if rsync reported errors.
+        get_transferred_runs(settings.wkdir).set_state(
+            run,
+            transfer_settings["name"],
+            "transferred",
+            started=started.isoformat(timespec="seconds"),
+            finished=datetime.now().isoformat(timespec="seconds"),
+            transferred_bytes=run_metrics["transferred_bytes"],
+            duration=duration,
+            metrics=run_metrics,
+        )
+        # VCF uploads and email are done by the post transfer workers, the state is updated when these are finished.
+        post_transfer_workers.submit(run, transfer_settings, {"mount_path": str(mount_path)})
+    else:
+        metrics.inc("rsync_to_rdisc_rsync_failures", labels=labels)
 
 
 def run_vcf_upload(vcf_file, vcf_type, run):
+    upload_started = time.monotonic()
     upload_vcf = subprocess.run(
         (
             f"source {settings.alissa_vcf_upload}/venv/bin/activate && "
@@ -309,9 +2114,21 @@ def run_vcf_upload(vcf_file, vcf_type, run):
     )
     # Cleanup upload_vcf output: Strip and split on new line, remove empty strings from list
     upload_vcf_out = list(filter(None, upload_vcf.stdout.strip().split("\n")))
+    labels = {"vcf_type": vcf_type}
+    metrics.observe("rsync_to_rdisc_vcf_upload_duration_seconds", time.monotonic() - upload_started, labels)
+    if upload_vcf.returncode or get_upload_state(upload_vcf_out) == "error":
+        metrics.inc("rsync_to_rdisc_vcf_upload_failures", labels=labels)
     return upload_vcf_out
 
 
+def run_vcf_uploads(vcf_files, vcf_type, run):
+    # Upload vcf files concurrently, output per vcf file is returned in the order of vcf_files.
+    if not vcf_files:
+        return []
+    with ThreadPoolExecutor(max_workers=min(settings.vcf_upload_workers, len(vcf_files))) as executor:
+        return list(executor.map(lambda vcf_file: run_vcf_upload(vcf_file, vcf_type, run), vcf_files))
+
+
 def get_upload_state(upload_result):
     return_value = "ok"
     for msg in upload_result:
@@ -328,8 +2145,8 @@ def upload_gatk_vcf(run, run_folder):
     run = "_".join(run.split("_")[:4])
     upload_result = []
 
-    for vcf_file in glob.iglob("{}/single_sample_vcf/*.vcf".format(run_folder)):
-        output_vcf_upload = run_vcf_upload(vcf_file, "VCF_FILE", run)
+    vcf_files = glob.glob("{}/single_sample_vcf/*.vcf".format(run_folder))
+    for output_vcf_upload in run_vcf_uploads(vcf_files, "VCF_FILE", run):
         if output_vcf_upload:
             upload_result.extend(output_vcf_upload)
     # Possible states: error, warning or ok.
@@ -362,14 +2179,14 @@ def upload_exomedepth_vcf(run, run_folder):
 
     # Remove project from run.
     run = "_".join(run.split("_")[:4])
+    upload_samples = [sample for sample in cnv_samples if not cnv_samples[sample]]
+    upload_vcf_files = [[vcf for vcf in vcf_files if sample in vcf][0] for sample in upload_samples]  # One vcf per sample
+    output_vcf_uploads = dict(zip(upload_samples, run_vcf_uploads(upload_vcf_files, "UMCU CNV VCF v1", run)))
     for sample in cnv_samples:
         if cnv_samples[sample]:
             upload_result.append(f"{sample} not uploaded\t{cnv_samples[sample]}")
-        else:
-            vcf_file = [vcf for vcf in vcf_files if sample in vcf][0]  # One vcf per sample
-            output_vcf_upload = run_vcf_upload(vcf_file, "UMCU CNV VCF v1", run)
-            if output_vcf_upload:
-                upload_result.extend(output_vcf_upload)
+        elif output_vcf_uploads[sample]:
+            upload_result.extend(output_vcf_uploads[sample])
 
     # Possible states: error, warning or ok.
     upload_state = get_upload_state(upload_result)
@@ -377,37 +2194,597 @@ def upload_exomedepth_vcf(run, run_folder):
     return upload_state, upload_result
 
 
-if __name__ == "__main__":
-    # If daemon is running exit, else create transfer.running file and continue.
-    run_file = check_daemon_running(settings.wkdir)
-    remove_run_file = True
+def parse_md5sums(md5sum_out):
+    # md5sum output to {relative path: md5}, binary mode (*) and ./ prefixes are removed.
+    checksums = {}
+    for line in md5sum_out.splitlines():
+        if not line.strip() or line.startswith("#"):
+            continue
+        md5, file_path = line.split(None, 1)
+        file_path = file_path.lstrip("*")
+        if file_path.startswith("./"):
+            file_path = file_path[2:]
+        checksums[file_path] = md5.lower()
+    return checksums
+
+
+def get_md5(file_path, read_size):
+    # Large sequential reads, hashlib releases the GIL so files are hashed in parallel threads.
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as checked_file:
+        for block in iter(lambda: checked_file.read(read_size), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def get_run_files(run_folder):
+    # Relative paths of the files in a transferred run folder.
+    return sorted(str(path.relative_to(run_folder)) for path in Path(run_folder).rglob("*") if path.is_file())
+
+
+def get_md5sum_cmds(remote_folder, file_paths, max_length=100000):
+    # md5sum of files in remote_folder, split in remote commands of at most max_length characters.
+    md5sum_cmd = f"cd {shlex.quote(remote_folder)} && md5sum --"
+    md5sum_cmds = []
+    file_args = []
+    for file_path in file_paths:
+        file_args.append(shlex.quote(file_path))
+        if len(md5sum_cmd) + sum(len(file_arg) + 1 for file_arg in file_args) > max_length and len(file_args) > 1:
+            md5sum_cmds.append(" ".join([md5sum_cmd, *file_args[:-1]]))
+            file_args = file_args[-1:]
+    if file_args:
+        md5sum_cmds.append(" ".join([md5sum_cmd, *file_args]))
+    return md5sum_cmds
+
+
+def get_remote_checksums(run, transfer_settings, run_folder):
+    """
+    md5 of the transferred files of the run, calculated on the HPC. Returns None if no transfer node can be reached.
+
+    Only the files in the run folder are hashed, e.g. not the files excluded by the include or exclude patterns.
+    The timeout of the remote command is scaled to the size of the run by verify_remote_rate.
+    """
+    import paramiko
+
+    file_paths = get_run_files(run_folder)
+    run_size = sum(Path(f"{run_folder}/{file_path}").stat().st_size for file_path in file_paths)
+    command_timeout = settings.ssh_command_timeout + run_size / settings.verify_remote_rate
+    remote_folder = f"{transfer_settings['input']}/{run}"
+    for hpc_server in settings.server:
+        client = get_ssh_client()
+        try:
+            client.load_host_keys(settings.host_keys)
+            client.load_system_host_keys()
+            client.connect(hpc_server, username=settings.user)
+            checksums = {}
+            for md5sum_cmd in get_md5sum_cmds(remote_folder, file_paths):
+                stdin, stdout, stderr = client.exec_command(md5sum_cmd, timeout=command_timeout)
+                checksums.update(parse_md5sums(stdout.read().decode("utf8")))
+            return checksums
+        except (OSError, paramiko.ssh_exception.SSHException):
+            # Try the next transfer node.
+            continue
+        finally:
+            client.close()
+    return None
+
+
+def verify_run(run, transfer_settings, run_folder):
+    remote_checksums = None
+    if transfer_settings["verify"] == "remote":
+        # Calculated by the post transfer worker, the rsync worker of the run is already free.
+        remote_checksums = get_remote_checksums(run, transfer_settings, run_folder)
+    return verify_run_folder(run_folder, transfer_settings, remote_checksums)
+
+
+def verify_run_folder(run_folder, transfer_settings, remote_checksums=None):
+    """
+    Compare md5 checksums of the transferred files to the manifest of the run, e.g. md5sum.txt, or to remote checksums.
+
+    Returns the state, ok or error, and a list of files that are missing or differ.
+    """
+    verify_result = []
+    if transfer_settings["verify"] == "remote":
+        if remote_checksums is None:
+            return "error", ["Checksums on the HPC could not be calculated"]
+        checksums = remote_checksums
+        verify_result = [
+            f"{file_path} not found on the HPC" for file_path in get_run_files(run_folder) if file_path not in checksums
+        ]
+    else:
+        manifest = Path(f"{run_folder}/{transfer_settings.get('verify_manifest', settings.verify_manifest)}")
+        if not manifest.exists():
+            return "error", [f"{manifest.name} not found"]
+        checksums = parse_md5sums(manifest.read_text())
 
-    # Make set of transferred_runs.txt file, or create transferred_runs.txt if not present.
+    verify_result.extend(
+        f"{file_path} missing" for file_path in checksums if not Path(f"{run_folder}/{file_path}").is_file()
+    )
+    file_paths = [file_path for file_path in checksums if Path(f"{run_folder}/{file_path}").is_file()]
+    if file_paths:
+        with ThreadPoolExecutor(max_workers=min(settings.verify_workers, len(file_paths))) as executor:
+            md5s = executor.map(
+                get_md5,
+                [f"{run_folder}/{file_path}" for file_path in file_paths],
+                [settings.verify_read_size] * len(file_paths),
+            )
+            verify_result.extend(
+                f"{file_path} checksum differs" for file_path, md5 in zip(file_paths, md5s) if md5 != checksums[file_path]
+            )
+    if verify_result:
+        return "error", verify_result
+    return "ok", [f"{len(file_paths)} files verified"]
+
+
+def is_client_active(client):
+    transport = client.get_transport()
+    return transport is not None and transport.is_active()
+
+
+def transfer_mount(
+    mount_name, client, server_pool, run_file, to_be_transferred, missing_files, folder_sizes, post_transfer_workers, scheduler
+):
+    mount_path = settings.transfer_settings[mount_name]["mount_path"]
+    # Check if mount is available and continue, transfers to a lost mount are skipped until it is available again.
+    if not is_mount_available(mount_name, mount_path, run_file):
+        return True
+    # Rsync folders from HPC to mount
+    return rsync_server_remote(
+        server_pool,
+        client,
+        to_be_transferred,
+        mount_path,
+        run_file,
+        missing_files,
+        settings.transfer_settings[mount_name].get("max_parallel", None),
+        post_transfer_workers,
+        folder_sizes,
+        scheduler,
+    )
+
+
+def transfer_cycle(client, hpc_servers, run_file, post_transfer_workers=None, scheduler=None):
+    # Emails of the cycle are sent over a single SMTP connection.
+    with notifier.session():
+        return run_transfer_cycle(client, hpc_servers, run_file, post_transfer_workers, scheduler)
+
+
+def run_transfer_cycle(client, hpc_servers, run_file, post_transfer_workers, scheduler):
+    cycle_started = time.monotonic()
+    # State store of transferred runs, created and imported from transferred_runs.txt if not present.
     transferred_set = get_transferred_runs(settings.wkdir)
 
-    # Connect to hpc
-    client, hpc_server = connect_to_remote_server(settings.host_keys, settings.server, settings.user, run_file)
+    # Post transfer jobs of a single cycle are finished before the cycle returns, in daemon mode workers keep running.
+    close_post_transfer_workers = post_transfer_workers is None
+    if close_post_transfer_workers:
+        post_transfer_workers = PostTransferWorkers(transferred_set, settings.post_transfer_workers)
 
-    # Run rsync commands for each mount point.
+    # Get folders to be transferred for all mount points in a single remote call.
+    to_be_transferred, missing_files = get_folders_remote_server(
+        client, settings.transfer_settings, run_file, transferred_set
+    )
+    # Size of the folders with all required files, in a second remote call for folders not measured before.
+    folder_sizes = get_folder_sizes(client, to_be_transferred, missing_files, run_file)
+
+    pending = Counter(
+        transfer["name"] for mount_name in to_be_transferred for transfer in to_be_transferred[mount_name].values()
+    )
+    pending_run_keys = {
+        f"{run}_{transfer['name']}"
+        for mount_name in to_be_transferred
+        for run, transfer in to_be_transferred[mount_name].items()
+    }
+    for run_key in set(run_first_seen) - pending_run_keys:
+        del run_first_seen[run_key]
+    for run_key in pending_run_keys:
+        run_first_seen.setdefault(run_key, time.time())
     for mount_name in settings.transfer_settings:
-        mount_path = settings.transfer_settings[mount_name]["mount_path"]
-        # Check if mount is available and continue
-        if is_mount_available(mount_name, mount_path, run_file):
-            # Get folders to be transferred
-            to_be_transferred = get_folders_remote_server(
-                client, settings.transfer_settings[mount_name]["transfers"], run_file, transferred_set
+        for transfer in settings.transfer_settings[mount_name]["transfers"]:
+            metrics.set("rsync_to_rdisc_runs_pending", pending[transfer["name"]], {"transfer": transfer["name"]})
+
+    # Mount points are independent pipelines, sharing the transfer workers and nodes.
+    # A slow or lost mount does not delay transfers to other mounts.
+    join_scheduler = scheduler is None
+    if join_scheduler:
+        scheduler = TransferScheduler(settings.rsync_max_workers)
+    server_pool = ServerPool(hpc_servers)
+    with ThreadPoolExecutor(max_workers=len(settings.transfer_settings)) as executor:
+        mount_results = [
+            executor.submit(
+                transfer_mount,
+                mount_name,
+                client,
+                server_pool,
+                run_file,
+                to_be_transferred[mount_name],
+                missing_files,
+                folder_sizes,
+                post_transfer_workers,
+                scheduler,
             )
+            for mount_name in settings.transfer_settings
+        ]
+    try:
+        # Transfers are blocked if a required file is missing for any of the mounts.
+        remove_run_file = all([mount_result.result() for mount_result in mount_results])
+    finally:
+        if join_scheduler:
+            # Wait for the transfers of all mounts to finish.
+            scheduler.join()
+        if close_post_transfer_workers:
+            post_transfer_workers.close()
 
-            # Rsync folders from HPC to mount
-            rsync_succes = rsync_server_remote(hpc_server, client, to_be_transferred, mount_path, run_file)
-            if not rsync_succes:
-                remove_run_file = False
-        else:  # Mount not available, send mail and block upcoming transfers
-            send_mail_lost_mount(mount_name, run_file)
-            remove_run_file = False
-
-    # Remove run_file if transfer daemon shouldn't be blocked to prevent repeated mailing.
     if remove_run_file:
-        Path(run_file).unlink()
+        metrics.set("rsync_to_rdisc_last_successful_cycle_timestamp_seconds", time.time())
+    event_log.emit(
+        "cycle",
+        result="ok" if remove_run_file else "blocked",
+        runs=sum(pending.values()),
+        duration_seconds=round(time.monotonic() - cycle_started, 3),
+    )
+    event_log.flush()
+
+    return remove_run_file, to_be_transferred
+
+
+def connect_daemon(client, hpc_servers, run_file):
+    # Reconnect when the connection is lost, otherwise discovery keeps using the connected server.
+    if client is None or not is_client_active(client):
+        if client is not None:
+            client.close()
+        # Unreachable nodes are reported by email but do not block the daemon, it connects again in the next cycle.
+        return connect_to_best_server(run_file, block_on_lost=False)
+    # Rank servers every cycle, discovery keeps using the connected server.
+    ranked_servers = rank_remote_servers(settings.server, settings.user, settings.host_keys)
+    return client, [hpc_servers[0]] + [server for server in ranked_servers if server != hpc_servers[0]]
+
+
+def recover_run_file(client, run_file):
+    # Lock the run file again after a cycle stopped by sys.exit, returns the run file and remove_run_file.
+    if client is not None:
+        client.close()
+    if Path(run_file) in run_file_locks:
+        return run_file, True
+    if Path(run_file).exists():
+        # run_file is blocked.
+        return run_file, False
+    return check_daemon_running(settings.wkdir), True
+
+
+def wait_until_unblocked(run_file, stop_event, wake_up_event):
+    # Block transfers until the run_file is removed manually, as is done by a single run.
+    release_run_file(run_file, remove_run_file=False)
+    while Path(run_file).exists() and not stop_event.is_set():
+        wake_up_event.wait(settings.daemon_max_interval)
+        wake_up_event.clear()
+    if stop_event.is_set():
+        return run_file
+    return check_daemon_running(settings.wkdir)
+
 
-    client.close()
+def stop_daemon(client, run_file, post_transfer_workers, scheduler, metrics_server):
+    # Finish running transfers, waiting transfers are started again by the next run.
+    scheduler.cancel_pending()
+    try:
+        scheduler.join()
+    except SystemExit as error:
+        print(f"Transfer stopped: {error}", file=sys.stderr)
+    post_transfer_workers.close()
+    event_log.flush()
+    notifier.send_digest()
+    if metrics_server is not None:
+        metrics_server.shutdown()
+        metrics_server.server_close()
+    if Path(run_file) in run_file_locks:
+        release_run_file(run_file, remove_run_file=True)
+    if client is not None:
+        client.close()
+
+
+def write_cycle_output():
+    # Metrics and events of the last cycle, buffered events are written after each cycle.
+    if settings.metrics_textfile_path:
+        write_metrics_textfile(settings.metrics_textfile_path)
+    event_log.flush()
+
+
+def set_daemon_signals(stop_event, wake_up_event):
+    # The daemon sleeps on wake_up_event, SIGUSR1 starts a new cycle immediately and SIGTERM/SIGINT stop the daemon.
+    def stop(signum, frame):
+        stop_event.set()
+        wake_up_event.set()
+
+    signal.signal(signal.SIGUSR1, lambda signum, frame: wake_up_event.set())
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+
+def run_daemon(run_file, stop_event=None):
+    if stop_event is None:
+        stop_event = threading.Event()
+    wake_up_event = threading.Event()
+    set_daemon_signals(stop_event, wake_up_event)
+
+    # Keep a single connection to hpc for all cycles.
+    client, hpc_servers = None, None
+    interval = settings.daemon_min_interval
+    # VCF uploads and emails are done independent of the transfer cycles.
+    post_transfer_workers = PostTransferWorkers(get_transferred_runs(settings.wkdir), settings.post_transfer_workers)
+    # Transfers keep running during the next cycles, new runs with a higher priority are started first.
+    scheduler = TransferScheduler(settings.rsync_max_workers)
+    metrics_server = None
+    if settings.metrics_port is not None:
+        metrics_server = start_metrics_server(settings.metrics_address, settings.metrics_port)
+
+    while not stop_event.is_set():
+        try:
+            client, hpc_servers = connect_daemon(client, hpc_servers, run_file)
+            remove_run_file, to_be_transferred = transfer_cycle(
+                client, hpc_servers, run_file, post_transfer_workers, scheduler
+            )
+            scheduler.raise_errors()
+        except SystemExit as error:
+            # Do not stop the daemon on a lost connection, reconnect in the next cycle after backing off.
+            print(f"Transfer cycle stopped: {error}", file=sys.stderr)
+            run_file, remove_run_file = recover_run_file(client, run_file)
+            client, to_be_transferred = None, {}
+
+        write_cycle_output()
+
+        if not remove_run_file:
+            run_file = wait_until_unblocked(run_file, stop_event, wake_up_event)
+            if stop_event.is_set():
+                break
+
+        # Poll often while new runs arrive, back off while the remote server is idle.
+        if any(to_be_transferred.values()):
+            interval = settings.daemon_min_interval
+        else:
+            interval = min(interval * 2, settings.daemon_max_interval)
+        if not stop_event.is_set():
+            wake_up_event.wait(interval)
+            wake_up_event.clear()
+
+    stop_daemon(client, run_file, post_transfer_workers, scheduler, metrics_server)
+
+
+def get_dry_run_sizes(hpc_server, runs, transfer_settings, mount_path):
+    """
+    Bytes rsync would transfer per run, estimated with a single rsync --dry-run for all runs of a transfer.
+
+    The rsync command of the first run is used with the source folders of all runs, files are listed with their size.
+    Returns None if the dry run failed.
+    """
+    rsync_cmd = get_rsync_cmd(hpc_server, runs[0], transfer_settings, mount_path)
+    source = f"{settings.user}@{hpc_server}:{transfer_settings['input']}/{runs[0]}"
+    # Next sources on the same server are given as :<path>.
+    sources = [source] + [f":{transfer_settings['input']}/{run}" for run in runs[1:]]
+    source_index = rsync_cmd.index(source)
+    dry_run_cmd = [option for option in rsync_cmd[:source_index] if option != "--info=progress2"]
+    dry_run_cmd += ["--dry-run", "--out-format=%n\t%l", *sources, *rsync_cmd[source_index + 1:]]
+    dry_run = subprocess.run(
+        dry_run_cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        encoding="UTF-8",
+        errors="replace",
+        env=get_rsync_env(),
+    )
+    if dry_run.returncode:
+        return None
+
+    dry_run_sizes = {run: 0 for run in runs}
+    for line in dry_run.stdout.splitlines():
+        file_path, separator, file_size = line.partition("\t")
+        run = file_path.split("/", 1)[0]
+        # Directories are listed with a trailing /.
+        if separator and file_size.isdigit() and run in dry_run_sizes and not file_path.endswith("/"):
+            dry_run_sizes[run] += int(file_size)
+    return dry_run_sizes
+
+
+def get_mount_plan(mount_name, to_be_transferred, missing_files, folder_sizes, hpc_server):
+    # Status of the runs of a mount in transfer order: transfer, missing_files or not_enough_space.
+    mount_path = settings.transfer_settings[mount_name]["mount_path"]
+    try:
+        free_bytes = get_free_bytes(mount_path)
+    except OSError:
+        free_bytes = None
+    mount_plan = []
+    for run in get_transfer_order(to_be_transferred, folder_sizes):
+        transfer_settings = to_be_transferred[run]
+        input_folder = f"{transfer_settings['input']}/{run}"
+        run_size = get_run_size(folder_sizes, run, transfer_settings)
+        status = "transfer"
+        if missing_files.get(input_folder):
+            status = "missing_files"
+        elif free_bytes is not None and run_size is not None:
+            if run_size > free_bytes:
+                status = "not_enough_space"
+            else:
+                free_bytes -= run_size
+        mount_plan.append(
+            {
+                "mount": mount_name,
+                "transfer": transfer_settings["name"],
+                "run": run,
+                "status": status,
+                "missing_files": missing_files.get(input_folder, []),
+                "priority": get_run_priority(run, transfer_settings),
+                "remote_bytes": run_size,
+                "estimated_bytes": None,
+                "expected_seconds": None,
+                "rsync_cmd": get_rsync_cmd(hpc_server, run, transfer_settings, mount_path),
+            }
+        )
+    return mount_plan
+
+
+def add_transfer_estimates(mount_plan, to_be_transferred, hpc_server, mount_path):
+    # A single dry run per transfer for all runs that would be transferred.
+    runs_per_transfer = {}
+    for run_plan in mount_plan:
+        if run_plan["status"] == "transfer":
+            runs_per_transfer.setdefault(run_plan["transfer"], []).append(run_plan)
+    for name, run_plans in runs_per_transfer.items():
+        transfer_settings = to_be_transferred[run_plans[0]["run"]]
+        runs = [run_plan["run"] for run_plan in run_plans]
+        dry_run_sizes = get_dry_run_sizes(hpc_server, runs, transfer_settings, mount_path)
+        throughput = get_transferred_runs(settings.wkdir).get_throughput(name)
+        for run_plan in run_plans:
+            if dry_run_sizes is not None:
+                run_plan["estimated_bytes"] = dry_run_sizes[run_plan["run"]]
+            estimated_bytes = run_plan["estimated_bytes"]
+            if estimated_bytes is None:
+                estimated_bytes = run_plan["remote_bytes"]
+            if throughput and estimated_bytes is not None:
+                run_plan["expected_seconds"] = round(estimated_bytes / throughput)
+
+
+def get_transfer_plan(client, hpc_server):
+    """
+    Runs the next transfer cycle would transfer, without transferring, uploading, sending email or updating the
+    discovery cache.
+
+    Per run: status (transfer, missing_files or not_enough_space), size on the HPC, bytes estimated by rsync --dry-run,
+    the expected duration from the throughput of previous transfers and the rsync command.
+    """
+    transferred_runs = get_transferred_runs(settings.wkdir)
+    to_be_transferred, missing_files = get_folders_remote_server(
+        client, settings.transfer_settings, None, transferred_runs, update_cache=False
+    )
+    folder_sizes = get_folder_sizes(client, to_be_transferred, missing_files, None, update_cache=False)
+
+    plan = []
+    for mount_name in settings.transfer_settings:
+        mount_plan = get_mount_plan(mount_name, to_be_transferred[mount_name], missing_files, folder_sizes, hpc_server)
+        add_transfer_estimates(
+            mount_plan, to_be_transferred[mount_name], hpc_server, settings.transfer_settings[mount_name]["mount_path"]
+        )
+        # Waiting transfers are started by priority including priority_age_boost,
+        # runs with the same priority from small to large.
+        plan.extend(sorted(mount_plan, key=lambda run_plan: -run_plan["priority"]))
+    return plan
+
+
+def print_transfer_plan(plan, as_json=False):
+    if as_json:
+        print(json.dumps(plan, indent=2))
+        return
+    print("\t".join(["mount", "transfer", "run", "status", "remote_gb", "estimated_gb", "expected_minutes"]))
+    for run_plan in plan:
+        print(
+            "\t".join(
+                [
+                    run_plan["mount"],
+                    run_plan["transfer"],
+                    run_plan["run"],
+                    run_plan["status"] if not run_plan["missing_files"] else f"missing {', '.join(run_plan['missing_files'])}",
+                    "-" if run_plan["remote_bytes"] is None else f"{run_plan['remote_bytes'] / 1e9:.1f}",
+                    "-" if run_plan["estimated_bytes"] is None else f"{run_plan['estimated_bytes'] / 1e9:.1f}",
+                    "-" if run_plan["expected_seconds"] is None else f"{run_plan['expected_seconds'] / 60:.0f}",
+                ]
+            )
+        )
+        if run_plan["status"] == "transfer":
+            print(f"\t{' '.join(shlex.quote(option) for option in run_plan['rsync_cmd'])}")
+
+
+def plan_transfers(as_json=False):
+    # Connect without a run file, a lost connection is reported without email and does not block transfers.
+    ranked_servers = rank_remote_servers(settings.server, settings.user, settings.host_keys)
+    client, hpc_server = connect_to_remote_server(settings.host_keys, ranked_servers or settings.server, settings.user, None)
+    try:
+        print_transfer_plan(get_transfer_plan(client, hpc_server), as_json)
+    finally:
+        client.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Transfer analysis and run folders from the HPC to the mounts with rsync.")
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep running and poll the HPC for new folders, instead of a single transfer cycle started by cron.",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Show the runs the next cycle would transfer with size and time estimates, nothing is transferred.",
+    )
+    parser.add_argument("--json", action="store_true", help="Print the --plan as json.")
+    subparsers = parser.add_subparsers(dest="command")
+    state_parser = subparsers.add_parser("state", help="List or reset transferred runs.")
+    state_subparsers = state_parser.add_subparsers(dest="state_command")
+    state_subparsers.required = True
+    list_parser = state_subparsers.add_parser("list", help="List transferred runs.")
+    list_parser.add_argument("--state", help="Only list runs with this state, e.g. ok or vcf_upload_error.")
+    state_subparsers.add_parser("jobs", help="List unfinished post transfer jobs, VCF uploads and transfer email.")
+    reset_parser = state_subparsers.add_parser("reset", help="Remove runs, so they are transferred again.")
+    reset_parser.add_argument("run_keys", nargs="+", metavar="run_key", help="<run>_<transfer name>, as shown by list.")
+    retry_parser = state_subparsers.add_parser("retry", help="Start failed post transfer jobs again, without a new transfer.")
+    retry_parser.add_argument("run_keys", nargs="+", metavar="run_key", help="<run>_<transfer name>, as shown by jobs.")
+    return parser.parse_args(argv)
+
+
+def update_run_keys(run_keys, update, updated_msg, unknown_msg):
+    for run_key in run_keys:
+        if update(run_key):
+            print(f"{updated_msg} {run_key}")
+        else:
+            print(f"{unknown_msg} {run_key}", file=sys.stderr)
+
+
+def manage_state(args):
+    transferred_runs = get_transferred_runs(settings.wkdir)
+    if args.state_command == "list":
+        print("\t".join(TransferredRuns.columns))
+        for transferred_run in transferred_runs.list(args.state):
+            transferred_run["metrics"] = json.dumps(transferred_run["metrics"]) if transferred_run["metrics"] else None
+            print("\t".join("" if value is None else str(value) for value in transferred_run.values()))
+    elif args.state_command == "jobs":
+        for job in transferred_runs.list_jobs():
+            finished_steps = [step for step in job["steps"] if step != "mount_path"]
+            print(f"{job['run_key']}\t{job['status']}\tfinished steps: {', '.join(finished_steps) or '-'}")
+    elif args.state_command == "reset":
+        update_run_keys(args.run_keys, transferred_runs.reset, "Reset", "Unknown run")
+    elif args.state_command == "retry":
+        update_run_keys(args.run_keys, transferred_runs.retry_job, "Retry", "No failed job for")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.command == "state":
+        manage_state(args)
+        return
+
+    if args.plan:
+        # Does not lock transfer.running, the plan can be made while transfers are running.
+        plan_transfers(args.json)
+        return
+
+    # If daemon is running exit, else lock transfer.running file and continue.
+    run_file = check_daemon_running(settings.wkdir)
+
+    try:
+        if args.daemon:
+            run_daemon(run_file)
+        else:
+            # Connect to hpc
+            client, hpc_servers = connect_to_best_server(run_file)
+
+            remove_run_file, to_be_transferred = transfer_cycle(client, hpc_servers, run_file)
+            if settings.metrics_textfile_path:
+                write_metrics_textfile(settings.metrics_textfile_path)
+            release_run_file(run_file, remove_run_file)
+
+            client.close()
+    finally:
+        # Events and completed transfers still buffered, e.g. when the cycle is stopped by a lost connection.
+        event_log.flush()
+        notifier.send_digest()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,27 +3,122 @@
 """ General settings """
 # Log files
 wkdir = "/diaggen/data/upload/"
-temp_error_path = f"{wkdir}/temp.error"
+# Human readable logs with the rsync output per run, set to None to only write the event log.
 log_path = f"{wkdir}/Rsync_Dx.log"
 errorlog_path = f"{wkdir}/Rsync_Dx.errorlog"
+# Compiled email templates, reused by the next transfer process. Set to None to compile templates in each process.
+template_cache_dir = f"{wkdir}/template_cache"
+# Event log, one JSON object per line for each stage of a run (discovery, rsync, transfer, vcf upload, email),
+# with the run, transfer, result, duration and bytes. Set to None to disable.
+# Events are buffered up to event_log_buffer events and written after each cycle,
+# the file is rotated when larger than event_log_max_bytes and event_log_backups old files are kept.
+event_log_path = f"{wkdir}/Rsync_Dx.events.jsonl"
+event_log_buffer = 100
+event_log_max_bytes = 50 * 1024 * 1024
+event_log_backups = 5
 
 # Tools
 alissa_vcf_upload = "/diaggen/software/production/alissa_vcf_upload/"
+# Maximum number of vcf files uploaded at the same time per run.
+vcf_upload_workers = 8
+# Number of runs for which vcf files are uploaded and the transfer email is sent at the same time.
+post_transfer_workers = 2
+
+# Daemon mode (--daemon), poll interval in seconds, doubled while no new folders are found.
+daemon_min_interval = 60
+daemon_max_interval = 900
+
+# Prometheus metrics, both disabled when set to None.
+# metrics_textfile_path: file for the node_exporter textfile collector, e.g. f"{wkdir}/rsync_to_rdisc.prom",
+#   written after each transfer cycle.
+# metrics_port: local http endpoint (/metrics) in daemon mode, e.g. 9101.
+metrics_textfile_path = None
+metrics_address = "127.0.0.1"
+metrics_port = None
+
+# Discovery cache, required files are only checked again for remote folders with a changed mtime.
+# discovery_mtime_margin: seconds, covers folders changed while the previous discovery was running.
+# discovery_cache_ttl: seconds, folders are checked again after this time, also when the mtime did not change.
+discovery_mtime_margin = 60
+discovery_cache_ttl = 86400
 
 """ Server/user settings """
 host_keys = ""
 server = ["", ""]
 user = ""
+# Multiplexed OpenSSH connection shared by discovery and rsync, set ssh_control_path to None to use paramiko instead.
+# %C is a hash of the connection, keeps the socket path short.
+ssh_control_path = f"{wkdir}/ssh-%C"
+ssh_control_persist = 600  # seconds
+ssh_connect_timeout = 30  # seconds
+ssh_command_timeout = 300  # seconds
+# Transfer nodes are ordered by connect latency, and load per cpu if server_load_probe (requires ssh_control_path).
+# rsync processes are spread over the healthy nodes, a run moves to another node when its connection is lost.
+server_load_probe = True
+server_load_weight = 1.0  # seconds of latency equal to a load of 1 per cpu
 
 """Mail finished transfer"""
 email_smtp_host = "pim.umcutrecht.nl"
 email_smtp_port = 25
 email_from = ""
 email_to = ["", ""]
+# Collect completed transfers in a single summary email instead of an email per run, errors are sent immediately.
+# The summary is sent at the end of a single transfer cycle, in daemon mode every email_digest_interval seconds.
+email_digest = False
+email_digest_interval = 3600  # seconds
+# Repeated alerts for the same problem (rsync error of a run, mount full, lost HPC connection) are sent once per interval.
+email_alert_interval = 21600  # seconds
 
 """ Transfer settings  """
+# Maximum number of rsync processes running at the same time, shared by all mount points.
+rsync_max_workers = 4
+# Report overall progress of each rsync (--info=progress2, rsync >= 3.1), exported as metrics while rsync is running.
+rsync_progress = True
+# rsync output is written to the log files while rsync is running, the last lines of each run are kept in memory
+# to check the result and are included in the error email.
+rsync_output_lines = 100
+# Partially transferred files are kept in this directory (relative to the target folder) and used by the next attempt,
+# set to None to remove partially transferred files.
+rsync_partial_dir = ".rsync-partial"
+# Stop rsync when no data is transferred for rsync_io_timeout seconds, the transfer is retried.
+rsync_io_timeout = 600
+# Transient rsync errors (lost connection, timeout, vanished source files) are retried rsync_retry_attempts times,
+# after rsync_retry_backoff seconds doubled for each attempt up to rsync_retry_max_backoff seconds.
+# Other errors are not retried and reported by email.
+rsync_retry_attempts = 3
+rsync_retry_backoff = 60
+rsync_retry_max_backoff = 900
+# CPU and I/O priority of rsync processes (nice -n <rsync_nice>, ionice best effort level 0-7 or "idle"),
+# None keeps the priority of this process. Overridden by the transfer settings nice and ionice.
+rsync_nice = None
+rsync_ionice = None
+# Priority per hour a run is waiting to be transferred, added to the priority of the transfer (daemon mode).
+priority_age_boost = 1.0
+# Mounts are probed by writing a small file in the first existing output directory of its transfers,
+# a mount is lost when the probe takes longer than mount_probe_timeout.
+# The result is reused for mount_probe_ttl seconds.
+mount_probe_timeout = 10  # seconds
+mount_probe_ttl = 30  # seconds
+# Fraction of each mount that is kept free, runs are not transferred when the remote size exceeds the free space.
+mount_reserved_fraction = 0.02
+# Verification of transferred runs (transfer setting verify), files are hashed by verify_workers threads
+# reading verify_read_size bytes at a time.
+verify_manifest = "md5sum.txt"
+verify_workers = 4
+verify_read_size = 8 * 1024 * 1024
+# Checksums on the HPC (verify "remote") are calculated by the post transfer workers, the remote command times out after
+# ssh_command_timeout plus the size of the run divided by verify_remote_rate.
+verify_remote_rate = 20 * 1000 * 1000  # bytes per second
+
 # transfer_settings: dict of dicts, where each dict is a mount point
 # mount_path = path to mount point
+# max_parallel = optional, maximum number of rsync processes running at the same time to this mount point,
+#   only useful when lower than rsync_max_workers.
+# bwlimit = optional, bandwidth budget of the mount point in KiB/s, split between its max_parallel rsync processes
+#   (rsync_max_workers if max_parallel is not set) with --bwlimit.
+#   A fixed budget or a list of time windows, unlimited outside the windows, e.g. capped during office hours:
+#   [{"start": "07:00", "end": "19:00", "bwlimit": 50000}], windows can pass midnight ("22:00" - "06:00").
+#   Running rsync processes are restarted at the start and end of each window with the limit of the new window.
 # transfers: dict of dicts, where each dict is a folder to be transferred
 #   input = hpc location,
 #   output = transfer location,
@@ -31,10 +126,22 @@ email_to = ["", ""]
 #   continue_without_email = True/False boolean, in which True = continue without mail, and False = send error mail and stop
 #   upload_gatk_vcf = True/False, upload gatk vcf files, assumes vcf files in folder <run>/single_sample_vcf/
 #   upload_exomedepth_vcf = True/False, upload exomedepth vcf files, assumes vcf files in folder <run>/exomedepth/HC/
+#   max_parallel = optional, maximum number of rsync processes running at the same time for this transfer.
+#   priority = optional, waiting transfers with the highest priority are started first, default 0.
+#   retry_attempts/retry_backoff = optional, overrides rsync_retry_attempts and rsync_retry_backoff for this transfer.
+#   append_verify = optional True/False, resume files by appending to them (--append-verify),
+#     only safe for files that are never changed after they are written, e.g. raw sequencing data.
+#   verify = optional, compare md5 checksums of the transferred files before vcf uploads and email:
+#     "manifest" = checksums in verify_manifest of the run folder (or the transfer setting verify_manifest),
+#     "remote" = checksums of the transferred files calculated on the HPC by the post transfer workers.
+#   bwlimit = optional, bandwidth budget of this transfer, as bwlimit of the mount point, split between max_parallel
+#     rsync processes of this transfer. The lowest share is used.
+#   nice/ionice = optional, overrides rsync_nice and rsync_ionice for this transfer.
 
 transfer_settings = {
     "bgarray": {
         "mount_path": "/mnt/bgarray/",
+        "max_parallel": 3,
         "transfers": [
             {
                 "name": "Exomes",
@@ -44,6 +151,7 @@ transfer_settings = {
                 "continue_without_email": False,
                 "upload_gatk_vcf": True,
                 "upload_exomedepth_vcf": True,
+                "priority": 10,
             },
             {
                 "name": "Genomes",
@@ -53,6 +161,7 @@ transfer_settings = {
                 "continue_without_email": False,
                 "upload_gatk_vcf": False,
                 "upload_exomedepth_vcf": False,
+                "priority": 10,
             },
             {
                 "name": "TRANSFER",
@@ -71,6 +180,11 @@ transfer_settings = {
                 "continue_without_email": False,
                 "upload_gatk_vcf": False,
                 "upload_exomedepth_vcf": False,
+                "max_parallel": 1,
+                "retry_attempts": 5,
+                "append_verify": True,
+                "nice": 10,
+                "ionice": 7,
             },
             {
                 "name": "Transcriptomes",
@@ -80,6 +194,7 @@ transfer_settings = {
                 "continue_without_email": False,
                 "upload_gatk_vcf": False,
                 "upload_exomedepth_vcf": False,
+                "priority": 10,
             },
             {
                 "name": "RAW_data_RNAseq",
@@ -89,6 +204,11 @@ transfer_settings = {
                 "continue_without_email": False,
                 "upload_gatk_vcf": False,
                 "upload_exomedepth_vcf": False,
+                "retry_attempts": 5,
+                "append_verify": True,
+                "verify": "manifest",
+                "nice": 10,
+                "ionice": 7,
                 "include": [
                     "**/",
                     "Data",
@@ -109,6 +229,7 @@ transfer_settings = {
     },
     "glims": {
         "mount_path": "/mnt/glims/",
+        "max_parallel": 1,
         "transfers": [
             {
                 "name": "pg_glims",
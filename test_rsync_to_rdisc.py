@@ -1,7 +1,19 @@
 #!/usr/bin/env python
+from collections import Counter
 from csv import writer
+from datetime import datetime
+import fcntl
+from io import BytesIO
+import json
+import os
+import smtplib
 import subprocess
 from pathlib import Path
+import sys
+import threading
+import time
+from urllib.error import HTTPError
+from urllib.request import urlopen
 
 from freezegun import freeze_time
 from paramiko import ssh_exception
@@ -29,14 +41,13 @@ def set_up_test(tmp_path_factory):
 
     # Setup settings
     rsync_to_rdisc.settings.wkdir = f"{tmp_path}/wkdir"
-    rsync_to_rdisc.settings.temp_error_path = f"{rsync_to_rdisc.settings.wkdir}/temp.error"
     rsync_to_rdisc.settings.log_path = f"{rsync_to_rdisc.settings.wkdir}/Rsync_Dx.log"
     rsync_to_rdisc.settings.errorlog_path = f"{rsync_to_rdisc.settings.wkdir}/Rsync_Dx.errorlog"
+    rsync_to_rdisc.settings.event_log_path = f"{rsync_to_rdisc.settings.wkdir}/Rsync_Dx.events.jsonl"
+    rsync_to_rdisc.settings.template_cache_dir = f"{rsync_to_rdisc.settings.wkdir}/template_cache"
 
     # Setup wkdir files
     Path(rsync_to_rdisc.settings.wkdir).mkdir()
-    Path(rsync_to_rdisc.settings.temp_error_path).touch()
-    Path(f"{rsync_to_rdisc.settings.wkdir}/temp_not_empty.error").write_text("hello")  # non empty temp error
     Path(rsync_to_rdisc.settings.log_path).touch()
     run_file = f"{rsync_to_rdisc.settings.wkdir}/transfer.running"
     Path(run_file).touch()
@@ -152,6 +163,133 @@ def mock_run_vcf_upload(class_mocker):
     return class_mocker.patch("rsync_to_rdisc.run_vcf_upload", side_effect=side_effect_run_vcf_upload)
 
 
+class TestTransferScheduler:
+    def _job(self, keys, running, max_running, lock):
+        with lock:
+            for key in keys:
+                running[key] += 1
+                max_running[key] = max(max_running[key], running[key])
+        time.sleep(0.05)
+        with lock:
+            for key in keys:
+                running[key] -= 1
+
+    @pytest.mark.parametrize(
+        "max_workers,mount_limit,transfer_limit,expected",
+        [
+            (4, None, None, {"all": 4, "mount": 4, "Exomes": 2, "RAW_data": 2}),
+            (4, 2, None, {"all": 2, "mount": 2, "Exomes": 2, "RAW_data": 2}),
+            (4, None, 1, {"all": 2, "mount": 2, "Exomes": 1, "RAW_data": 1}),
+            (1, None, None, {"all": 1, "mount": 1, "Exomes": 1, "RAW_data": 1}),
+        ],
+    )
+    def test_limits(self, max_workers, mount_limit, transfer_limit, expected):
+        running, max_running, lock = Counter(), Counter(), threading.Lock()
+        scheduler = rsync_to_rdisc.TransferScheduler(max_workers)
+        for name in ["Exomes", "Exomes", "RAW_data", "RAW_data"]:
+            scheduler.submit(
+                self._job,
+                ["all", "mount", name],
+                running,
+                max_running,
+                lock,
+                limits=[("mount:/mnt/bgarray", mount_limit), (f"transfer:{name}", transfer_limit)],
+            )
+        scheduler.join()
+        assert max_running == expected
+        assert not scheduler.pending and not scheduler.running
+
+    def test_priority(self):
+        started, release = [], threading.Event()
+        scheduler = rsync_to_rdisc.TransferScheduler(1)
+        scheduler.submit(lambda: release.wait(5), key="first")
+        # Submitted while the first job is running, the high priority job jumps the queue.
+        scheduler.submit(started.append, "RAW_data", priority=0, key="RAW_data")
+        scheduler.submit(started.append, "RAW_data_2", priority=0)
+        scheduler.submit(started.append, "Exomes", priority=10, key="Exomes")
+        assert scheduler.is_active("first") and scheduler.is_active("Exomes")
+        release.set()
+        scheduler.join()
+        assert started == ["Exomes", "RAW_data", "RAW_data_2"]
+        assert not scheduler.is_active("Exomes")
+
+    def test_cancel_pending(self):
+        started, release = [], threading.Event()
+        scheduler = rsync_to_rdisc.TransferScheduler(1)
+        scheduler.submit(lambda: release.wait(5))
+        scheduler.submit(started.append, "RAW_data", key="RAW_data")
+        scheduler.cancel_pending()
+        release.set()
+        scheduler.join()
+        assert not started
+        assert not scheduler.is_active("RAW_data")
+
+    def test_raises_worker_exception(self):
+        scheduler = rsync_to_rdisc.TransferScheduler(2)
+        scheduler.submit(sys_exit_job)
+        with pytest.raises(SystemExit):
+            scheduler.join()
+
+
+def test_get_run_priority(mocker):
+    mocker.patch.object(rsync_to_rdisc.settings, "priority_age_boost", 2)
+    mocker.patch.dict(rsync_to_rdisc.run_first_seen, {"run1_RAW_data": time.time() - 3 * 3600 - 60})
+    assert rsync_to_rdisc.get_run_priority("run1", {"name": "RAW_data"}) == 6
+    assert rsync_to_rdisc.get_run_priority("run2", {"name": "Exomes", "priority": 10}) == 10
+
+
+@pytest.mark.parametrize("mount_max_parallel,transfer_max_parallel", [(None, None), (2, None), (None, 1), (3, 1)])
+def test_get_transfer_limits(mount_max_parallel, transfer_max_parallel):
+    transfer_settings = {"name": "RAW_data"}
+    if transfer_max_parallel:
+        transfer_settings["max_parallel"] = transfer_max_parallel
+    limits = rsync_to_rdisc.get_transfer_limits("/mnt/bgarray/", mount_max_parallel, transfer_settings)
+    assert limits == [("mount:/mnt/bgarray/", mount_max_parallel), ("transfer:RAW_data", transfer_max_parallel)]
+
+
+def sys_exit_job():
+    raise SystemExit("HPC connection ConnectionResetError/TimeoutError")
+
+
+def test_log_writer(tmp_path):
+    log_path = f"{tmp_path}/Rsync_Dx.log"
+    lines = [f"run{run}\t{'x' * 10000}\n" for run in range(20)]
+    threads = [threading.Thread(target=rsync_to_rdisc.log_writer.write, args=(log_path, [line] * 10)) for line in lines]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Lines of a single write are kept together.
+    log_lines = Path(log_path).read_text().splitlines(keepends=True)
+    assert Counter(log_lines) == Counter({line: 10 for line in lines})
+    assert all(log_lines[index:index + 10] == [log_lines[index]] * 10 for index in range(0, 200, 10))
+
+
+def test_event_log(tmp_path, mocker):
+    mocker.patch("rsync_to_rdisc.settings.event_log_path", f"{tmp_path}/events.jsonl")
+    mocker.patch("rsync_to_rdisc.settings.event_log_buffer", 3)
+    mocker.patch("rsync_to_rdisc.settings.event_log_max_bytes", 500)
+    mocker.patch("rsync_to_rdisc.settings.event_log_backups", 2)
+    event_log = rsync_to_rdisc.EventLog()
+    event_log.emit("rsync", run="run1", transfer="Exomes", result=0, duration_seconds=1.5)
+    event_log.emit("transfer", run="run1", transfer="Exomes", result="ok", bytes=1024)
+    # Events are buffered until the buffer is full or flushed.
+    assert not Path(f"{tmp_path}/events.jsonl").exists()
+    event_log.flush()
+    events = [json.loads(line) for line in Path(f"{tmp_path}/events.jsonl").read_text().splitlines()]
+    assert [event["stage"] for event in events] == ["rsync", "transfer"]
+    assert events[1]["run"] == "run1" and events[1]["bytes"] == 1024 and "time" in events[1]
+
+    # The file is rotated when it exceeds event_log_max_bytes, only event_log_backups files are kept.
+    for index in range(30):
+        event_log.emit("cycle", result="ok", runs=index)
+    event_log.flush()
+    assert Path(f"{tmp_path}/events.jsonl.1").exists()
+    assert Path(f"{tmp_path}/events.jsonl.2").exists()
+    assert not Path(f"{tmp_path}/events.jsonl.3").exists()
+    assert all(Path(path).stat().st_size <= 500 for path in tmp_path.glob("events.jsonl*"))
+
+
 class TestCheckRsync:
     def test_ok(self, set_up_test, mocker, fake_process):
         # Use fake_process of pytest subprocess to mock subprocess.run output
@@ -162,15 +300,12 @@ class TestCheckRsync:
             set_up_test["analysis1"], set_up_test["analysis1_transfer_settings"], "Exomes", subprocess_result
         )
         assert rsync_result == "ok"
-        assert not Path(rsync_to_rdisc.settings.temp_error_path).exists()
         assert "No errors detected" in Path(rsync_to_rdisc.settings.log_path).read_text()
 
     def _callback_function(self, process):
         process.returncode = 1
 
-    def test_temperror(self, mock_send_mail_transfer_state, set_up_test, fake_process):
-        rsync_to_rdisc.settings.temp_error_path = f"{rsync_to_rdisc.settings.wkdir}/temp_not_empty.error"
-
+    def test_error(self, mock_send_mail_transfer_state, set_up_test, fake_process):
         rsync_cmd = ["rsync", "-rahuL", "--stats", "/source", "/target"]
         fake_process.register_subprocess(rsync_cmd, callback=self._callback_function, stderr=["error"])
         subprocess_result = subprocess.run(rsync_cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE, encoding="UTF-8")
@@ -180,23 +315,414 @@ class TestCheckRsync:
         )
         assert rsync_result == "error"
         assert f"{set_up_test['analysis1']}_Exomes errors detected" in Path(rsync_to_rdisc.settings.log_path).read_text()
+        # Errors of this run are included in the email.
+        mock_send_mail_transfer_state.assert_called_once()
+        assert mock_send_mail_transfer_state.call_args[1]["errors"] == "error\n"
+
+        # The run is retried in the next cycle, the error mail is not repeated within email_alert_interval.
+        rsync_to_rdisc.check_rsync(
+            set_up_test["analysis1"], set_up_test["analysis1_transfer_settings"], "Exomes", subprocess_result
+        )
         mock_send_mail_transfer_state.assert_called_once()
+        rsync_to_rdisc.check_rsync(
+            set_up_test["analysis1"],
+            set_up_test["analysis1_transfer_settings"],
+            "Exomes",
+            subprocess.CompletedProcess(rsync_cmd, 0, "", ""),
+        )
+        assert rsync_to_rdisc.is_alert_due(f"transfer_error:{set_up_test['analysis1']}_Exomes")
 
         # Reset all mocks
         mock_send_mail_transfer_state.reset_mock()
 
 
+RSYNC_STATS = """
+Number of files: 1,234 (reg: 1,200, dir: 34)
+Number of created files: 1,234 (reg: 1,200, dir: 34)
+Number of deleted files: 0
+Number of regular files transferred: 1,200
+Total file size: 12.35G bytes
+Total transferred file size: 10.00G bytes
+Literal data: 9.50G bytes
+Matched data: 500.00M bytes
+File list size: 65.54K
+Total bytes sent: 9.51G
+Total bytes received: 23.04K
+
+sent 9.51G bytes  received 23.04K bytes  95.10M bytes/sec
+total size is 12.35G  speedup is 1.30
+"""
+
+
+class TestParseRsyncStats:
+    def test_human_readable(self):
+        metrics = rsync_to_rdisc.parse_rsync_stats(RSYNC_STATS, 100)
+        assert metrics == {
+            "files_transferred": 1200,
+            "total_size": 12350000000,
+            "transferred_bytes": 10000000000,
+            "literal_bytes": 9500000000,
+            "matched_bytes": 500000000,
+            "duration": 100,
+            "mb_per_second": 100.0,
+        }
+
+    def test_bytes(self):
+        metrics = rsync_to_rdisc.parse_rsync_stats("Total transferred file size: 1,048,576 bytes\n", 0)
+        assert metrics["transferred_bytes"] == 1048576
+        assert metrics["files_transferred"] is None
+        assert metrics["mb_per_second"] is None
+
+    def test_no_stats(self):
+        metrics = rsync_to_rdisc.parse_rsync_stats("", 10)
+        assert metrics["transferred_bytes"] is None
+        assert metrics["duration"] == 10
+
+    def test_locale_grouping(self):
+        metrics = rsync_to_rdisc.parse_rsync_stats("Total transferred file size: 1.048.576 bytes\n", 10)
+        assert metrics["transferred_bytes"] is None
+        assert metrics["mb_per_second"] is None
+
+
+class TestRunRsync:
+    def test_parse_rsync_progress(self):
+        assert rsync_to_rdisc.parse_rsync_progress("      1.23G  45%   10.00MB/s    0:01:23 (xfr#12, to-chk=3/100)") == {
+            "bytes": 1230000000,
+            "percent": 45,
+            "rate": "10.00MB/s",
+            "eta_seconds": 83,
+        }
+        assert rsync_to_rdisc.parse_rsync_progress("Number of files: 1,234") is None
+
+    def test_run_rsync(self, set_up_test, mocker):
+        mock_metrics_set = mocker.patch.object(rsync_to_rdisc.metrics, "set")
+        mocker.patch.object(rsync_to_rdisc.settings, "rsync_output_lines", 2)
+        script = (
+            "printf '   1.00M  10%%   1.00MB/s    0:00:09\\r   5.00M  50%%   1.00MB/s    0:00:05\\r'; "
+            "printf 'stats1\\nstats2\\nstats3\\n'; echo error >&2; exit 23"
+        )
+        result = rsync_to_rdisc.run_rsync(["bash", "-c", script], "run1")
+        assert result.returncode == 23
+        assert result.stdout == "stats2\nstats3\n"
+        assert result.stderr == "error\n"
+        assert Path(rsync_to_rdisc.settings.log_path).read_text().endswith("run1\tstats1\nrun1\tstats2\nrun1\tstats3\n")
+        assert "run1\terror\n" in Path(rsync_to_rdisc.settings.errorlog_path).read_text()
+        mock_metrics_set.assert_any_call("rsync_to_rdisc_rsync_progress_bytes", 5000000, {"run": "run1"})
+        mock_metrics_set.assert_any_call("rsync_to_rdisc_rsync_progress_eta_seconds", 9, {"run": "run1"})
+        assert "run1" not in rsync_to_rdisc.transfer_progress
+        assert rsync_to_rdisc.metrics.get("rsync_to_rdisc_rsync_progress_bytes", {"run": "run1"}) is None
+
+    def test_run_rsync_locale(self, set_up_test, mocker):
+        mocker.patch.dict(rsync_to_rdisc.os.environ, {"LC_ALL": "nl_NL.UTF-8"})
+        assert rsync_to_rdisc.run_rsync(["bash", "-c", "echo $LC_ALL"], "run1").stdout == "C\n"
+
+
 class TestCheckDaemonRunning:
     def test_new_file(self, set_up_test):
         out = rsync_to_rdisc.check_daemon_running(f"{set_up_test['tmp_path']}/empty/")
         assert Path(f"{set_up_test['tmp_path']}/empty/transfer.running").exists()
         assert out == Path(f"{set_up_test['tmp_path']}/empty/transfer.running")
+        assert out.read_text() == str(os.getpid())
 
     def test_file_exists(self, set_up_test, mock_sys_exit):
+        # An empty or non pid run file blocks transfers.
         rsync_to_rdisc.check_daemon_running(rsync_to_rdisc.settings.wkdir)
         mock_sys_exit.assert_called_once()
         mock_sys_exit.reset_mock()
 
+    def test_locked(self, tmp_path, mock_sys_exit):
+        with open(tmp_path / "transfer.running", "w") as lock_file:
+            lock_file.write("1")
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            out = rsync_to_rdisc.check_daemon_running(tmp_path)
+        mock_sys_exit.assert_called_once()
+        assert not out
+        mock_sys_exit.reset_mock()
+
+    def test_stale_pid(self, tmp_path):
+        # Run file of a crashed transfer process, not locked anymore.
+        Path(tmp_path / "transfer.running").write_text("99999999")
+        out = rsync_to_rdisc.check_daemon_running(tmp_path)
+        assert out.read_text() == str(os.getpid())
+        rsync_to_rdisc.release_run_file(out, remove_run_file=True)
+
+    @pytest.mark.parametrize("remove_run_file", [True, False])
+    def test_release_run_file(self, tmp_path, remove_run_file):
+        run_file = rsync_to_rdisc.check_daemon_running(tmp_path)
+        rsync_to_rdisc.release_run_file(run_file, remove_run_file)
+        assert run_file not in rsync_to_rdisc.run_file_locks
+        if remove_run_file:
+            assert not run_file.exists()
+        else:
+            assert run_file.read_text().startswith("Transfers are blocked")
+
+
+class TestTransferCycle:
+    mounts = {
+        "bgarray": {
+            "mount_path": "/mnt/bgarray/",
+            "transfers": [{"name": "RAW_data", "input": "/raw", "files_required": [""]}],
+        },
+        "glims": {
+            "mount_path": "/mnt/glims/",
+            "transfers": [{"name": "pg_glims", "input": "/glims", "files_required": [""]}],
+        },
+    }
+
+    @pytest.fixture(autouse=True)
+    def set_up_cycle(self, tmp_path, mocker):
+        mocker.patch.object(rsync_to_rdisc.settings, "wkdir", tmp_path)
+        mocker.patch.object(rsync_to_rdisc.settings, "transfer_settings", self.mounts)
+        to_be_transferred = {
+            "bgarray": {"run1": self.mounts["bgarray"]["transfers"][0]},
+            "glims": {"run2": self.mounts["glims"]["transfers"][0]},
+        }
+        mocker.patch(
+            "rsync_to_rdisc.get_folders_remote_server",
+            return_value=(to_be_transferred, {"/raw/run1": [], "/glims/run2": []}),
+        )
+        mocker.patch("rsync_to_rdisc.get_remote_folder_sizes", return_value={})
+        mocker.patch("rsync_to_rdisc.is_mount_available", return_value=True)
+
+    def test_mounts_in_parallel(self, mocker):
+        glims_started = threading.Event()
+
+        def side_effect_transfer_run(server_pool, run, transfer_settings, *args):
+            # The bgarray transfer only finishes when the glims transfer has started.
+            if run == "run1":
+                assert glims_started.wait(5)
+            else:
+                glims_started.set()
+
+        mock_transfer_run = mocker.patch("rsync_to_rdisc.transfer_run", side_effect=side_effect_transfer_run)
+        remove_run_file, to_be_transferred = rsync_to_rdisc.transfer_cycle("client", ["hpct04"], "run_file")
+        assert remove_run_file
+        assert mock_transfer_run.call_count == 2
+        # Both mounts share the transfer nodes.
+        assert mock_transfer_run.call_args_list[0][0][0] is mock_transfer_run.call_args_list[1][0][0]
+
+    def test_remove_run_file(self, mocker):
+        mocker.patch("rsync_to_rdisc.transfer_run")
+        # A required file is missing for the run on bgarray.
+        mocker.patch(
+            "rsync_to_rdisc.rsync_server_remote", side_effect=lambda server_pool, client, runs, *args: "run1" not in runs
+        )
+        remove_run_file, to_be_transferred = rsync_to_rdisc.transfer_cycle("client", ["hpct04"], "run_file")
+        assert not remove_run_file
+
+
+class TestRunDaemon:
+    @pytest.fixture(autouse=True)
+    def wkdir(self, tmp_path, mocker):
+        mocker.patch.object(rsync_to_rdisc.settings, "wkdir", str(tmp_path))
+        mocker.patch("rsync_to_rdisc.rank_remote_servers", return_value=["hpct05", "hpct04"])
+
+    def test_cycle(self, tmp_path, mocker):
+        run_file = rsync_to_rdisc.check_daemon_running(tmp_path)
+        client = mocker.MagicMock()
+        mocker.patch("rsync_to_rdisc.connect_to_best_server", return_value=(client, ["hpct04"]))
+        mocker.patch("rsync_to_rdisc.signal.signal")
+        stop_event = threading.Event()
+
+        def side_effect_transfer_cycle(client, hpc_server, run_file, post_transfer_workers, scheduler):
+            stop_event.set()
+            return True, {}
+
+        mock_cycle = mocker.patch("rsync_to_rdisc.transfer_cycle", side_effect=side_effect_transfer_cycle)
+        rsync_to_rdisc.run_daemon(run_file, stop_event)
+        mock_cycle.assert_called_once_with(client, ["hpct04"], run_file, mocker.ANY, mocker.ANY)
+        client.close.assert_called_once()
+        assert not run_file.exists()
+
+    def test_reconnect(self, tmp_path, mocker):
+        run_file = rsync_to_rdisc.check_daemon_running(tmp_path)
+        client = mocker.MagicMock()
+        # Transport dropped after the first cycle.
+        client.get_transport.return_value = None
+        mock_connect = mocker.patch("rsync_to_rdisc.connect_to_best_server", return_value=(client, ["hpct04"]))
+        mocker.patch("rsync_to_rdisc.signal.signal")
+        mocker.patch.object(rsync_to_rdisc.settings, "daemon_min_interval", 0)
+        stop_event = threading.Event()
+
+        def side_effect_transfer_cycle(client, hpc_server, run_file, post_transfer_workers, scheduler):
+            if mock_cycle.call_count == 2:
+                stop_event.set()
+            return True, {"bgarray": {"run": {}}}
+
+        mock_cycle = mocker.patch("rsync_to_rdisc.transfer_cycle", side_effect=side_effect_transfer_cycle)
+        rsync_to_rdisc.run_daemon(run_file, stop_event)
+        assert mock_connect.call_count == 2
+
+    def test_rank_servers_every_cycle(self, tmp_path, mocker):
+        run_file = rsync_to_rdisc.check_daemon_running(tmp_path)
+        client = mocker.MagicMock()
+        mocker.patch("rsync_to_rdisc.connect_to_best_server", return_value=(client, ["hpct04", "hpct05"]))
+        mocker.patch("rsync_to_rdisc.signal.signal")
+        mocker.patch.object(rsync_to_rdisc.settings, "daemon_min_interval", 0)
+        stop_event = threading.Event()
+
+        def side_effect_transfer_cycle(client, hpc_server, run_file, post_transfer_workers, scheduler):
+            if mock_cycle.call_count == 2:
+                stop_event.set()
+            return True, {"bgarray": {"run": {}}}
+
+        mock_cycle = mocker.patch("rsync_to_rdisc.transfer_cycle", side_effect=side_effect_transfer_cycle)
+        rsync_to_rdisc.run_daemon(run_file, stop_event)
+        # Connected server stays first for discovery, other servers follow the new ranking.
+        assert mock_cycle.call_args_list[0][0][1] == ["hpct04", "hpct05"]
+        assert mock_cycle.call_args_list[1][0][1] == ["hpct04", "hpct05"]
+
+    def test_lost_connection(self, tmp_path, mocker):
+        run_file = rsync_to_rdisc.check_daemon_running(tmp_path)
+        client = mocker.MagicMock()
+        mocker.patch("rsync_to_rdisc.connect_to_best_server", return_value=(client, ["hpct04"]))
+        mocker.patch("rsync_to_rdisc.signal.signal")
+        mocker.patch.object(rsync_to_rdisc.settings, "daemon_min_interval", 0)
+        mocker.patch.object(rsync_to_rdisc.settings, "daemon_max_interval", 0)
+        stop_event = threading.Event()
+
+        def side_effect_transfer_cycle(client, hpc_server, run_file, post_transfer_workers, scheduler):
+            if mock_cycle.call_count == 1:
+                # Connection lost during discovery, run file is removed before sys.exit.
+                rsync_to_rdisc.release_run_file(run_file, remove_run_file=True)
+                raise SystemExit("HPC connection ConnectionResetError/TimeoutError")
+            stop_event.set()
+            return True, {}
+
+        mock_cycle = mocker.patch("rsync_to_rdisc.transfer_cycle", side_effect=side_effect_transfer_cycle)
+        rsync_to_rdisc.run_daemon(run_file, stop_event)
+        # Daemon continues with a new connection and a new lock on the run file.
+        assert mock_cycle.call_count == 2
+        assert client.close.call_count == 2
+        assert not run_file.exists()
+
+
+class TestMetrics:
+    @pytest.fixture(autouse=True)
+    def metrics(self, mocker):
+        return mocker.patch("rsync_to_rdisc.metrics", rsync_to_rdisc.Metrics())
+
+    def test_render(self, metrics):
+        metrics.set("rsync_to_rdisc_mount_available", 1, {"mount": "bgarray"})
+        metrics.inc("rsync_to_rdisc_rsync_transferred_bytes", 100, {"transfer": "Exomes"})
+        metrics.inc("rsync_to_rdisc_rsync_transferred_bytes", 50, {"transfer": "Exomes"})
+        metrics.observe("rsync_to_rdisc_discovery_duration_seconds", 1.5)
+        metrics.observe("rsync_to_rdisc_discovery_duration_seconds", 0.5)
+        assert metrics.render() == (
+            "# HELP rsync_to_rdisc_rsync_transferred_bytes Bytes transferred by rsync.\n"
+            "# TYPE rsync_to_rdisc_rsync_transferred_bytes counter\n"
+            'rsync_to_rdisc_rsync_transferred_bytes_total{transfer="Exomes"} 150\n'
+            "# HELP rsync_to_rdisc_discovery_duration_seconds Duration of the remote discovery command.\n"
+            "# TYPE rsync_to_rdisc_discovery_duration_seconds summary\n"
+            "rsync_to_rdisc_discovery_duration_seconds_sum 2.0\n"
+            "rsync_to_rdisc_discovery_duration_seconds_count 2\n"
+            "# HELP rsync_to_rdisc_mount_available Mount point available in the last transfer cycle.\n"
+            "# TYPE rsync_to_rdisc_mount_available gauge\n"
+            'rsync_to_rdisc_mount_available{mount="bgarray"} 1\n'
+        )
+
+    def test_write_metrics_textfile(self, tmp_path, metrics):
+        metrics.set("rsync_to_rdisc_last_successful_cycle_timestamp_seconds", 1)
+        rsync_to_rdisc.write_metrics_textfile(f"{tmp_path}/rsync_to_rdisc.prom")
+        assert Path(f"{tmp_path}/rsync_to_rdisc.prom").read_text() == metrics.render()
+        assert os.listdir(tmp_path) == ["rsync_to_rdisc.prom"]
+
+    def test_metrics_server(self, metrics):
+        metrics.set("rsync_to_rdisc_runs_pending", 2, {"transfer": "Exomes"})
+        metrics_server = rsync_to_rdisc.start_metrics_server("127.0.0.1", 0)
+        try:
+            url = f"http://127.0.0.1:{metrics_server.server_port}"
+            assert urlopen(f"{url}/metrics").read().decode() == metrics.render()
+            with pytest.raises(HTTPError):
+                urlopen(f"{url}/other")
+        finally:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+
+    def test_mount_available(self, set_up_test, metrics):
+        rsync_to_rdisc.is_mount_available("bgarray", set_up_test["tmp_path"], set_up_test["run_file"])
+        assert metrics.get("rsync_to_rdisc_mount_available", {"mount": "bgarray"}) == 1
+
+    def test_vcf_upload(self, mocker, metrics):
+        mocker.patch.object(subprocess, "run", return_value=subprocess.CompletedProcess([], 1, stdout="Error\n"))
+        rsync_to_rdisc.run_vcf_upload("file.vcf", "VCF_FILE", "run")
+        assert metrics.get("rsync_to_rdisc_vcf_upload_failures", {"vcf_type": "VCF_FILE"}) == 1
+        assert metrics.get("rsync_to_rdisc_vcf_upload_duration_seconds", {"vcf_type": "VCF_FILE"})[1] == 1
+
+
+class TestNotifier:
+    @pytest.fixture
+    def mock_email_sender(self, tmp_path, mocker):
+        mocker.patch.object(rsync_to_rdisc.settings, "template_cache_dir", f"{tmp_path}/template_cache")
+        mock_email_sender = mocker.patch("redmail.EmailSender").return_value
+        mock_email_sender.connection = None
+        mock_email_sender.connect.side_effect = lambda: setattr(mock_email_sender, "connection", "smtp")
+        mock_email_sender.close.side_effect = lambda: setattr(mock_email_sender, "connection", None)
+        type(mock_email_sender).is_alive = property(lambda email_sender: email_sender.connection is not None)
+        return mock_email_sender
+
+    def test_session(self, mock_email_sender, mocker):
+        notifier = rsync_to_rdisc.Notifier()
+        with notifier.session():
+            notifier.send("subject1", "lost_hpc.html", {})
+            notifier.send("subject2", "lost_hpc.html", {})
+            templates = notifier.email_sender.templates_html
+            # Template environment and SMTP connection are shared by all emails of the session.
+            with notifier.session():
+                notifier.send("subject3", "lost_hpc.html", {})
+            assert notifier.email_sender.templates_html is templates
+            mock_email_sender.close.assert_not_called()
+        assert mock_email_sender.send.call_count == 3
+        mock_email_sender.connect.assert_called_once()
+        mock_email_sender.close.assert_called_once()
+
+    def test_reconnect(self, mock_email_sender):
+        notifier = rsync_to_rdisc.Notifier()
+        mock_email_sender.send.side_effect = [smtplib.SMTPServerDisconnected, None]
+        with notifier.session():
+            notifier.send("subject1", "lost_hpc.html", {})
+        assert mock_email_sender.send.call_count == 2
+        assert mock_email_sender.connect.call_count == 2
+
+    def test_digest(self, mocker):
+        mocker.patch.object(rsync_to_rdisc.settings, "email_digest", True)
+        mocker.patch.object(rsync_to_rdisc.settings, "email_digest_interval", 3600)
+        mocker.patch("rsync_to_rdisc.notifier", rsync_to_rdisc.Notifier())
+        mock_send_email = mocker.patch("rsync_to_rdisc.send_email")
+        with rsync_to_rdisc.notifier.session():
+            rsync_to_rdisc.send_mail_transfer_state("/hpc/Exomes/run1", "ok", upload_result_gatk=["ok"])
+            rsync_to_rdisc.send_mail_transfer_state("/hpc/Exomes/run2", "vcf_upload_warning")
+            rsync_to_rdisc.send_mail_transfer_state("/hpc/Exomes/run3", "vcf_upload_error")
+        # Errors are sent immediately, completed transfers are collected until the digest interval has passed.
+        mock_send_email.assert_called_once()
+        assert "ERROR" in mock_send_email.call_args[0][0]
+        rsync_to_rdisc.notifier.send_digest()
+        assert mock_send_email.call_args[1]["template"] == "transfer_digest.html"
+        transfers = mock_send_email.call_args[1]["body_params"]["transfers"]
+        assert [transfer["filename"] for transfer in transfers] == ["/hpc/Exomes/run1", "/hpc/Exomes/run2"]
+        assert transfers[0]["upload_result_gatk"] == ["ok"]
+        rsync_to_rdisc.notifier.send_digest()
+        assert mock_send_email.call_count == 2
+
+    def test_digest_template(self, tmp_path, mocker):
+        mocker.patch.object(rsync_to_rdisc.settings, "template_cache_dir", str(tmp_path))
+        template = rsync_to_rdisc.get_template_environment().get_template("transfer_digest.html")
+        metrics = rsync_to_rdisc.parse_rsync_stats(RSYNC_STATS, 100)
+        html = template.render(transfers=[{"subject": "COMPLETED: run1", "metrics": metrics, "upload_result_gatk": ["ok"]}])
+        assert "COMPLETED: run1" in html
+        assert "Alissa upload GATK: ok" in html
+        # Compiled template is cached on disk for the next transfer process.
+        assert list(tmp_path.iterdir())
+
+    def test_alert_interval(self, tmp_path):
+        transferred_runs = rsync_to_rdisc.TransferredRuns(tmp_path)
+        with freeze_time("2025-01-01 12:00:00"):
+            assert transferred_runs.set_alert("mount_full:/mnt/bgarray/", interval=3600)
+            assert not transferred_runs.set_alert("mount_full:/mnt/bgarray/", interval=3600)
+        with freeze_time("2025-01-01 13:00:00"):
+            assert transferred_runs.set_alert("mount_full:/mnt/bgarray/", interval=3600)
+            assert not transferred_runs.set_alert("mount_full:/mnt/bgarray/")
+
 
 class TestIsMountAvailable:
     def test_mount_exists(self, set_up_test, mock_send_mail_lost_mount):
@@ -210,23 +736,464 @@ class TestIsMountAvailable:
         mock_send_mail_lost_mount.reset_mock()
         mock_sys_exit.reset_mock()
 
+    def test_probe_timeout(self, tmp_path, mocker, mock_send_mail_lost_mount):
+        mocker.patch.dict(rsync_to_rdisc.mount_probes, clear=True)
+        mocker.patch.object(rsync_to_rdisc.settings, "wkdir", tmp_path)
+        mocker.patch.object(rsync_to_rdisc.settings, "mount_probe_timeout", 0.1)
+        release = threading.Event()
+        mock_probe = mocker.patch("rsync_to_rdisc.probe_mount", side_effect=lambda mount_path, output_dirs: release.wait(5))
+        started = time.monotonic()
+        assert not rsync_to_rdisc.is_mount_available("bgarray", tmp_path, "run_file")
+        # A blocked probe is not started again and the lost mount mail is only sent once.
+        assert not rsync_to_rdisc.is_mount_available("bgarray", tmp_path, "run_file")
+        assert time.monotonic() - started < 1
+        mock_probe.assert_called_once()
+        mock_send_mail_lost_mount.assert_called_once_with("bgarray", "run_file")
+        release.set()
+        mock_send_mail_lost_mount.reset_mock()
+
+    def test_probe_ttl(self, tmp_path, mocker, mock_send_mail_lost_mount):
+        mocker.patch.dict(rsync_to_rdisc.mount_probes, clear=True)
+        mocker.patch.object(rsync_to_rdisc.settings, "wkdir", tmp_path)
+        mock_probe = mocker.patch("rsync_to_rdisc.probe_mount", side_effect=[False, True])
+        assert not rsync_to_rdisc.is_mount_available("bgarray", tmp_path, "run_file")
+        assert not rsync_to_rdisc.is_mount_available("bgarray", tmp_path, "run_file")
+        assert mock_probe.call_count == 1
+        mocker.patch.object(rsync_to_rdisc.settings, "mount_probe_ttl", 0)
+        assert rsync_to_rdisc.is_mount_available("bgarray", tmp_path, "run_file")
+        mock_send_mail_lost_mount.assert_called_once()
+        # Mail is sent again when the mount is lost again.
+        assert rsync_to_rdisc.get_transferred_runs(tmp_path).set_alert("lost_mount:bgarray")
+        mock_send_mail_lost_mount.reset_mock()
+
+    def test_probe_mount(self, tmp_path, mocker):
+        (tmp_path / "Illumina/Exomes").mkdir(parents=True)
+        mock_write_text = mocker.spy(rsync_to_rdisc.Path, "write_text")
+        assert rsync_to_rdisc.probe_mount(tmp_path, ["Illumina/Genomes/", "Illumina/Exomes/"])
+        # Probe file is written in an existing output directory and removed.
+        assert mock_write_text.call_args[0][0].parent == tmp_path / "Illumina/Exomes"
+        assert not list((tmp_path / "Illumina/Exomes").iterdir())
+        # Without output directories the mount is only listed.
+        assert rsync_to_rdisc.probe_mount(tmp_path)
+        assert mock_write_text.call_count == 1
+        assert not rsync_to_rdisc.probe_mount(tmp_path / "missing")
+
 
 class TestGetTransferredRuns:
     def test_get(self, set_up_test):
+        # Imported from legacy transferred_runs.txt
         transferred_runs = rsync_to_rdisc.get_transferred_runs(rsync_to_rdisc.settings.wkdir)
-        assert transferred_runs == {set_up_test["analysis1"]}
+        assert set_up_test["analysis1"] in transferred_runs
+        assert f"{set_up_test['run']}_2" not in transferred_runs
+        assert transferred_runs is rsync_to_rdisc.get_transferred_runs(rsync_to_rdisc.settings.wkdir)
+
+    def test_empty_transferred_runs(self, tmp_path):
+        transferred_runs = rsync_to_rdisc.get_transferred_runs(tmp_path)
+        assert not transferred_runs.list()
+        assert Path(tmp_path / "transferred_runs.db").exists()
+        assert not Path(tmp_path / "transferred_runs.txt").exists()
+
+
+class TestTransferredRuns:
+    def test_import_legacy_file(self, tmp_path):
+        Path(tmp_path / "transferred_runs.txt").write_text("run1_RAW_data\tok\nrun2_Exomes\tvcf_upload_error\nrun3_unknown\n")
+        transferred_runs = rsync_to_rdisc.TransferredRuns(tmp_path)
+        assert transferred_runs.get("run1_RAW_data")["name"] == "RAW_data"
+        assert transferred_runs.get("run2_Exomes")["state"] == "vcf_upload_error"
+        assert transferred_runs.get("run3_unknown")["run"] == "run3_unknown"
+        transferred_runs.close()
+
+        # Imported only once, e.g. reset runs are not imported again.
+        transferred_runs = rsync_to_rdisc.TransferredRuns(tmp_path)
+        assert transferred_runs.reset("run1_RAW_data")
+        transferred_runs.close()
+        transferred_runs = rsync_to_rdisc.TransferredRuns(tmp_path)
+        assert "run1_RAW_data" not in transferred_runs
+        assert "run2_Exomes" in transferred_runs
+
+    def test_add_metrics_column(self, tmp_path):
+        connection = rsync_to_rdisc.sqlite3.connect(str(tmp_path / "transferred_runs.db"))
+        connection.execute(
+            "CREATE TABLE transferred_runs (run_key TEXT PRIMARY KEY, run TEXT, name TEXT, state TEXT, "
+            "started TEXT, finished TEXT, bytes INTEGER, duration REAL)"
+        )
+        connection.execute("INSERT INTO transferred_runs VALUES ('run1_Exomes', 'run1', 'Exomes', 'ok', '', '', 1, 1.0)")
+        connection.commit()
+        connection.close()
+        transferred_runs = rsync_to_rdisc.TransferredRuns(tmp_path)
+        assert transferred_runs.get("run1_Exomes")["metrics"] is None
+        transferred_runs.set_state("run2", "Exomes", "ok", metrics={"transferred_bytes": 1})
+        assert transferred_runs.get("run2_Exomes")["metrics"] == {"transferred_bytes": 1}
+
+    def test_set_state_list_reset(self, tmp_path):
+        transferred_runs = rsync_to_rdisc.TransferredRuns(tmp_path)
+        transferred_runs.set_state("run1", "Exomes", "ok", "2025-01-01T13:00:00", "2025-01-01T14:00:00", 100, 3600.0)
+        transferred_runs.set_state("run2", "Exomes", "vcf_upload_error")
+        assert "run1_Exomes" in transferred_runs
+        assert transferred_runs.get("run1_Exomes") == {
+            "run_key": "run1_Exomes",
+            "run": "run1",
+            "name": "Exomes",
+            "state": "ok",
+            "started": "2025-01-01T13:00:00",
+            "finished": "2025-01-01T14:00:00",
+            "bytes": 100,
+            "duration": 3600.0,
+            "metrics": None,
+        }
+        assert [run["run_key"] for run in transferred_runs.list("vcf_upload_error")] == ["run2_Exomes"]
+        assert transferred_runs.reset("run2_Exomes")
+        assert not transferred_runs.reset("run2_Exomes")
+        assert [run["run_key"] for run in transferred_runs.list()] == ["run1_Exomes"]
+
+
+class TestPostTransferWorkers:
+    transfer_settings = {
+        "name": "Exomes",
+        "input": "/hpc/Exomes/",
+        "output": "Illumina/Exomes/",
+        "upload_gatk_vcf": True,
+        "upload_exomedepth_vcf": True,
+    }
+
+    def test_metrics(self, tmp_path, mocker):
+        mocker.patch("rsync_to_rdisc.upload_gatk_vcf", return_value=("ok", []))
+        mocker.patch("rsync_to_rdisc.upload_exomedepth_vcf", return_value=("ok", []))
+        mock_send_mail = mocker.patch("rsync_to_rdisc.send_mail_transfer_state")
+        metrics = rsync_to_rdisc.parse_rsync_stats(RSYNC_STATS, 100)
+        transferred_runs = rsync_to_rdisc.TransferredRuns(tmp_path)
+        transferred_runs.set_state("run1", "Exomes", "transferred", transferred_bytes=10000000000, metrics=metrics)
+        workers = rsync_to_rdisc.PostTransferWorkers(transferred_runs, 1)
+        workers.submit("run1", self.transfer_settings)
+        workers.close()
+        assert mock_send_mail.call_args[1]["metrics"] == metrics
+        assert transferred_runs.get("run1_Exomes")["metrics"] == metrics
+        assert transferred_runs.get("run1_Exomes")["bytes"] == 10000000000
+
+    def test_submit(self, tmp_path, mocker):
+        mocker.patch("rsync_to_rdisc.upload_gatk_vcf", return_value=("ok", ["gatk"]))
+        mocker.patch("rsync_to_rdisc.upload_exomedepth_vcf", return_value=("warning", ["warning"]))
+        mock_send_mail = mocker.patch("rsync_to_rdisc.send_mail_transfer_state")
+        transferred_runs = rsync_to_rdisc.TransferredRuns(tmp_path)
+        transferred_runs.set_state("run1", "Exomes", "transferred")
+        workers = rsync_to_rdisc.PostTransferWorkers(transferred_runs, 2)
+        workers.submit("run1", self.transfer_settings)
+        workers.close()
+        mock_send_mail.assert_called_once_with(
+            filename="/hpc/Exomes/run1",
+            state="vcf_upload_warning",
+            upload_result_gatk=["gatk"],
+            upload_result_exomedepth=["warning"],
+            metrics=None,
+            verify_result=None,
+        )
+        assert transferred_runs.get("run1_Exomes")["state"] == "vcf_upload_warning"
+        assert not transferred_runs.list_jobs()
+
+    def test_resume(self, tmp_path, mocker):
+        mock_gatk = mocker.patch("rsync_to_rdisc.upload_gatk_vcf")
+        mocker.patch("rsync_to_rdisc.upload_exomedepth_vcf", return_value=("ok", ["exomedepth"]))
+        mock_send_mail = mocker.patch("rsync_to_rdisc.send_mail_transfer_state")
+        transferred_runs = rsync_to_rdisc.TransferredRuns(tmp_path)
+        transferred_runs.set_state("run1", "Exomes", "transferred")
+        # Job interrupted after the GATK upload.
+        transferred_runs.add_job("run1", self.transfer_settings)
+        transferred_runs.claim_job()
+        transferred_runs.update_job("run1_Exomes", "running", {"upload_gatk_vcf": ["error", ["gatk error"]]})
+        transferred_runs.close()
+
+        transferred_runs = rsync_to_rdisc.TransferredRuns(tmp_path)
+        rsync_to_rdisc.PostTransferWorkers(transferred_runs, 1).close()
+        mock_gatk.assert_not_called()
+        assert mock_send_mail.call_args[1]["state"] == "vcf_upload_error"
+        assert mock_send_mail.call_args[1]["upload_result_gatk"] == ["gatk error"]
+        assert transferred_runs.get("run1_Exomes")["state"] == "vcf_upload_error"
+
+    def test_failed(self, tmp_path, mocker):
+        mocker.patch("rsync_to_rdisc.upload_gatk_vcf", side_effect=FileNotFoundError)
+        mock_send_mail = mocker.patch("rsync_to_rdisc.send_mail_transfer_state")
+        transferred_runs = rsync_to_rdisc.TransferredRuns(tmp_path)
+        transferred_runs.set_state("run1", "Exomes", "transferred")
+        workers = rsync_to_rdisc.PostTransferWorkers(transferred_runs, 1)
+        workers.submit("run1", self.transfer_settings)
+        workers.close()
+        mock_send_mail.assert_not_called()
+        assert transferred_runs.list_jobs() == [{"run_key": "run1_Exomes", "status": "failed", "steps": {}}]
+        assert transferred_runs.get("run1_Exomes")["state"] == "transferred"
+        # Failed job is started again without a new transfer, only failed jobs can be retried.
+        assert transferred_runs.retry_job("run1_Exomes")
+        assert not transferred_runs.retry_job("run1_Exomes")
+        assert transferred_runs.list_jobs() == [{"run_key": "run1_Exomes", "status": "pending", "steps": {}}]
+
+    def test_verify_error(self, tmp_path, mocker):
+        mock_gatk = mocker.patch("rsync_to_rdisc.upload_gatk_vcf")
+        mock_verify = mocker.patch("rsync_to_rdisc.verify_run_folder", return_value=("error", ["file1 checksum differs"]))
+        mock_send_mail = mocker.patch("rsync_to_rdisc.send_mail_transfer_state")
+        transferred_runs = rsync_to_rdisc.TransferredRuns(tmp_path)
+        transferred_runs.set_state("run1", "Exomes", "transferred")
+        workers = rsync_to_rdisc.PostTransferWorkers(transferred_runs, 1)
+        mock_remote_checksums = mocker.patch("rsync_to_rdisc.get_remote_checksums", return_value={"file1": "abc"})
+        workers.submit("run1", dict(self.transfer_settings, verify="remote"))
+        workers.close()
+        # Checksums on the HPC are calculated by the post transfer worker.
+        mock_remote_checksums.assert_called_once_with("run1", mocker.ANY, "Illumina/Exomes//run1")
+        mock_verify.assert_called_once_with("Illumina/Exomes//run1", mocker.ANY, {"file1": "abc"})
+        # VCF files of a run that does not match its checksums are not uploaded.
+        mock_gatk.assert_not_called()
+        assert mock_send_mail.call_args[1]["state"] == "verify_error"
+        assert mock_send_mail.call_args[1]["verify_result"] == ["file1 checksum differs"]
+        assert transferred_runs.get("run1_Exomes")["state"] == "verify_error"
+
+    def test_mount_path(self, tmp_path, mocker):
+        # Run folder is on the mount, not relative to the working directory of the transfer process.
+        mock_verify = mocker.patch("rsync_to_rdisc.verify_run_folder", return_value=("ok", ["1 files verified"]))
+        mock_gatk = mocker.patch("rsync_to_rdisc.upload_gatk_vcf", return_value=("ok", []))
+        mocker.patch("rsync_to_rdisc.upload_exomedepth_vcf", return_value=("ok", []))
+        mocker.patch("rsync_to_rdisc.send_mail_transfer_state")
+        transferred_runs = rsync_to_rdisc.TransferredRuns(tmp_path)
+        workers = rsync_to_rdisc.PostTransferWorkers(transferred_runs, 1)
+        workers.submit("run1", dict(self.transfer_settings, verify="manifest"), {"mount_path": f"{tmp_path}/mnt"})
+        workers.close()
+        assert mock_verify.call_args[0][0] == f"{tmp_path}/mnt/Illumina/Exomes//run1"
+        assert mock_gatk.call_args[1]["run_folder"] == f"{tmp_path}/mnt/Illumina/Exomes//run1"
+
+
+class TestVerifyRunFolder:
+    @pytest.fixture
+    def run_folder(self, tmp_path):
+        Path(f"{tmp_path}/Data").mkdir()
+        Path(f"{tmp_path}/Data/file1.txt").write_text("file1")
+        Path(f"{tmp_path}/file2.txt").write_text("file2")
+        return tmp_path
+
+    def test_parse_md5sums(self):
+        md5sums = "826e8142e6baabe8af779f5f490cf5f5  ./Data/file1.txt\n1c1c96fd2cf8330db0bfa936ce82f3b9 *file2.txt\n\n"
+        assert rsync_to_rdisc.parse_md5sums(md5sums) == {
+            "Data/file1.txt": "826e8142e6baabe8af779f5f490cf5f5",
+            "file2.txt": "1c1c96fd2cf8330db0bfa936ce82f3b9",
+        }
+
+    def test_manifest_ok(self, run_folder, mocker):
+        mocker.patch("rsync_to_rdisc.settings.verify_read_size", 2)
+        Path(f"{run_folder}/md5sum.txt").write_text(
+            "826e8142e6baabe8af779f5f490cf5f5  ./Data/file1.txt\n1c1c96fd2cf8330db0bfa936ce82f3b9  file2.txt\n"
+        )
+        assert rsync_to_rdisc.verify_run_folder(run_folder, {"verify": "manifest"}) == ("ok", ["2 files verified"])
+
+    def test_manifest_error(self, run_folder):
+        Path(f"{run_folder}/checksums.md5").write_text(
+            "00000000000000000000000000000000  Data/file1.txt\n"
+            "1c1c96fd2cf8330db0bfa936ce82f3b9  file2.txt\n"
+            "1c1c96fd2cf8330db0bfa936ce82f3b9  file3.txt\n"
+        )
+        verify_state, verify_result = rsync_to_rdisc.verify_run_folder(
+            run_folder, {"verify": "manifest", "verify_manifest": "checksums.md5"}
+        )
+        assert verify_state == "error"
+        assert verify_result == ["file3.txt missing", "Data/file1.txt checksum differs"]
+
+    def test_manifest_missing(self, run_folder):
+        assert rsync_to_rdisc.verify_run_folder(run_folder, {"verify": "manifest"}) == ("error", ["md5sum.txt not found"])
+
+    def test_remote(self, run_folder):
+        remote_checksums = {
+            "Data/file1.txt": "826e8142e6baabe8af779f5f490cf5f5",
+            "file2.txt": "1c1c96fd2cf8330db0bfa936ce82f3b9",
+        }
+        assert rsync_to_rdisc.verify_run_folder(run_folder, {"verify": "remote"}, remote_checksums)[0] == "ok"
+        assert rsync_to_rdisc.verify_run_folder(run_folder, {"verify": "remote"}, None) == (
+            "error",
+            ["Checksums on the HPC could not be calculated"],
+        )
+        # A file without checksum, e.g. md5sum on the HPC could not read it.
+        del remote_checksums["file2.txt"]
+        assert rsync_to_rdisc.verify_run_folder(run_folder, {"verify": "remote"}, remote_checksums) == (
+            "error",
+            ["file2.txt not found on the HPC"],
+        )
 
-    def test_empty_transferred_runs(self, set_up_test, mocker):
-        mock_touch = mocker.patch("rsync_to_rdisc.Path.touch")
-        transferred_runs = rsync_to_rdisc.get_transferred_runs(f"{set_up_test['tmp_path']}/empty/")
-        assert not transferred_runs  # Empty set
-        mock_touch.assert_called_once_with(Path(f"{set_up_test['tmp_path']}/empty/transferred_runs.txt"))
+    def test_get_remote_checksums(self, run_folder, mocker):
+        mocker.patch.object(rsync_to_rdisc.settings, "server", ["hpct04", "hpct05"])
+        mocker.patch.object(rsync_to_rdisc.settings, "ssh_command_timeout", 300)
+        mocker.patch.object(rsync_to_rdisc.settings, "verify_remote_rate", 1)
+        mock_client = mocker.patch("rsync_to_rdisc.get_ssh_client").return_value
+        mock_client.exec_command.return_value = (None, BytesIO(b"826e8142e6baabe8af779f5f490cf5f5  file2.txt\n"), None)
+        # First node is not reachable.
+        mock_client.connect.side_effect = [OSError, None]
+        checksums = rsync_to_rdisc.get_remote_checksums("run1", {"input": "/hpc/RAW_data/"}, run_folder)
+        assert checksums == {"file2.txt": "826e8142e6baabe8af779f5f490cf5f5"}
+        assert mock_client.connect.call_args[0][0] == "hpct05"
+        # Only the transferred files are hashed, the timeout is scaled to the size of the run (10 bytes).
+        mock_client.exec_command.assert_called_once_with(
+            "cd /hpc/RAW_data//run1 && md5sum -- Data/file1.txt file2.txt", timeout=310
+        )
+        mock_client.connect.side_effect = OSError
+        assert rsync_to_rdisc.get_remote_checksums("run1", {"input": "/hpc/RAW_data/"}, run_folder) is None
+
+    def test_get_md5sum_cmds(self):
+        assert rsync_to_rdisc.get_md5sum_cmds("/hpc/run1", ["file 1", "file2", "file3"], max_length=39) == [
+            "cd /hpc/run1 && md5sum -- 'file 1'",
+            "cd /hpc/run1 && md5sum -- file2 file3",
+        ]
+
+
+class TestStartup:
+    # Modules loaded when needed: sending email, or ssh with paramiko.
+    heavy_modules = ["paramiko.transport", "jinja2.environment", "redmail.email"]
+
+    def run_python(self, code):
+        started = time.monotonic()
+        result = subprocess.run(
+            [sys.executable, "-c", code], cwd=Path(__file__).parent, stdout=subprocess.PIPE, encoding="UTF-8", check=True
+        )
+        return json.loads(result.stdout), time.monotonic() - started
+
+    def test_import(self):
+        loaded, duration = self.run_python(
+            f"import json, sys, rsync_to_rdisc; print(json.dumps([m for m in {self.heavy_modules} if m in sys.modules]))"
+        )
+        assert loaded == []
+        assert duration < 2
+
+    def test_transfer_running(self, tmp_path):
+        # Cron start while a transfer is still running or transfers are blocked, exits without loading heavy modules.
+        Path(f"{tmp_path}/transfer.running").write_text(rsync_to_rdisc.RUN_FILE_BLOCKED)
+        loaded, duration = self.run_python(
+            "import json, sys, rsync_to_rdisc\n"
+            f"rsync_to_rdisc.settings.wkdir = '{tmp_path}'\n"
+            "try:\n"
+            "    rsync_to_rdisc.main([])\n"
+            "except SystemExit:\n"
+            f"    print(json.dumps([m for m in {self.heavy_modules} if m in sys.modules]))\n"
+        )
+        assert loaded == []
+        assert duration < 2
+
+
+class TestPlan:
+    transfer_settings = {
+        "name": "Exomes",
+        "input": "/hpc/Exomes/",
+        "output": "Exomes/",
+        "files_required": ["workflow.done"],
+        "priority": 10,
+    }
+
+    def test_get_dry_run_sizes(self, mocker, fake_process):
+        mocker.patch.object(rsync_to_rdisc.settings, "user", "user")
+        fake_process.register(
+            ["rsync", fake_process.any()],
+            stdout=["run1/\t4096", "run1/file1.vcf\t1000", "run1/QC/file2.txt\t500", "run2/file3.vcf\t2000", "", "Total: 3"],
+        )
+        dry_run_sizes = rsync_to_rdisc.get_dry_run_sizes("hpct04", ["run1", "run2"], self.transfer_settings, "/mnt/bgarray/")
+        assert dry_run_sizes == {"run1": 1500, "run2": 2000}
+        dry_run_cmd = fake_process.calls[0]
+        assert "--dry-run" in dry_run_cmd and "--info=progress2" not in dry_run_cmd
+        # All runs of the transfer in a single rsync, target folder of the transfer last.
+        assert list(dry_run_cmd[-3:]) == ["user@hpct04:/hpc/Exomes//run1", ":/hpc/Exomes//run2", "/mnt/bgarray//Exomes/"]
+
+    def test_get_dry_run_sizes_error(self, fake_process):
+        fake_process.register(["rsync", fake_process.any()], returncode=255)
+        assert rsync_to_rdisc.get_dry_run_sizes("hpct04", ["run1"], self.transfer_settings, "/mnt/bgarray/") is None
+
+    def test_get_transfer_plan(self, tmp_path, mocker):
+        mocker.patch.object(rsync_to_rdisc.settings, "wkdir", str(tmp_path))
+        mocker.patch.object(
+            rsync_to_rdisc.settings,
+            "transfer_settings",
+            {"bgarray": {"mount_path": "/mnt/bgarray/", "transfers": [self.transfer_settings]}},
+        )
+        mock_folders = mocker.patch(
+            "rsync_to_rdisc.get_folders_remote_server",
+            return_value=(
+                {"bgarray": {"run1": self.transfer_settings, "run2": self.transfer_settings, "run3": self.transfer_settings}},
+                {"/hpc/Exomes//run1": [], "/hpc/Exomes//run2": [], "/hpc/Exomes//run3": ["workflow.done"]},
+            ),
+        )
+        mocker.patch(
+            "rsync_to_rdisc.get_remote_folder_sizes",
+            return_value={"/hpc/Exomes//run1": 3000, "/hpc/Exomes//run2": 2000},
+        )
+        mocker.patch("rsync_to_rdisc.get_free_bytes", return_value=2500)
+        mock_dry_run = mocker.patch("rsync_to_rdisc.get_dry_run_sizes", return_value={"run2": 1000})
+        mock_run_rsync = mocker.patch("rsync_to_rdisc.run_rsync")
+        mock_send_email = mocker.patch("rsync_to_rdisc.send_email")
+        transferred_runs = rsync_to_rdisc.get_transferred_runs(tmp_path)
+        transferred_runs.set_state("run0", "Exomes", "ok", transferred_bytes=1000, duration=10)
+        transferred_runs.set_state("run00", "Exomes", "ok", transferred_bytes=3000, duration=10)
+
+        plan = rsync_to_rdisc.get_transfer_plan("client", "hpct04")
+        assert [(run_plan["run"], run_plan["status"]) for run_plan in plan] == [
+            ("run3", "missing_files"),
+            ("run2", "transfer"),
+            ("run1", "not_enough_space"),
+        ]
+        mock_dry_run.assert_called_once_with("hpct04", ["run2"], self.transfer_settings, "/mnt/bgarray/")
+        # 1000 bytes at 200 bytes/s from the previous transfers.
+        assert plan[1]["estimated_bytes"] == 1000
+        assert plan[1]["expected_seconds"] == 5
+        assert plan[1]["rsync_cmd"] == rsync_to_rdisc.get_rsync_cmd("hpct04", "run2", self.transfer_settings, "/mnt/bgarray/")
+        assert plan[0]["missing_files"] == ["workflow.done"]
+        mock_run_rsync.assert_not_called()
+        mock_send_email.assert_not_called()
+        # The plan does not update the discovery cache or the cached folder sizes.
+        assert mock_folders.call_args[1] == {"update_cache": False}
+        assert transferred_runs.get_folder_sizes() == {}
+        transferred_runs.close()
+        rsync_to_rdisc.transferred_runs_stores.pop(str(tmp_path))
+
+    def test_main_plan(self, mocker, capsys):
+        mock_check_daemon_running = mocker.patch("rsync_to_rdisc.check_daemon_running")
+        mocker.patch("rsync_to_rdisc.rank_remote_servers", return_value=["hpct04"])
+        mock_client = mocker.MagicMock()
+        mocker.patch("rsync_to_rdisc.connect_to_remote_server", return_value=(mock_client, "hpct04"))
+        run_plan = {
+            "mount": "bgarray",
+            "transfer": "Exomes",
+            "run": "run1",
+            "status": "transfer",
+            "missing_files": [],
+            "priority": 10,
+            "remote_bytes": 2e9,
+            "estimated_bytes": 1e9,
+            "expected_seconds": 600,
+            "rsync_cmd": ["rsync", "-rahuL"],
+        }
+        mocker.patch("rsync_to_rdisc.get_transfer_plan", return_value=[run_plan])
+        rsync_to_rdisc.main(["--plan"])
+        assert "bgarray\tExomes\trun1\ttransfer\t2.0\t1.0\t10\n\trsync -rahuL\n" in capsys.readouterr().out
+        rsync_to_rdisc.main(["--plan", "--json"])
+        assert json.loads(capsys.readouterr().out) == [run_plan]
+        # The plan does not lock transfer.running.
+        mock_check_daemon_running.assert_not_called()
+        assert mock_client.close.call_count == 2
+
+
+def test_main_state(tmp_path, mocker, capsys):
+    mocker.patch.object(rsync_to_rdisc.settings, "wkdir", str(tmp_path))
+    mock_check_daemon_running = mocker.patch("rsync_to_rdisc.check_daemon_running")
+    rsync_to_rdisc.get_transferred_runs(tmp_path).set_state("run1", "Exomes", "ok")
+    rsync_to_rdisc.main(["state", "list"])
+    assert "run1_Exomes\trun1\tExomes\tok" in capsys.readouterr().out
+    rsync_to_rdisc.main(["state", "reset", "run1_Exomes", "run2_Exomes"])
+    captured = capsys.readouterr()
+    assert "Reset run1_Exomes" in captured.out
+    assert "Unknown run run2_Exomes" in captured.err
+    assert "run1_Exomes" not in rsync_to_rdisc.get_transferred_runs(tmp_path)
+    rsync_to_rdisc.main(["state", "retry", "run1_Exomes"])
+    assert "No failed job for run1_Exomes" in capsys.readouterr().err
+    mock_check_daemon_running.assert_not_called()
 
 
 class TestConnectToRemoteServer:
+    @pytest.fixture(autouse=True)
+    def paramiko_client(self, mocker):
+        mocker.patch.object(rsync_to_rdisc.settings, "ssh_control_path", None)
+
     def test_connect_ok(self, mocker, set_up_test):
         fake_ssh_client = mocker.MagicMock()
-        with mocker.patch("rsync_to_rdisc.SSHClient", return_value=fake_ssh_client):  # TODO: raises warning, should change.
+        # TODO: raises warning, should change.
+        with mocker.patch("paramiko.SSHClient", return_value=fake_ssh_client):
             rsync_to_rdisc.connect_to_remote_server("host_keys", ["hpct04", "hpct05"], "user", set_up_test["run_file"])
         fake_ssh_client.load_host_keys.assert_called_once_with("host_keys")
         fake_ssh_client.load_system_host_keys.assert_called_once()
@@ -236,10 +1203,13 @@ class TestConnectToRemoteServer:
     def test_raises_OSerror(self, mocker, set_up_test, mock_send_mail_lost_hpc, mock_sys_exit):
         fake_ssh_client = mocker.MagicMock()
         fake_ssh_client.connect.side_effect = OSError
-        with mocker.patch("rsync_to_rdisc.SSHClient", return_value=fake_ssh_client):  # TODO: raises warning, should change.
+        # TODO: raises warning, should change.
+        with mocker.patch("paramiko.SSHClient", return_value=fake_ssh_client):
             rsync_to_rdisc.connect_to_remote_server("host_keys", ["hpct04"], "user", set_up_test["run_file"])
         mock_send_mail_lost_hpc.assert_called_once_with("hpct04", set_up_test["run_file"])
         mock_sys_exit.assert_called_once_with("Connection to HPC transfer nodes are lost.")
+        # Run file blocks upcoming transfers.
+        assert Path(set_up_test["run_file"]).read_text() == rsync_to_rdisc.RUN_FILE_BLOCKED
         # Reset
         mock_send_mail_lost_hpc.reset_mock()
         mock_sys_exit.reset_mock()
@@ -249,7 +1219,8 @@ class TestConnectToRemoteServer:
     def test_raises_errors(self, side, mocker, set_up_test, mock_path_unlink, mock_sys_exit):
         fake_ssh_client = mocker.MagicMock()
         fake_ssh_client.connect.side_effect = side
-        with mocker.patch("rsync_to_rdisc.SSHClient", return_value=fake_ssh_client):  # TODO: raises warning, should change.
+        # TODO: raises warning, should change.
+        with mocker.patch("paramiko.SSHClient", return_value=fake_ssh_client):
             rsync_to_rdisc.connect_to_remote_server("host_keys", ["hpct04"], "user", set_up_test["run_file"])
         mock_sys_exit.assert_called_once_with("HPC connection timeout/SSHException/AuthenticationException")
         mock_path_unlink.assert_called_once_with(Path(set_up_test["run_file"]))
@@ -258,17 +1229,315 @@ class TestConnectToRemoteServer:
         mock_path_unlink.reset_mock()
         mock_sys_exit.reset_mock()
 
+    def test_lost_daemon(self, mocker, tmp_path, mock_send_mail_lost_hpc, mock_sys_exit):
+        mocker.patch.object(rsync_to_rdisc.settings, "wkdir", str(tmp_path))
+        run_file = rsync_to_rdisc.check_daemon_running(tmp_path)
+        fake_ssh_client = mocker.MagicMock()
+        fake_ssh_client.connect.side_effect = OSError
+        mocker.patch("paramiko.SSHClient", return_value=fake_ssh_client)
+        rsync_to_rdisc.connect_to_remote_server("host_keys", ["hpct04"], "user", run_file, block_on_lost=False)
+        mock_send_mail_lost_hpc.assert_called_once_with("hpct04", run_file)
+        mock_sys_exit.assert_called_once_with("Connection to HPC transfer nodes are lost.")
+        # Daemon keeps its lock on the run file and connects again in the next cycle.
+        assert run_file in rsync_to_rdisc.run_file_locks
+        assert run_file.read_text() == str(os.getpid())
+        rsync_to_rdisc.release_run_file(run_file, remove_run_file=True)
+        mock_send_mail_lost_hpc.reset_mock()
+        mock_sys_exit.reset_mock()
+
+
+class TestControlMasterClient:
+    @pytest.fixture(autouse=True)
+    def control_path(self, mocker):
+        mocker.patch.object(rsync_to_rdisc.settings, "ssh_control_path", "/wkdir/ssh-%C")
+
+    def test_connect_existing_master(self, fake_process):
+        fake_process.register(["ssh", fake_process.any(), "-O", "check", "user@hpct04"])
+        client = rsync_to_rdisc.ControlMasterClient()
+        client.connect("hpct04", username="user")
+        assert fake_process.call_count(["ssh", fake_process.any(), "-O", "check", "user@hpct04"]) == 1
+        assert fake_process.call_count(["ssh", fake_process.any(), "-N", "user@hpct04"]) == 0
+        assert "ControlPath=/wkdir/ssh-%C" in fake_process.calls[0]
+
+    def test_connect_new_master(self, fake_process):
+        fake_process.register(["ssh", fake_process.any(), "-O", "check", "user@hpct04"], returncode=255)
+        fake_process.register(["ssh", fake_process.any(), "-N", "user@hpct04"])
+        client = rsync_to_rdisc.ControlMasterClient()
+        client.load_host_keys("known_hosts")
+        client.connect("hpct04", username="user")
+        assert fake_process.call_count(["ssh", fake_process.any(), "-N", "user@hpct04"]) == 1
+        assert "UserKnownHostsFile=known_hosts" in fake_process.calls[1]
+        # ssh uses the first ControlMaster option, the master is started without ControlMaster=auto.
+        assert "ControlMaster=yes" in fake_process.calls[1]
+        assert "ControlMaster=auto" not in fake_process.calls[1]
+
+    @pytest.mark.parametrize(
+        "stderr,error",
+        [
+            ("ssh: connect to host hpct04 port 22: No route to host", OSError),
+            ("user@hpct04: Permission denied (publickey).", ssh_exception.AuthenticationException),
+        ],
+    )
+    def test_connect_error(self, stderr, error, fake_process):
+        fake_process.register(["ssh", fake_process.any(), "-O", "check", "user@hpct04"], returncode=255)
+        fake_process.register(["ssh", fake_process.any(), "-N", "user@hpct04"], returncode=255, stderr=stderr)
+        with pytest.raises(error):
+            rsync_to_rdisc.ControlMasterClient().connect("hpct04", username="user")
+
+    def test_exec_command(self, fake_process):
+        fake_process.register(["ssh", fake_process.any(), "-O", "check", "user@hpct04"], occurrences=2)
+        fake_process.register(["ssh", fake_process.any(), "user@hpct04", "ls /"], stdout="run1\n")
+        client = rsync_to_rdisc.ControlMasterClient()
+        client.connect("hpct04", username="user")
+        stdin, stdout, stderr = client.exec_command("ls /")
+        assert stdout.read().decode("utf8") == "run1\n"
+        assert client.get_transport().is_active()
+
+    def test_exec_command_reconnect(self, fake_process):
+        client = rsync_to_rdisc.ControlMasterClient()
+        client.destination = "user@hpct04"
+        fake_process.register(["ssh", fake_process.any(), "user@hpct04", "ls /"], returncode=255)
+        fake_process.register(["ssh", fake_process.any(), "-O", "check", "user@hpct04"], returncode=255)
+        fake_process.register(["ssh", fake_process.any(), "-N", "user@hpct04"])
+        fake_process.register(["ssh", fake_process.any(), "user@hpct04", "ls /"], stdout="run1\n")
+        stdin, stdout, stderr = client.exec_command("ls /")
+        assert stdout.read().decode("utf8") == "run1\n"
+        assert fake_process.call_count(["ssh", fake_process.any(), "-N", "user@hpct04"]) == 1
+
+    def test_exec_command_lost(self, fake_process):
+        client = rsync_to_rdisc.ControlMasterClient()
+        client.destination = "user@hpct04"
+        fake_process.register(["ssh", fake_process.any(), "user@hpct04", "ls /"], returncode=255, occurrences=2)
+        fake_process.register(["ssh", fake_process.any(), "-O", "check", "user@hpct04"], returncode=255)
+        fake_process.register(["ssh", fake_process.any(), "-N", "user@hpct04"])
+        with pytest.raises(ConnectionResetError):
+            client.exec_command("ls /")
+
+    def test_rsync_cmd(self, mocker):
+        mocker.patch.object(rsync_to_rdisc.settings, "host_keys", "")
+        rsync_cmd = rsync_to_rdisc.get_rsync_cmd(
+            "hpct04", "run1", {"name": "Exomes", "input": "/hpc/Exomes/", "output": "Exomes/"}, "/mnt/bgarray/"
+        )
+        rsh = [option for option in rsync_cmd if option.startswith("--rsh=")]
+        assert rsh == [
+            "--rsh=ssh -o BatchMode=yes -o ControlMaster=auto -o ControlPath=/wkdir/ssh-%C -o ControlPersist=600 "
+            "-o ConnectTimeout=30"
+        ]
+
+
+class TestServerSelection:
+    @pytest.mark.parametrize(
+        "scores,expected",
+        [
+            ({"hpct04": 0.2, "hpct05": 0.1}, ["hpct05", "hpct04"]),
+            ({"hpct04": 0.1, "hpct05": 0.2}, ["hpct04", "hpct05"]),
+            ({"hpct04": None, "hpct05": 0.2}, ["hpct05"]),
+            ({"hpct04": None, "hpct05": None}, []),
+        ],
+    )
+    def test_rank_remote_servers(self, scores, expected, mocker):
+        mocker.patch("rsync_to_rdisc.get_server_score", side_effect=lambda server, user, host_keys: scores[server])
+        assert rsync_to_rdisc.rank_remote_servers(["hpct04", "hpct05"], "user", "") == expected
+
+    @pytest.mark.parametrize("load_probe,load,expected", [(False, None, 0.1), (True, 0.5, 0.6), (True, None, None)])
+    def test_get_server_score(self, load_probe, load, expected, mocker):
+        mocker.patch.object(rsync_to_rdisc.settings, "server_load_probe", load_probe)
+        mocker.patch.object(rsync_to_rdisc.settings, "ssh_control_path", "/wkdir/ssh-%C")
+        mocker.patch.object(rsync_to_rdisc.settings, "server_load_weight", 1.0)
+        mocker.patch("rsync_to_rdisc.get_server_latency", return_value=0.1)
+        mocker.patch("rsync_to_rdisc.get_server_load", return_value=load)
+        assert rsync_to_rdisc.get_server_score("hpct04", "user", "") == pytest.approx(expected)
+
+    def test_get_server_latency_unreachable(self, mocker):
+        mocker.patch("rsync_to_rdisc.get_ssh_address", return_value=("hpct04", 22))
+        mocker.patch("rsync_to_rdisc.create_connection", side_effect=OSError)
+        assert rsync_to_rdisc.get_server_latency("hpct04") is None
+
+    def test_get_server_latency_ssh_config(self, mocker, fake_process):
+        fake_process.register(["ssh", "-G", "hpct04"], stdout="user user\nhostname hpct04.hpc.local\nport 2222\n")
+        mock_create_connection = mocker.patch("rsync_to_rdisc.create_connection")
+        assert rsync_to_rdisc.get_server_latency("hpct04") is not None
+        mock_create_connection.assert_called_once_with(("hpct04.hpc.local", 2222), timeout=mocker.ANY)
+
+    def test_get_ssh_address_no_ssh(self, fake_process):
+        fake_process.register(["ssh", "-G", "hpct04"], callback=lambda process: (_ for _ in ()).throw(OSError))
+        assert rsync_to_rdisc.get_ssh_address("hpct04") == ("hpct04", 22)
+
+    def test_server_pool(self):
+        server_pool = rsync_to_rdisc.ServerPool(["hpct04", "hpct05"])
+        assert server_pool.acquire() == "hpct04"
+        assert server_pool.acquire() == "hpct05"
+        assert server_pool.acquire() == "hpct04"
+        server_pool.release("hpct04")
+        server_pool.release("hpct05", failed=True)
+        assert server_pool.acquire() == "hpct04"
+        assert server_pool.acquire(exclude=["hpct04"]) is None
+
+    def test_single_failed_node(self, set_up_test, mocker):
+        server_pool = rsync_to_rdisc.ServerPool(["hpct04"])
+        server_pool.release(server_pool.acquire(), failed=True)
+        assert server_pool.acquire() is None
+        # A retried transfer is started on the failed node, not on user@None.
+        mock_rsync_cmd = mocker.patch("rsync_to_rdisc.get_rsync_cmd", return_value=["rsync"])
+        mocker.patch("rsync_to_rdisc.run_rsync", return_value=subprocess.CompletedProcess(["rsync"], 0, "", ""))
+        subprocess_result = rsync_to_rdisc.rsync_with_failover(
+            server_pool, "run1", {"name": "Exomes"}, set_up_test["tmp_path"], "date"
+        )
+        assert not subprocess_result.returncode
+        assert mock_rsync_cmd.call_args[0][0] == "hpct04"
+
+    def test_connect_to_best_server(self, mocker):
+        mocker.patch("rsync_to_rdisc.rank_remote_servers", return_value=["hpct05", "hpct04"])
+        mock_connect = mocker.patch("rsync_to_rdisc.connect_to_remote_server", return_value=("client", "hpct05"))
+        client, hpc_servers = rsync_to_rdisc.connect_to_best_server("run_file")
+        assert mock_connect.call_args[0][1] == ["hpct05", "hpct04"]
+        assert hpc_servers == ["hpct05", "hpct04"]
+
 
 class TestGetFoldersRemoteServer:
     def test_ok(self, set_up_test, mocker):
         stdout = mocker.MagicMock()
-        stdout.read().decode("utf8").split.return_value = ["analysis1", "analysis2"]
+        stdout.read.return_value = (
+            b"time\t1000\n0\tanalysis1\t900\t+\n0\tanalysis2\t900\t+\n1\tanalysis3\t900\t+\tworkflow.done\n"
+            b"1\tanalysis4\t900\t+\n"
+        )
+        client = mocker.MagicMock()
+        client.exec_command.return_value = "", stdout, ""
+        transfers = [
+            {"name": "Exomes", "input": "", "files_required": [""]},
+            {"name": "Genomes", "input": "/genomes", "files_required": ["workflow.done"]},
+        ]
+        mounts = {"bgarray": {"transfers": [transfers[0]]}, "glims": {"transfers": [transfers[1]]}}
+        to_transfer, missing_files = rsync_to_rdisc.get_folders_remote_server(
+            client, mounts, set_up_test["run_file"], {"analysis1_Exomes"}
+        )
+        # Single remote call for all transfers and required files.
+        client.exec_command.assert_called_once()
+        assert to_transfer == {
+            "bgarray": {"analysis2": transfers[0]},
+            "glims": {"analysis3": transfers[1], "analysis4": transfers[1]},
+        }
+        assert missing_files == {"/analysis2": [], "/genomes/analysis3": [], "/genomes/analysis4": ["workflow.done"]}
+
+    def test_same_folder_multiple_mounts(self, set_up_test, mocker):
+        stdout = mocker.MagicMock()
+        stdout.read.return_value = b"0\tRUN1\t900\t+\n1\tRUN1\t900\t+\n"
         client = mocker.MagicMock()
         client.exec_command.return_value = "", stdout, ""
-        to_transfer = rsync_to_rdisc.get_folders_remote_server(
-            client, [{"name": "Exomes", "input": ""}], set_up_test["run_file"], {set_up_test["analysis1"]}
+        # Identical transfer dicts on two mount points.
+        mounts = {
+            "bgarray": {"transfers": [{"name": "Exomes", "input": "/exomes", "files_required": [""]}]},
+            "glims": {"transfers": [{"name": "Exomes", "input": "/exomes", "files_required": [""]}]},
+        }
+        to_transfer, missing_files = rsync_to_rdisc.get_folders_remote_server(client, mounts, set_up_test["run_file"], set())
+        assert to_transfer["bgarray"]["RUN1"] is mounts["bgarray"]["transfers"][0]
+        assert to_transfer["glims"]["RUN1"] is mounts["glims"]["transfers"][0]
+
+    def test_discovery_cmd(self, set_up_test):
+        transfers = [
+            {"name": "Exomes", "input": f"{set_up_test['tmp_path']}/processed/", "files_required": ["workflow.done"]},
+            {"name": "TRANSFER", "input": f"{set_up_test['tmp_path']}/processed/", "files_required": [""]},
+            {"name": "Missing", "input": f"{set_up_test['tmp_path']}/missing/", "files_required": [""]},
+        ]
+        mtime = int(Path(f"{set_up_test['processed_run_dir']}_1").stat().st_mtime)
+        discovery_cmd = rsync_to_rdisc.get_discovery_cmd(transfers)
+        discovery_out = subprocess.run(["bash", "-c", discovery_cmd], stdout=subprocess.PIPE, encoding="UTF-8").stdout
+        lines = discovery_out.splitlines()
+        assert lines[0].startswith("time\t")
+        assert f"0\t{set_up_test['run']}_1\t{mtime}\t+\tworkflow.done" in lines
+        assert f"0\t{set_up_test['run']}_2\t{mtime}\t+" in lines
+        assert f"1\t{set_up_test['run']}_2\t{mtime}\t+" in lines
+        assert not [line for line in lines if line.startswith("2\t")]
+
+        # Required files are not checked for folders not changed since the previous discovery.
+        discovery_cmd = rsync_to_rdisc.get_discovery_cmd(transfers, mtime + 1)
+        discovery_out = subprocess.run(["bash", "-c", discovery_cmd], stdout=subprocess.PIPE, encoding="UTF-8").stdout
+        assert f"0\t{set_up_test['run']}_1\t{mtime}" in discovery_out.splitlines()
+
+        check_cmd = rsync_to_rdisc.get_check_folders_cmd(transfers, [(0, f"{set_up_test['run']}_1", mtime)])
+        check_out = subprocess.run(["bash", "-c", check_cmd], stdout=subprocess.PIPE, encoding="UTF-8").stdout
+        assert check_out == f"0\t{set_up_test['run']}_1\t{mtime}\t+\tworkflow.done\n"
+
+    def test_discovery_cache(self, tmp_path, mocker):
+        mocker.patch.object(rsync_to_rdisc.settings, "wkdir", tmp_path)
+        transfer = {"name": "Exomes", "input": "/exomes", "files_required": ["workflow.done"]}
+        mounts = {"bgarray": {"transfers": [transfer]}}
+        client = mocker.MagicMock()
+
+        def discover(*outputs):
+            client.exec_command.reset_mock()
+            client.exec_command.side_effect = [("", BytesIO(output), "") for output in outputs]
+            return rsync_to_rdisc.get_folders_remote_server(client, mounts, "run_file", set())
+
+        # First discovery checks all folders.
+        to_transfer, missing_files = discover(b"time\t1000\n0\trun1\t900\t+\n0\trun2\t900\t+\tworkflow.done\n")
+        assert "-ge 0 ]" in client.exec_command.call_args[0][0]
+        assert missing_files == {"/exomes/run1": ["workflow.done"], "/exomes/run2": []}
+
+        # Unchanged folders are not checked again, the result is taken from the cache.
+        to_transfer, missing_files = discover(b"time\t1100\n0\trun1\t900\n0\trun2\t900\n")
+        assert "-ge 940 ]" in client.exec_command.call_args[0][0]
+        assert missing_files == {"/exomes/run1": ["workflow.done"], "/exomes/run2": []}
+        client.exec_command.assert_called_once()
+
+        # Required file added to run1, changing its mtime. run3 moved into the input folder with an old mtime.
+        to_transfer, missing_files = discover(
+            b"time\t1200\n0\trun1\t1150\t+\tworkflow.done\n0\trun3\t500\n",
+            b"0\trun3\t500\t+\tworkflow.done\n",
         )
-        assert to_transfer == {"analysis1": {"name": "Exomes", "input": ""}, "analysis2": {"name": "Exomes", "input": ""}}
+        assert client.exec_command.call_count == 2
+        assert "folder=run3;" in client.exec_command.call_args[0][0]
+        assert to_transfer == {"bgarray": {"run1": transfer, "run3": transfer}}
+        assert missing_files == {"/exomes/run1": [], "/exomes/run3": []}
+        # run2 is no longer found, e.g. removed from the input folder.
+        assert set(rsync_to_rdisc.get_transferred_runs(tmp_path).get_discovery_cache()) == {
+            "/exomes/run1_Exomes",
+            "/exomes/run3_Exomes",
+        }
+
+        # Folders are checked again after discovery_cache_ttl.
+        mocker.patch.object(rsync_to_rdisc.settings, "discovery_cache_ttl", 0)
+        discover(b"time\t1300\n0\trun1\t1150\n0\trun3\t500\n", b"")
+        assert client.exec_command.call_count == 2
+
+    def test_get_remote_folder_sizes(self, set_up_test, mocker):
+        Path(f"{set_up_test['tmp_path']}/sizes/run1").mkdir(parents=True)
+        Path(f"{set_up_test['tmp_path']}/sizes/run1/file").write_bytes(b"x" * 1000)
+        remote_folders = [f"{set_up_test['tmp_path']}/sizes//run1", f"{set_up_test['tmp_path']}/sizes/missing run"]
+
+        def exec_command(command):
+            du_out = subprocess.run(["bash", "-c", command], stdout=subprocess.PIPE).stdout
+            return "", BytesIO(du_out), ""
+
+        client = mocker.MagicMock()
+        client.exec_command.side_effect = exec_command
+        folder_sizes = rsync_to_rdisc.get_remote_folder_sizes(client, remote_folders, set_up_test["run_file"])
+        client.exec_command.assert_called_once()
+        assert list(folder_sizes) == [remote_folders[0]]
+        assert folder_sizes[remote_folders[0]] >= 1000
+        assert rsync_to_rdisc.get_remote_folder_sizes(client, [], set_up_test["run_file"]) == {}
+        # Sizes are unknown when du times out, the cycle continues.
+        client.exec_command.side_effect = TimeoutError
+        assert rsync_to_rdisc.get_remote_folder_sizes(client, remote_folders, set_up_test["run_file"]) == {}
+
+    def test_get_folder_sizes(self, tmp_path, mocker):
+        mocker.patch.object(rsync_to_rdisc.settings, "wkdir", str(tmp_path))
+        exomes = {"name": "Exomes", "input": "/exomes"}
+        filtered = {"name": "RAW", "input": "/raw", "include": ["*.fastq.gz"]}
+        to_be_transferred = {"bgarray": {"run1": exomes, "run2": exomes, "run3": filtered}}
+        missing_files = {"/exomes/run1": [], "/exomes/run2": ["workflow.done"], "/raw/run3": []}
+        discovery_store = rsync_to_rdisc.get_transferred_runs(tmp_path)
+        discovery_store.update_discovery_cache({"/exomes/run1_Exomes": (100, [], 0)}, ["/exomes/run1_Exomes"], 0)
+        mock_sizes = mocker.patch("rsync_to_rdisc.get_remote_folder_sizes", return_value={"/exomes/run1": 1000})
+        # Only complete folders of transfers without include or exclude patterns are measured.
+        assert rsync_to_rdisc.get_folder_sizes("client", to_be_transferred, missing_files, None) == {"/exomes/run1": 1000}
+        assert mock_sizes.call_args[0][1] == ["/exomes/run1"]
+        # Size of an unchanged folder is cached, it is measured again after the folder changed.
+        assert rsync_to_rdisc.get_folder_sizes("client", to_be_transferred, missing_files, None) == {"/exomes/run1": 1000}
+        assert mock_sizes.call_args[0][1] == []
+        discovery_store.update_discovery_cache({"/exomes/run1_Exomes": (200, [], 0)}, ["/exomes/run1_Exomes"], 0)
+        rsync_to_rdisc.get_folder_sizes("client", to_be_transferred, missing_files, None)
+        assert mock_sizes.call_args[0][1] == ["/exomes/run1"]
 
     @pytest.mark.parametrize("side", [ConnectionResetError, TimeoutError])
     def test_errors(self, side, set_up_test, mocker, mock_path_unlink):
@@ -276,7 +1545,10 @@ class TestGetFoldersRemoteServer:
         client.exec_command.side_effect = side
         with pytest.raises(SystemExit) as system_error:
             rsync_to_rdisc.get_folders_remote_server(
-                client, [{"name": "Exomes", "input": ""}], set_up_test["run_file"], {set_up_test["analysis1"]}
+                client,
+                {"bgarray": {"transfers": [{"name": "Exomes", "input": "", "files_required": [""]}]}},
+                set_up_test["run_file"],
+                set(),
             )
         mock_path_unlink.assert_called_once_with(Path(set_up_test["run_file"]))
         assert system_error.type == SystemExit
@@ -344,6 +1616,22 @@ class TestRsyncServerRemote:
         assert f"{set_up_test['run']}_2" in mock_check.call_args[0][1]
         mock_action.assert_called_once()
 
+    def test_missing_file_from_discovery(self, set_up_test, mocker):
+        mock_check = mocker.patch("rsync_to_rdisc.check_if_file_missing")
+        mock_action = mocker.patch("rsync_to_rdisc.action_if_file_missing", return_value=False)
+        transfer_settings = rsync_to_rdisc.settings.transfer_settings["bgarray"]["transfers"][0]
+        rsync_to_rdisc.rsync_server_remote(
+            "hpct04",
+            "client",
+            {f"{set_up_test['run']}_2": transfer_settings},
+            set_up_test["tmp_path"],
+            f"{rsync_to_rdisc.settings.wkdir}/transferred_runs.txt",
+            {f"{transfer_settings['input']}/{set_up_test['run']}_2": ["workflow.done"]},
+        )
+        mock_check.assert_not_called()
+        mock_action.assert_called_once()
+        assert mock_action.call_args[0][2] == ["workflow.done"]
+
     @freeze_time("2025-01-01 13:00:00")
     def test_rsync_ok(self, set_up_test, mocker, mock_send_mail_transfer_state, fake_process):
         mock_check = mocker.patch("rsync_to_rdisc.check_if_file_missing", return_value=[])
@@ -369,7 +1657,8 @@ class TestRsyncServerRemote:
             in Path(rsync_to_rdisc.settings.log_path).read_text()
         )
         assert (
-            f"{set_up_test['run']}_3_TRANSFER\tok" in Path(f"{rsync_to_rdisc.settings.wkdir}/transferred_runs.txt").read_text()
+            rsync_to_rdisc.get_transferred_runs(rsync_to_rdisc.settings.wkdir).get(f"{set_up_test['run']}_3_TRANSFER")["state"]
+            == "ok"
         )
 
     @freeze_time("2025-01-02 13:00:00")
@@ -404,7 +1693,8 @@ class TestRsyncServerRemote:
         mock_send_mail_transfer_state.assert_called_once()
         mock_send_mail_transfer_state.reset_mock()
         assert (
-            f"{set_up_test['run']}_3_TRANSFER\tok" in Path(f"{rsync_to_rdisc.settings.wkdir}/transferred_runs.txt").read_text()
+            rsync_to_rdisc.get_transferred_runs(rsync_to_rdisc.settings.wkdir).get(f"{set_up_test['run']}_3_TRANSFER")["state"]
+            == "ok"
         )
         assert fake_process.call_count(["rsync", "-rahuL", "--stats", fake_process.any()]) == 1
         rsync_cmd = fake_process.calls[0]
@@ -421,9 +1711,207 @@ class TestRsyncServerRemote:
         # Assert number of include/exclude statements.
         assert count_include_exclude == len(value)
 
+    def test_rsync_failover(self, set_up_test, mocker, mock_send_mail_transfer_state, fake_process):
+        mocker.patch("rsync_to_rdisc.check_if_file_missing", return_value=[])
+        mock_check_rsync = mocker.patch("rsync_to_rdisc.check_rsync", return_value="ok")
+        # Connection to first node is lost, continue on the second node.
+        fake_process.register(["rsync", "-rahuL", "--stats", fake_process.any()], returncode=12, stderr=["lost"])
+        fake_process.register(["rsync", "-rahuL", "--stats", fake_process.any()])
+        rsync_to_rdisc.rsync_server_remote(
+            ["hpct04", "hpct05"],
+            "client",
+            {f"{set_up_test['run']}_4": rsync_to_rdisc.settings.transfer_settings["bgarray"]["transfers"][2]},
+            set_up_test["tmp_path"],
+            set_up_test["run_file"],
+        )
+        assert len(fake_process.calls) == 2
+        assert any("@hpct04:" in part for part in fake_process.calls[0])
+        assert any("@hpct05:" in part for part in fake_process.calls[1])
+        assert mock_check_rsync.call_args[1]["subprocess_out"].returncode == 0
+        mock_send_mail_transfer_state.reset_mock()
+
+    def test_size_order_and_free_space(self, set_up_test, mocker, mock_send_mail_transfer_state):
+        mocker.patch("rsync_to_rdisc.check_if_file_missing", return_value=[])
+        mocker.patch("rsync_to_rdisc.shutil.disk_usage", return_value=mocker.MagicMock(total=1000, free=300))
+        mocker.patch.object(rsync_to_rdisc.settings, "mount_reserved_fraction", 0.1)
+        mocker.patch.object(rsync_to_rdisc.settings, "rsync_max_workers", 1)
+        mock_transfer_run = mocker.patch("rsync_to_rdisc.transfer_run")
+        mock_send_mail_mount_full = mocker.patch("rsync_to_rdisc.send_mail_mount_full")
+        transfer_settings = {"name": "Exomes", "input": "/exomes", "files_required": [""]}
+        rsync_to_rdisc.rsync_server_remote(
+            "hpct04",
+            "client",
+            {run: transfer_settings for run in ["large", "small", "medium", "unknown"]},
+            set_up_test["tmp_path"],
+            set_up_test["run_file"],
+            folder_sizes={"/exomes/large": 150, "/exomes/small": 50, "/exomes/medium": 100},
+        )
+        # Smallest runs first, 200 bytes available after keeping 10% of the mount free.
+        assert [call[0][1] for call in mock_transfer_run.call_args_list] == ["unknown", "small", "medium"]
+        mock_send_mail_mount_full.assert_called_once_with(set_up_test["tmp_path"], [("large", 150)], 50)
+
+    def test_free_space_filtered_and_in_flight(self, set_up_test, mocker, mock_send_mail_transfer_state):
+        mocker.patch("rsync_to_rdisc.check_if_file_missing", return_value=[])
+        mocker.patch("rsync_to_rdisc.shutil.disk_usage", return_value=mocker.MagicMock(total=1000, free=300))
+        mocker.patch.object(rsync_to_rdisc.settings, "mount_reserved_fraction", 0.1)
+        mocker.patch("rsync_to_rdisc.send_mail_mount_full")
+        release = threading.Event()
+        mock_transfer_run = mocker.patch("rsync_to_rdisc.transfer_run", side_effect=lambda *args: release.wait(5))
+        transfer_settings = {"name": "Exomes", "input": "/exomes", "files_required": [""]}
+        filtered_settings = {"name": "RAW", "input": "/raw", "files_required": [""], "exclude": ["*.bam"]}
+        scheduler = rsync_to_rdisc.TransferScheduler(2)
+        for to_be_transferred in [{"run1": transfer_settings}, {"run2": transfer_settings, "run3": filtered_settings}]:
+            rsync_to_rdisc.rsync_server_remote(
+                "hpct04",
+                "client",
+                to_be_transferred,
+                set_up_test["tmp_path"],
+                set_up_test["run_file"],
+                post_transfer_workers=mocker.MagicMock(),
+                folder_sizes={"/exomes/run1": 150, "/exomes/run2": 100, "/raw/run3": 500},
+                scheduler=scheduler,
+            )
+        release.set()
+        scheduler.join()
+        # run1 is still running in the second cycle and counted as used space, run2 does not fit.
+        # The size of a transfer with include or exclude patterns is unknown, run3 is transferred.
+        assert [call[0][1] for call in mock_transfer_run.call_args_list] == ["run1", "run3"]
+        assert rsync_to_rdisc.get_available_bytes(set_up_test["tmp_path"], scheduler) == 200
+
+    def test_shared_scheduler(self, set_up_test, mocker, mock_send_mail_transfer_state):
+        mocker.patch("rsync_to_rdisc.check_if_file_missing", return_value=[])
+        release = threading.Event()
+        mock_transfer_run = mocker.patch("rsync_to_rdisc.transfer_run", side_effect=lambda *args: release.wait(5))
+        transfer_settings = {"name": "Exomes", "input": "/exomes", "files_required": [""]}
+        scheduler = rsync_to_rdisc.TransferScheduler(1)
+        for cycle in range(2):
+            # Returns without waiting for the transfer, the running transfer is not started again.
+            rsync_to_rdisc.rsync_server_remote(
+                "hpct04",
+                "client",
+                {"run1": transfer_settings},
+                set_up_test["tmp_path"],
+                set_up_test["run_file"],
+                post_transfer_workers=mocker.MagicMock(),
+                scheduler=scheduler,
+            )
+        assert scheduler.is_active("run1_Exomes")
+        release.set()
+        scheduler.join()
+        mock_transfer_run.assert_called_once()
+
+    def test_rsync_retry(self, set_up_test, mocker, mock_send_mail_transfer_state, fake_process):
+        mocker.patch("rsync_to_rdisc.check_if_file_missing", return_value=[])
+        mock_check_rsync = mocker.patch("rsync_to_rdisc.check_rsync", return_value="ok")
+        mock_sleep = mocker.patch("rsync_to_rdisc.time.sleep")
+        # Timeout and vanished source files are retried with backoff.
+        fake_process.register(["rsync", "-rahuL", "--stats", fake_process.any()], returncode=30, stderr=["timeout"])
+        fake_process.register(["rsync", "-rahuL", "--stats", fake_process.any()], returncode=24, stderr=["vanished"])
+        fake_process.register(["rsync", "-rahuL", "--stats", fake_process.any()])
+        rsync_to_rdisc.rsync_server_remote(
+            "hpct04",
+            "client",
+            {f"{set_up_test['run']}_5": rsync_to_rdisc.settings.transfer_settings["bgarray"]["transfers"][2]},
+            set_up_test["tmp_path"],
+            set_up_test["run_file"],
+        )
+        assert len(fake_process.calls) == 3
+        # The connection to the only node was lost, it is used again after backing off.
+        assert all(any("@hpct04:" in part for part in call) for call in fake_process.calls)
+        assert mock_sleep.call_args_list == [mocker.call(60), mocker.call(120)]
+        assert mock_check_rsync.call_args[1]["subprocess_out"].returncode == 0
+        assert "rsync exit code 30, retry 1/3 in 60s" in Path(rsync_to_rdisc.settings.log_path).read_text()
+        rsync_to_rdisc.event_log.flush()
+        events = [
+            json.loads(line)
+            for line in Path(rsync_to_rdisc.settings.event_log_path).read_text().splitlines()
+            if json.loads(line).get("run") == f"{set_up_test['run']}_5"
+        ]
+        assert [event["stage"] for event in events][:6] == ["rsync", "retry", "rsync", "retry", "rsync", "transfer"]
+        assert [event["result"] for event in events if event["stage"] == "rsync"] == [30, 24, 0]
+        mock_send_mail_transfer_state.reset_mock()
+
+    def test_rsync_no_retry(self, set_up_test, mocker, mock_send_mail_transfer_state, fake_process):
+        mocker.patch("rsync_to_rdisc.check_if_file_missing", return_value=[])
+        mock_check_rsync = mocker.patch("rsync_to_rdisc.check_rsync", return_value="error")
+        mock_sleep = mocker.patch("rsync_to_rdisc.time.sleep")
+        # Permanent errors, e.g. a file I/O error, are reported without retrying.
+        fake_process.register(["rsync", "-rahuL", "--stats", fake_process.any()], returncode=11, stderr=["no space"])
+        rsync_to_rdisc.rsync_server_remote(
+            "hpct04",
+            "client",
+            {f"{set_up_test['run']}_5": rsync_to_rdisc.settings.transfer_settings["bgarray"]["transfers"][2]},
+            set_up_test["tmp_path"],
+            set_up_test["run_file"],
+        )
+        assert len(fake_process.calls) == 1
+        mock_sleep.assert_not_called()
+        assert mock_check_rsync.call_args[1]["subprocess_out"].returncode == 11
+
+    @pytest.mark.parametrize("transfer_index,append_verify", [(0, False), (3, True)])
+    def test_rsync_cmd_resume(self, transfer_index, append_verify):
+        transfer_settings = rsync_to_rdisc.settings.transfer_settings["bgarray"]["transfers"][transfer_index]
+        rsync_cmd = rsync_to_rdisc.get_rsync_cmd("hpct04", "run1", transfer_settings, "/mnt/bgarray/")
+        assert "--partial-dir=.rsync-partial" in rsync_cmd
+        assert "--timeout=600" in rsync_cmd
+        assert ("--append-verify" in rsync_cmd) == append_verify
+
+    @pytest.mark.parametrize(
+        "now,expected",
+        [("2024-01-01 12:00", 1000), ("2024-01-01 19:00", None), ("2024-01-01 23:30", 4000), ("2024-01-01 05:59", 4000)],
+    )
+    def test_get_bwlimit_budget(self, now, expected):
+        windows = [{"start": "07:00", "end": "19:00", "bwlimit": 1000}, {"start": "22:00", "end": "06:00", "bwlimit": 4000}]
+        assert rsync_to_rdisc.get_bwlimit_budget(windows, datetime.strptime(now, "%Y-%m-%d %H:%M")) == expected
+        assert rsync_to_rdisc.get_bwlimit_budget(500, datetime.strptime(now, "%Y-%m-%d %H:%M")) == 500
+
+    def test_get_bwlimit(self, mocker):
+        mocker.patch.dict(rsync_to_rdisc.settings.transfer_settings["bgarray"], {"bwlimit": 9000})
+        mocker.patch.dict(rsync_to_rdisc.running_rsyncs, {"mount:/mnt/bgarray/": 1, "transfer:RAW_data": 1})
+        # Budgets are split between the rsync slots of the mount (max_parallel 3) and the transfer, the lowest share is used.
+        assert rsync_to_rdisc.get_bwlimit("/mnt/bgarray/", {"name": "Exomes"}) == 3000
+        assert rsync_to_rdisc.get_bwlimit("/mnt/bgarray/", {"name": "RAW_data", "bwlimit": 2000}) == 500
+        assert rsync_to_rdisc.get_bwlimit("/mnt/bgarray/", {"name": "RAW_data", "bwlimit": 2000, "max_parallel": 1}) == 2000
+        assert rsync_to_rdisc.get_bwlimit("/mnt/glims/", {"name": "pg_glims"}) is None
+
+    @pytest.mark.parametrize(
+        "now,expected", [("2024-01-01 12:00", 7 * 3600), ("2024-01-01 19:00", 3 * 3600), ("2024-01-01 06:30", 1800)]
+    )
+    def test_get_bwlimit_window_seconds(self, mocker, now, expected):
+        windows = [{"start": "07:00", "end": "19:00", "bwlimit": 1000}, {"start": "22:00", "end": "06:00", "bwlimit": 4000}]
+        mocker.patch.dict(rsync_to_rdisc.settings.transfer_settings["bgarray"], {"bwlimit": windows})
+        now = datetime.strptime(now, "%Y-%m-%d %H:%M")
+        assert rsync_to_rdisc.get_bwlimit_window_seconds("/mnt/bgarray/", {"name": "Exomes"}, now) == expected
+        assert rsync_to_rdisc.get_bwlimit_window_seconds("/mnt/glims/", {"name": "pg_glims"}, now) is None
+
+    def test_run_shaped_rsync(self, set_up_test, mocker):
+        # rsync stopped at the start of a bandwidth window is restarted with the bandwidth limit of the new window.
+        mocker.patch("rsync_to_rdisc.get_bwlimit_window_seconds", return_value=0.5)
+        mock_rsync_cmd = mocker.patch("rsync_to_rdisc.get_rsync_cmd", side_effect=[["sleep", "5"], ["true"]])
+        subprocess_result = rsync_to_rdisc.run_shaped_rsync("hpct04", "run1", {"name": "Exomes"}, "/mnt/bgarray/", "date")
+        assert subprocess_result.returncode == 0
+        assert mock_rsync_cmd.call_count == 2
+        assert "run1\t>>> bandwidth window changed, restart rsync <<<" in Path(rsync_to_rdisc.settings.log_path).read_text()
+        assert not +rsync_to_rdisc.running_rsyncs
+
+    def test_rsync_cmd_shaping(self, mocker):
+        mocker.patch.dict(rsync_to_rdisc.settings.transfer_settings["bgarray"], {"bwlimit": 9000})
+        transfer_settings = rsync_to_rdisc.settings.transfer_settings["bgarray"]["transfers"][3]
+        rsync_cmd = rsync_to_rdisc.get_rsync_cmd("hpct04", "run1", transfer_settings, "/mnt/bgarray/")
+        assert rsync_cmd[:9] == ["nice", "-n", "10", "ionice", "-c", "2", "-n", "7", "rsync"]
+        assert "--bwlimit=3000" in rsync_cmd
+        transfer_settings = rsync_to_rdisc.settings.transfer_settings["glims"]["transfers"][0]
+        rsync_cmd = rsync_to_rdisc.get_rsync_cmd("hpct04", "run1", transfer_settings, "/mnt/glims/")
+        assert rsync_cmd[0] == "rsync"
+        assert not [option for option in rsync_cmd if option.startswith("--bwlimit")]
+
+    def test_get_retry_delay(self):
+        assert [rsync_to_rdisc.get_retry_delay({}, attempt) for attempt in range(1, 7)] == [60, 120, 240, 480, 900, 900]
+        assert rsync_to_rdisc.get_retry_delay({"retry_backoff": 10}, 2) == 20
+
     def test_rsync_error(self, set_up_test, mocker, mock_send_mail_transfer_state, fake_process):
         mocker.patch("rsync_to_rdisc.check_if_file_missing", return_value=[])
-        mocker.patch("rsync_to_rdisc.check_rsync", return_value="error")
+        mock_check_rsync = mocker.patch("rsync_to_rdisc.check_rsync", return_value="error")
 
         # Use fake_process of pytest subprocess to mock subprocess.run
         fake_process.register_subprocess(
@@ -438,13 +1926,11 @@ class TestRsyncServerRemote:
             set_up_test["tmp_path"],
             f"{rsync_to_rdisc.settings.wkdir}/transferred_runs.txt",
         )
-        assert (
-            f"{set_up_test['run']}_3_Exomes" not in Path(f"{rsync_to_rdisc.settings.wkdir}/transferred_runs.txt").read_text()
-        )
+        assert f"{set_up_test['run']}_3_Exomes" not in rsync_to_rdisc.get_transferred_runs(rsync_to_rdisc.settings.wkdir)
 
         mock_send_mail_transfer_state.reset_mock()
         assert fake_process.call_count(["rsync", "-rahuL", "--stats", fake_process.any()]) == 1
-        assert "Just stderr" in Path(rsync_to_rdisc.settings.temp_error_path).read_text()
+        assert mock_check_rsync.call_args[1]["subprocess_out"].stderr == "Just stderr\n"
         assert "Just stderr" in Path(rsync_to_rdisc.settings.errorlog_path).read_text()
 
     # parametrize GATK / ExomeDepth error and no errors.
@@ -466,7 +1952,7 @@ class TestRsyncServerRemote:
     ):
         analysis = f"{set_up_test['run']}_{project}"
         mocker.patch("rsync_to_rdisc.check_if_file_missing", return_value=[])
-        mocker.patch("rsync_to_rdisc.subprocess.run")
+        mocker.patch("rsync_to_rdisc.run_rsync", return_value=subprocess.CompletedProcess([], 0, "", ""))
         mocker.patch("rsync_to_rdisc.check_rsync", return_value="ok")
         mocker.patch("rsync_to_rdisc.upload_gatk_vcf", return_value=(gatk_succes, ""))
         mocker.patch("rsync_to_rdisc.upload_exomedepth_vcf", return_value=(ed_succes, ""))
@@ -483,9 +1969,11 @@ class TestRsyncServerRemote:
             state=state,
             upload_result_gatk="",
             upload_result_exomedepth="",
+            metrics=mocker.ANY,
+            verify_result=None,
         )
         mock_send_mail_transfer_state.reset_mock()
-        assert f"{analysis}_Exomes\t{state}" in Path(f"{rsync_to_rdisc.settings.wkdir}/transferred_runs.txt").read_text()
+        assert rsync_to_rdisc.get_transferred_runs(rsync_to_rdisc.settings.wkdir).get(f"{analysis}_Exomes")["state"] == state
 
 
 def test_run_vcf_upload(mocker, set_up_test):
@@ -517,6 +2005,21 @@ def test_run_vcf_upload(mocker, set_up_test):
     assert out == ["passed", "done"]
 
 
+def test_run_vcf_uploads(mocker):
+    mocker.patch.object(rsync_to_rdisc.settings, "vcf_upload_workers", 2)
+
+    def side_effect_slow_run_vcf_upload(vcf_file, vcf_type, run):
+        # First vcf file finishes last, output order should follow input order.
+        time.sleep(0.05 if vcf_file == "1.vcf" else 0)
+        return [f"{vcf_file} {vcf_type} {run}"]
+
+    mock_run_vcf_upload = mocker.patch("rsync_to_rdisc.run_vcf_upload", side_effect=side_effect_slow_run_vcf_upload)
+    out = rsync_to_rdisc.run_vcf_uploads(["1.vcf", "2.vcf", "3.vcf"], "VCF_FILE", "run")
+    assert out == [["1.vcf VCF_FILE run"], ["2.vcf VCF_FILE run"], ["3.vcf VCF_FILE run"]]
+    assert mock_run_vcf_upload.call_count == 3
+    assert rsync_to_rdisc.run_vcf_uploads([], "VCF_FILE", "run") == []
+
+
 @pytest.mark.parametrize(
     "msg,expected",
     [